@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# Copyright 2017 Red Hat Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Generate network isolation templates without the UI
+
+Each input is a directory containing either a nic-input.json and
+global-input.json pair or the ui-settings.json (or older ui-settings.pickle)
+from a previous run of net-iso-gen.py.  Environments are generated in
+parallel across a pool of worker processes.  If there is only one, its roles
+are generated in parallel instead.
+
+By default the templates are written back into each input directory.  If
+--output is passed, each environment is instead written to a subdirectory of
+that path named after the input directory.
+
+Files whose inputs have not changed since the last run into the same output
+directory are skipped unless --force is passed.
+
+Passing --stats reports the time taken by each stage of generation, and
+--profile writes cProfile stats for each environment.
+
+With --diff, nothing is written.  Instead a unified diff is printed for every
+template that differs from the one already in the output directory, and the
+exit status is 1 if any do.
+
+With --watch, the inputs are generated once and then polled for changes.
+Each input is regenerated as soon as its files have stopped changing for the
+--debounce period, which only rewrites the files affected by the change.
+Only the input files that changed are parsed again, and the roles are
+written one at a time.  This carries on until interrupted.  --output is
+required with --watch, so that the watched directories are never written to.
+
+Passing --node-count plans a fixed IP for every node and writes them to
+ips-from-pool.yaml.  The counts apply to every environment and override any
+saved in the settings.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import netaddr
+
+import net_processing
+
+# The errors _generate_one reports as a failure of that input.  Malformed
+# input data can raise KeyError, TypeError or AttributeError as well as the
+# usual errors.
+INPUT_ERRORS = (RuntimeError, EnvironmentError, ValueError, KeyError,
+                TypeError, AttributeError, netaddr.AddrFormatError)
+
+
+def _parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Generate network isolation templates from saved '
+                    'net-iso-gen.py settings.')
+    parser.add_argument('inputs', nargs='+', metavar='DIR',
+                        help='Directory containing nic-input.json and '
+                             'global-input.json, or ui-settings.json')
+    parser.add_argument('-o', '--output',
+                        help='Write each environment to a subdirectory of '
+                             'this path instead of to its input directory')
+    parser.add_argument('-j', '--jobs', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='Number of worker processes (default: %(default)s)')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Regenerate every file, even if its inputs are '
+                             'unchanged since the last run')
+    parser.add_argument('-n', '--node-count', action='append', default=[],
+                        type=_node_count, metavar='ROLE=COUNT',
+                        help='Number of nodes of a role to plan fixed IPs '
+                             'for.  May be repeated.')
+    parser.add_argument('-s', '--stats', action='store_true',
+                        help='Report the time taken by each stage of '
+                             'generation')
+    parser.add_argument('-p', '--profile', metavar='DIR',
+                        help='Write cProfile stats for each environment to '
+                             'a file in this directory named after it')
+    parser.add_argument('-d', '--diff', action='store_true',
+                        help='Print a diff of the changes generating would '
+                             'make, without writing anything')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='Keep running, and regenerate each input when '
+                             'its files change')
+    parser.add_argument('--interval', type=float, default=0.1,
+                        metavar='SECONDS',
+                        help='How often --watch checks the inputs for changes '
+                             '(default: %(default)s)')
+    parser.add_argument('--debounce', type=float, default=0.2,
+                        metavar='SECONDS',
+                        help='How long the input files must be unchanged '
+                             'before --watch regenerates them '
+                             '(default: %(default)s)')
+    args = parser.parse_args(args)
+    if args.diff and (args.watch or args.profile):
+        parser.error('--diff cannot be used with --watch or --profile')
+    if args.watch and args.output is None:
+        parser.error('--watch requires --output')
+    return args
+
+
+def _node_count(value):
+    role, sep, count = value.partition('=')
+    try:
+        count = int(count)
+    except ValueError:
+        sep = None
+    if not role or not sep or count < 0:
+        raise argparse.ArgumentTypeError('"%s" is not of the form '
+                                         'ROLE=COUNT' % value)
+    return role, count
+
+
+def _profile_path(input_path, profile_root):
+    if profile_root is None:
+        return None
+    return os.path.join(profile_root, '%s.prof' %
+                        os.path.basename(os.path.normpath(input_path)))
+
+
+def _generate_one(task, cache=None):
+    """Generate a single environment
+
+    Runs in a worker process, so errors are returned rather than raised.
+
+    :param cache: As for _load_input.  If not passed, the input is read
+                  from scratch.
+    """
+    (input_path, output_path, force, workers, node_counts, profile,
+     diff) = task
+    start = time.time()
+    written = []
+    stats = net_processing._Stats()
+    try:
+        if cache is None:
+            data, global_data = net_processing._load_input(input_path)
+        else:
+            data, global_data = _load_input(input_path, cache)
+        if node_counts:
+            counts = dict(global_data.get('node_counts') or {})
+            counts.update(node_counts)
+            global_data = dict(global_data, node_counts=counts)
+        if diff:
+            written = net_processing._diff(data, global_data, output_path,
+                                           workers, stats)
+        else:
+            written = net_processing._generate(data, global_data,
+                                               output_path, force, workers,
+                                               stats, profile)
+        error = None
+    except INPUT_ERRORS as e:
+        error = str(e)
+        if isinstance(e, KeyError):
+            error = 'Missing key %s' % error
+    return (input_path, output_path, time.time() - start, written, error,
+            stats)
+
+
+def _print_result(result, show_stats, diff=False):
+    """Print the result of _generate_one
+
+    :returns: True if the environment was generated, or compared with diff,
+              successfully.
+    """
+    input_path, output_path, elapsed, written, error, stats = result
+    if error is not None:
+        print('%8.1f ms  %s FAILED: %s' % (elapsed * 1000, input_path, error))
+        sys.stdout.flush()
+        return False
+    if diff:
+        for path, lines in written:
+            sys.stdout.writelines(lines)
+        print('%8.1f ms  %s vs %s (%d files differ)' %
+              (elapsed * 1000, input_path, output_path, len(written)))
+    else:
+        print('%8.1f ms  %s -> %s (%d files written)' %
+              (elapsed * 1000, input_path, output_path, len(written)))
+    if show_stats:
+        print('            %s' % stats.summary())
+    sys.stdout.flush()
+    return True
+
+
+def _input_signature(input_path):
+    """Return something that changes whenever an input file changes"""
+    signature = []
+    for path in net_processing._input_files(input_path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            signature.append((path, None, None))
+        else:
+            signature.append((path, st.st_mtime, st.st_size))
+    return signature
+
+
+def _load_input(input_path, cache):
+    """Load an input as net_processing._load_input does, using cache
+
+    Only the input files whose modification time or size have changed since
+    they were cached are parsed again.
+
+    :param cache: dict of the signature and parsed contents of each input
+                  file, which is updated in place.
+    """
+    loaded = []
+    for path, mtime, size in _input_signature(input_path):
+        if mtime is None:
+            # Let net_processing report the missing input
+            return net_processing._load_input(input_path)
+        cached = cache.get(path)
+        if cached is None or cached[0] != (mtime, size):
+            if os.path.basename(path) in ('nic-input.json',
+                                          'global-input.json'):
+                with open(path) as f:
+                    value = json.loads(f.read())
+                if not isinstance(value, dict):
+                    raise RuntimeError('%s does not contain a JSON object' %
+                                       path)
+            else:
+                value = net_processing._load(input_path)
+            cached = cache[path] = ((mtime, size), value)
+        loaded.append(cached[1])
+    if len(loaded) == 1:
+        return loaded[0]
+    return tuple(loaded)
+
+
+def _watch(tasks, interval, debounce, show_stats):
+    """Regenerate each task whenever its inputs change, until interrupted
+
+    An input is regenerated once its files have been unchanged for debounce
+    seconds, so a burst of saves only regenerates it once.  Only the files
+    affected by a change are rewritten, even if --force was passed, and the
+    roles are written serially rather than by a new pool on every change.
+    """
+    tasks = [t[:2] + (False, 1) + t[4:] for t in tasks]
+    signatures = dict((t[0], _input_signature(t[0])) for t in tasks)
+    changed = {}
+    cache = {}
+    for task in tasks:
+        try:
+            _load_input(task[0], cache)
+        except INPUT_ERRORS:
+            pass
+    print('Watching %d inputs for changes' % len(tasks))
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(interval)
+            now = time.time()
+            for task in tasks:
+                input_path = task[0]
+                signature = _input_signature(input_path)
+                if signature != signatures[input_path]:
+                    signatures[input_path] = signature
+                    changed[input_path] = now
+                elif (input_path in changed and
+                        now - changed[input_path] >= debounce):
+                    del changed[input_path]
+                    _print_result(_generate_one(task, cache), show_stats)
+    except KeyboardInterrupt:
+        pass
+
+
+def main(args=None):
+    args = _parse_args(sys.argv[1:] if args is None else args)
+
+    # Pool workers cannot start processes of their own, so the roles are only
+    # written in parallel when there is a single environment.
+    role_workers = args.jobs if len(args.inputs) == 1 else 1
+    try:
+        outputs = net_processing._output_dirs(args.inputs, args.output)
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        return 1
+    tasks = [(i, o, args.force, role_workers, dict(args.node_count),
+              _profile_path(i, args.profile), args.diff)
+             for i, o in zip(args.inputs, outputs)]
+    if args.watch and any(os.path.realpath(t[0]) == os.path.realpath(t[1])
+                          for t in tasks):
+        print('--watch cannot write to the directory it is watching',
+              file=sys.stderr)
+        return 1
+    for path in (None if args.diff else args.output, args.profile):
+        if path is not None and not os.path.isdir(path):
+            os.makedirs(path)
+
+    failed = 0
+    differ = 0
+    start = time.time()
+    if len(tasks) == 1:
+        pool = None
+        results = [_generate_one(tasks[0])]
+    else:
+        pool = multiprocessing.Pool(max(1, min(args.jobs, len(tasks))))
+        results = pool.imap_unordered(_generate_one, tasks)
+    try:
+        for result in results:
+            if not _print_result(result, args.stats, args.diff):
+                failed += 1
+            elif args.diff and result[3]:
+                differ += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    total = time.time() - start
+
+    print(net_processing._throughput('Compared' if args.diff else 'Generated',
+                                     len(tasks) - failed, len(tasks), total,
+                                     'environments'))
+    if args.watch:
+        _watch(tasks, args.interval, args.debounce, args.stats)
+        return 0
+    return 1 if failed or differ else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# Copyright 2017 Red Hat Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Benchmark net_processing against large synthetic topologies
+
+A topology of any size is generated from a seed, so the same arguments always
+benchmark the same input.  Each role has a control plane nic, a bridge with a
+bond and a VLAN for some of the other networks, and any remaining nics either
+unconfigured or on a network of their own.  Routes are scattered over all of
+them.
+
+Every stage of generation is timed separately, taking the best of --repeat
+runs, and its peak memory use is measured in a separate run so that tracing
+does not skew the times.  Peak memory needs tracemalloc, so it is only
+reported on Python 3.
+
+The results can be saved with --output and later passed back in with
+--baseline, in which case any stage that has got slower or bigger by more
+than --threshold is reported and the exit status is 1.
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import net_processing
+
+RESULTS_VERSION = 1
+# Time differences smaller than this are noise, however large in proportion
+NOISE_SECONDS = 0.001
+# Networks other than ControlPlane that are IPv6 with --ipv6, as in a typical
+# IPv6 deployment where tenant and management traffic stay on IPv4
+IPV6_NETWORKS = ['External', 'InternalApi', 'Storage', 'StorageMgmt']
+
+
+def _parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Benchmark template generation on a synthetic topology.')
+    parser.add_argument('-r', '--roles', type=int, default=50,
+                        help='Number of roles (default: %(default)s)')
+    parser.add_argument('-m', '--nics', type=int, default=6,
+                        help='Number of nics per role, at least 3 '
+                             '(default: %(default)s)')
+    parser.add_argument('--networks', type=int, default=0,
+                        help='Number of custom networks on top of the '
+                             'standard ones (default: %(default)s)')
+    parser.add_argument('--ipv6', action='store_true',
+                        help='Use IPv6 for the external, internal API and '
+                             'storage networks')
+    parser.add_argument('--node-count', type=int, default=0, metavar='COUNT',
+                        help='Also benchmark planning fixed IPs for this many '
+                             'nodes of each role')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='Seed for the topology (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs of each stage to take the best time of '
+                             '(default: %(default)s)')
+    parser.add_argument('-o', '--output',
+                        help='Write the results to this json file')
+    parser.add_argument('-b', '--baseline',
+                        help='Compare the results with this json file written '
+                             'by --output')
+    parser.add_argument('-t', '--threshold', type=float, default=0.25,
+                        help='Fraction a stage may grow by before it is '
+                             'reported as a regression (default: %(default)s)')
+    args = parser.parse_args(args)
+    if args.nics < 3:
+        parser.error('--nics must be at least 3')
+    if args.roles < 1:
+        parser.error('--roles must be at least 1')
+    return args
+
+
+def _routes(rng, max_routes=2):
+    return [{'type': 'route', 'name': 'Route',
+             'ip_netmask': '192.168.%d.0/24' % rng.randint(0, 255),
+             'next_hop': '192.168.%d.1' % rng.randint(0, 255),
+             'default': False, 'members': []}
+            for i in range(rng.randint(0, max_routes))]
+
+
+def _interface(rng, name, network='None', primary=False):
+    return {'type': 'interface', 'name': name, 'network': network,
+            'primary': primary, 'mtu': -1, 'addresses': [], 'routes': [],
+            'use_dhcp': False, 'members': _routes(rng)}
+
+
+def _role_nodes(rng, networks, nics):
+    """Build the nic-config data of one role"""
+    networks = list(networks)
+    rng.shuffle(networks)
+    # Networks that do not go on the bridge can have a nic of their own
+    spare = nics - 3
+    on_nics = networks[:rng.randint(0, min(spare, len(networks)))]
+    on_vlans = networks[len(on_nics):]
+    on_vlans = on_vlans[:rng.randint(1, len(on_vlans))] if on_vlans else []
+
+    bond = {'type': 'ovs_bond', 'name': 'bond1', 'network': 'None',
+            'bond_type': rng.choice(['ovs', 'linux']),
+            'ovs_options': '{get_param: BondInterfaceOvsOptions}',
+            'mtu': -1, 'addresses': [], 'routes': [],
+            'members': ([_interface(rng, 'nic2', primary=True),
+                         _interface(rng, 'nic3')] + _routes(rng, 1))}
+    vlans = [{'type': 'vlan', 'name': 'VLAN', 'network': n, 'vlan_id': '',
+              'mtu': -1, 'addresses': [], 'routes': [],
+              'members': _routes(rng, 1)}
+             for n in on_vlans]
+    bridge = {'type': 'ovs_bridge', 'name': 'br-ex', 'network': 'None',
+              'bridge_type': 'ovs', 'use_dhcp': False,
+              'dns_servers': '{get_param: DnsServers}', 'mtu': -1,
+              'addresses': [], 'routes': [],
+              'members': [bond] + vlans + _routes(rng, 1)}
+
+    nodes = [_interface(rng, 'nic1', 'ControlPlane', True), bridge]
+    for i in range(4, nics + 1):
+        network = on_nics[i - 4] if i - 4 < len(on_nics) else 'None'
+        nodes.append(_interface(rng, 'nic%d' % i, network))
+    return nodes
+
+
+def _network_settings(i, version):
+    """Settings for the i'th network, with a /16 of its own if IPv4"""
+    if version == 6:
+        prefix = 'fd00:fd00:fd00:%x000::' % (i + 1)
+        return {'cidr': prefix + '/64', 'start': prefix + '10',
+                'end': prefix[:-1] + 'ffff:ffff:ffff:fffe'}
+    return {'cidr': '10.%d.0.0/16' % i, 'start': '10.%d.0.10' % i,
+            'end': '10.%d.255.250' % i}
+
+
+def generate_topology(roles, nics, networks=0, ipv6=False, seed=0):
+    """Generate the data and global_data of a synthetic topology
+
+    The same arguments always generate the same topology, which passes
+    net_processing._validate_config.
+    """
+    rng = random.Random(seed)
+    global_data = {'major': net_processing.DATA_MAJOR,
+                   'minor': net_processing.DATA_MINOR,
+                   'ipv6': ipv6,
+                   'auto_routes': True,
+                   'bond_options': '',
+                   'dns1': '8.8.8.8',
+                   'dns2': '8.8.4.4',
+                   'control': {'route': '192.0.2.1', 'mask': 24,
+                               'ec2': '192.0.2.1'},
+                   'roles': [{'filename': 'bench-role-%d.yaml' % i}
+                             for i in range(roles)],
+                   'networks': [{'name': 'Bench%d' % i, 'vlan': 10 + i}
+                                for i in range(networks)],
+                   }
+    all_networks = net_processing._networks(global_data)[1:]
+    for i, net in enumerate(all_networks):
+        version = 6 if ipv6 and net['name'] in IPV6_NETWORKS else 4
+        settings = _network_settings(i, version)
+        settings['vlan'] = i + 1
+        if net['name'] == 'External':
+            settings['bridge'] = "''"
+            settings['gateway'] = settings['start'][:-2] + '1'
+        global_data[net['lower']] = settings
+
+    names = [n['name'] for n in all_networks]
+    data = dict((r['filename'], _role_nodes(rng, names, nics))
+                for r in global_data['roles'])
+    return data, global_data
+
+
+def _time(func, repeat):
+    return min(timeit.Timer(func).repeat(repeat, 1))
+
+
+def _peak(func):
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _stages(data, global_data, base_path, index):
+    """The stages to benchmark, in order, as (name, callable) pairs"""
+    np = net_processing
+    stages = [
+        ('validate_config', lambda: np._validate_config(data, global_data)),
+        ('check_duplicate_vlans',
+         lambda: np._check_duplicate_vlans(data, global_data, index)),
+        ('check_duplicate_networks',
+         lambda: np._check_duplicate_networks(data)),
+        ('check_duplicate_bonds', lambda: np._check_duplicate_bonds(data)),
+        ('check_duplicate_nics', lambda: np._check_duplicate_nics(data)),
+        ('check_overlapping_cidrs',
+         lambda: np._check_overlapping_cidrs(data, global_data, index)),
+        ('check_ips_in_cidr',
+         lambda: np._check_ips_in_cidr(data, global_data, index)),
+        ('check_primary_interfaces',
+         lambda: np._check_primary_interfaces(data)),
+        ('check_bridge_members', lambda: np._check_bridge_members(data)),
+        ('write_nic_configs',
+         lambda: np._write_nic_configs(data, global_data, base_path)),
+        ('write_net_env',
+         lambda: np._write_net_env(data, global_data, base_path, index)),
+        ('write_net_iso',
+         lambda: np._write_net_iso(data, global_data, base_path,
+                                   index=index)),
+        ('write_settings',
+         lambda: np._write_settings(data, global_data, base_path)),
+        ('load', lambda: np._load(base_path)),
+    ]
+    if global_data.get('node_counts'):
+        stages.append(('plan_ips',
+                       lambda: np._plan_ips(data, global_data, index)))
+    stages.append(('generate',
+                   lambda: np._generate(data, global_data, base_path,
+                                        force=True)))
+    return stages
+
+
+def run(data, global_data, repeat=3):
+    """Benchmark every stage on the topology passed in
+
+    :returns: An ordered dict mapping each stage name to a dict of its best
+              time in seconds and its peak memory use in bytes, which is None if
+              it cannot be measured.
+    """
+    base_path = tempfile.mkdtemp()
+    try:
+        index = net_processing._validate_config(data, global_data)
+        results = collections.OrderedDict()
+        for name, func in _stages(data, global_data, base_path, index):
+            results[name] = {'seconds': _time(func, repeat),
+                             'peak_bytes': _peak(func)}
+        return results
+    finally:
+        shutil.rmtree(base_path)
+
+
+def compare(results, baseline, threshold):
+    """Find the stages that have regressed against a baseline
+
+    :returns: A list of (stage, measurement, baseline value, new value) for
+              each measurement that grew by more than threshold.  Stages or
+              measurements missing from either side are ignored, as are
+              time differences below NOISE_SECONDS.
+    """
+    regressions = []
+    for name, stage in sorted(results.items()):
+        old = baseline.get(name)
+        if old is None:
+            continue
+        for key in ('seconds', 'peak_bytes'):
+            if stage.get(key) is None or not old.get(key):
+                continue
+            if key == 'seconds' and stage[key] - old[key] < NOISE_SECONDS:
+                continue
+            if stage[key] > old[key] * (1 + threshold):
+                regressions.append((name, key, old[key], stage[key]))
+    return regressions
+
+
+def _print_results(results, baseline):
+    print('%-26s %12s %12s %10s' % ('stage', 'ms', 'peak KiB', 'vs base'))
+    for name, stage in results.items():
+        peak = stage['peak_bytes']
+        change = ''
+        if name in baseline and baseline[name]['seconds']:
+            change = '%+9.1f%%' % ((stage['seconds'] /
+                                    baseline[name]['seconds'] - 1) * 100)
+        print('%-26s %12.2f %12s %10s' %
+              (name, stage['seconds'] * 1000,
+               '-' if peak is None else '%.1f' % (peak / 1024.0), change))
+
+
+def main(args=None):
+    args = _parse_args(sys.argv[1:] if args is None else args)
+    topology = {'roles': args.roles, 'nics': args.nics,
+                'networks': args.networks, 'ipv6': args.ipv6,
+                'node_count': args.node_count, 'seed': args.seed}
+
+    data, global_data = generate_topology(args.roles, args.nics,
+                                          args.networks, args.ipv6,
+                                          args.seed)
+    if args.node_count:
+        global_data['node_counts'] = dict(
+            (net_processing._role(r)['name'], args.node_count)
+            for r in global_data['roles'])
+    results = run(data, global_data, args.repeat)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            file_data = json.load(f)
+        if file_data.get('topology') != topology:
+            print('Warning: the baseline was run on a different topology',
+                  file=sys.stderr)
+        baseline = file_data['results']
+    _print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'version': RESULTS_VERSION,
+                       'python': platform.python_version(),
+                       'topology': topology,
+                       'results': results,
+                       }, f, indent=1, sort_keys=True)
+
+    regressions = compare(results, baseline, args.threshold)
+    for name, key, old, new in regressions:
+        print('REGRESSION: %s %s went from %s to %s' % (name, key, old, new),
+              file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
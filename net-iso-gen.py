@@ -18,6 +18,7 @@
 import copy
 import os
 import sys
+import threading
 import yaml
 
 import sip
@@ -27,11 +28,22 @@ sip.setapi('QVariant', 2)
 from PyQt4 import QtCore
 from PyQt4 import QtGui
 
+import net_history
 import net_processing
 
 
-DATA_MAJOR = 1
-DATA_MINOR = 2
+DATA_MAJOR = net_processing.DATA_MAJOR
+DATA_MINOR = net_processing.DATA_MINOR
+# Milliseconds to wait after an edit before validating
+VALIDATE_DELAY = 300
+# Icon files for each type of item, and for the roles
+ICONS = {'role': 'network-server.png',
+         'interface': 'network-wired.png',
+         'ovs_bridge': 'bridge.png',
+         'ovs_bond': 'repository.png',
+         'vlan': 'network-workgroup.png',
+         'route': 'arrow-right.png',
+         }
 
 
 def get_current_item(model):
@@ -84,6 +96,43 @@ class NetworkListWidget(QtGui.QListWidget):
         self.focused.emit()
 
 
+class GenerateThread(QtCore.QThread):
+    """Run net_processing._generate without blocking the UI
+
+    The outcome is reported through signals, which Qt delivers to slots on
+    the UI thread.
+    """
+    progress = QtCore.pyqtSignal(int, int, str)
+    succeeded = QtCore.pyqtSignal(str)
+    failed = QtCore.pyqtSignal(str)
+    cancelled = QtCore.pyqtSignal()
+
+    def __init__(self, data, global_data, base_path, parent=None):
+        super(GenerateThread, self).__init__(parent)
+        self._args = (data, global_data, base_path)
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def run(self):
+        stats = net_processing._Stats()
+        try:
+            # The roles are written serially.  Forking a pool from a
+            # threaded Qt process is not safe, and for the handful of roles
+            # a layout has it would be slower anyway.
+            net_processing._generate(*self._args, stats=stats,
+                                     progress=self.progress.emit,
+                                     cancel=self._cancel)
+        except net_processing._Cancelled:
+            self.cancelled.emit()
+        except Exception as e:
+            # Nothing would see an exception raised out of the thread
+            self.failed.emit(str(e))
+        else:
+            self.succeeded.emit(stats.summary())
+
+
 class MainForm(QtGui.QMainWindow):
     def __init__(self):
         super(MainForm, self).__init__()
@@ -95,8 +144,44 @@ class MainForm(QtGui.QMainWindow):
         self._interface_models = {}
         self._nested_models = {}
         self._last_selected = None
+        # Role definitions loaded from the settings, if they were customized
+        self._roles = None
+        self._role_list = []
+        self._role_index = {}
+        # Networks added in the loaded settings, which have no widgets
+        self._networks = None
+        self._network_settings = {}
+        # Node counts for IP planning, which can't be edited in the UI
+        self._node_counts = None
+        # Where networks and nic numbers are used, kept up to date by every
+        # edit so they don't have to be recalculated from all the models
+        self._usage = net_processing._NetworkUsage()
+        # Members of items loaded by _dict_to_ui that have not been shown yet
+        self._pending = {}
+        # The GenerateThread currently running, if any
+        self._generate_thread = None
+        # Validation runs once edits pause, and only revalidates the roles
+        # edited since it last ran
+        self._validator = net_processing._Validator()
+        self._edited_roles = set()
+        self._errors = {}
+        self._validate_timer = QtCore.QTimer(self)
+        self._validate_timer.setSingleShot(True)
+        self._validate_timer.setInterval(VALIDATE_DELAY)
+        self._validate_timer.timeout.connect(self._validate)
+        self._error_brush = QtGui.QBrush(QtGui.QColor(255, 192, 192))
+        # Each role's data as of every pause in editing, for undo and redo
+        self._history = net_history.History()
+        # Loading every icon from disk for each item is slow on big layouts
+        self._icons = dict((name, QtGui.QIcon(os.path.join('icons', path)))
+                           for name, path in ICONS.items())
 
         self._setup_ui()
+        # The global settings only affect the global rules, which are cheap
+        for widget in self.findChildren(QtGui.QLineEdit):
+            widget.textEdited.connect(self._global_edited)
+        for widget in self.findChildren(QtGui.QSpinBox):
+            widget.valueChanged.connect(self._global_edited)
         if len(sys.argv) > 1:
             self._load_templates(sys.argv[1])
         self._update_enabled_networks()
@@ -129,22 +214,23 @@ class MainForm(QtGui.QMainWindow):
         delete = QtGui.QPushButton('Delete')
         delete.clicked.connect(self._delete_current)
         button_layout.addWidget(delete)
+        self.undo = QtGui.QPushButton('Undo')
+        self.undo.setShortcut(QtGui.QKeySequence(QtGui.QKeySequence.Undo))
+        self.undo.setEnabled(False)
+        self.undo.clicked.connect(self._undo)
+        button_layout.addWidget(self.undo)
+        self.redo = QtGui.QPushButton('Redo')
+        self.redo.setShortcut(QtGui.QKeySequence(QtGui.QKeySequence.Redo))
+        self.redo.setEnabled(False)
+        self.redo.clicked.connect(self._redo)
+        button_layout.addWidget(self.redo)
         main_layout.addLayout(button_layout)
 
         pane_layout = QtGui.QHBoxLayout()
         main_layout.addLayout(pane_layout)
 
         self.node_type = NetworkListWidget()
-        def new_item(name):
-            item = QtGui.QListWidgetItem(
-                QtGui.QIcon(os.path.join('icons', 'network-server.png')), name)
-            self.node_type.addItem(item)
-            self._node_models[item] = QtGui.QStandardItemModel(0, 1)
-        new_item('Controller')
-        new_item('Compute')
-        new_item('Ceph')
-        new_item('Block Storage')
-        new_item('Swift')
+        self._set_roles(net_processing._roles())
         self.node_type.setIconSize(QtCore.QSize(64, 64))
         self.node_type.currentRowChanged.connect(self._node_type_changed)
         self.node_type.focused.connect(self._node_type_focused)
@@ -186,13 +272,8 @@ class MainForm(QtGui.QMainWindow):
         input_layout.addWidget(self.network_group)
         self.network_type = QtGui.QComboBox()
         self.network_type.addItem('None')
-        self.network_type.addItem('ControlPlane')
-        self.network_type.addItem('External')
-        self.network_type.addItem('InternalApi')
-        self.network_type.addItem('Storage')
-        self.network_type.addItem('StorageMgmt')
-        self.network_type.addItem('Tenant')
-        self.network_type.addItem('Management')
+        for net in net_processing.NETWORKS:
+            self.network_type.addItem(net['name'])
         self.network_type.currentIndexChanged.connect(self._network_type_changed)
         network_layout.addWidget(PairWidget('Network', self.network_type))
 
@@ -481,6 +562,20 @@ class MainForm(QtGui.QMainWindow):
         self.ipv6.setToolTip('Configure networks to use IPv6 when possible.')
         general_layout.addWidget(PairWidget('IPv6', self.ipv6))
 
+        self.dedup_nic_configs = QtGui.QCheckBox()
+        self.dedup_nic_configs.setToolTip('Generate a single nic-config '
+                                          'template for roles with identical '
+                                          'network layouts.')
+        general_layout.addWidget(PairWidget('Share Identical NIC Configs',
+                                            self.dedup_nic_configs))
+
+        self.trim_nic_params = QtGui.QCheckBox()
+        self.trim_nic_params.setToolTip('Only include the parameters for '
+                                        'networks each role uses in its '
+                                        'nic-config.')
+        general_layout.addWidget(PairWidget('Trim NIC Config Parameters',
+                                            self.trim_nic_params))
+
         self.version_box = QtGui.QSpinBox()
         self.version_box.setMinimum(1)
         self.version_box.setMaximum(2)
@@ -507,91 +602,150 @@ class MainForm(QtGui.QMainWindow):
         load.clicked.connect(self._load)
         generate_layout.addWidget(load, 1)
 
-        generate = QtGui.QPushButton('Generate')
-        generate.clicked.connect(self._generate_templates)
-        generate_layout.addWidget(generate, 3)
+        self.generate = QtGui.QPushButton('Generate')
+        self.generate.clicked.connect(self._generate_templates)
+        generate_layout.addWidget(self.generate, 3)
+
+        self.cancel = QtGui.QPushButton('Cancel')
+        self.cancel.setToolTip('Stop generating.  Nothing in the output path '
+                               'is changed.')
+        self.cancel.setEnabled(False)
+        self.cancel.clicked.connect(self._cancel_generate)
+        generate_layout.addWidget(self.cancel, 1)
         main_layout.addLayout(generate_layout)
 
+        self.progress = QtGui.QProgressBar()
+        self.progress.setVisible(False)
+        self.statusBar().addPermanentWidget(self.progress)
+
+        self.problems = QtGui.QLabel()
+        self.statusBar().addPermanentWidget(self.problems)
+
+    def _set_roles(self, roles):
+        """Replace the node types with roles, each with an empty model"""
+        self.node_type.blockSignals(True)
+        self.node_type.clear()
+        self.node_type.blockSignals(False)
+        self._node_models = {}
+        self._pending = {}
+        self._usage = net_processing._NetworkUsage()
+        self._validator = net_processing._Validator()
+        self._edited_roles = set()
+        self._role_list = roles
+        self._role_index = dict((r['filename'], i)
+                                for i, r in enumerate(roles))
+        for role in roles:
+            item = QtGui.QListWidgetItem(self._icons['role'], role['label'])
+            self.node_type.addItem(item)
+            self._node_models[item] = QtGui.QStandardItemModel(0, 1)
+            self._validator.update(role['filename'], [])
+        self._reset_history(dict((r['filename'], []) for r in roles))
+
     def _ui_to_dict(self):
         """Convert the UI data to a more readable dict
 
         :returns: dict representing the current UI state
         """
-        def process_leaf(model, d):
-            for i in range(model.rowCount()):
-                nd = copy.deepcopy(model.item(i).data())
+        return dict((role['filename'], self._role_to_dict(index))
+                    for index, role in enumerate(self._role_list))
+
+    def _role_to_dict(self, index):
+        """Convert the UI data of the role at index in the role list
+
+        :returns: list of the role's nodes, as in _ui_to_dict
+        """
+        def members(item, models, d):
+            """Yield each member of item, its data and a copy of the data
+
+            Members whose items have not been created yet come from the
+            pending data, or from d when item is one of them.
+            """
+            if item is None:
+                source = [(None, m) for m in d.get('members', [])]
+            elif item in self._pending:
+                source = [(None, m) for m in self._pending[item][0]]
+            else:
+                model = models[item]
+                source = [(model.item(i), model.item(i).data())
+                          for i in range(model.rowCount())]
+            for child, cd in source:
+                nd = dict((k, copy.deepcopy(v)) for k, v in cd.items()
+                          if k != 'members')
+                yield child, cd, nd
+
+        def process_leaf(item, orig, d):
+            for child, cd, nd in members(item, self._nested_models, orig):
                 d['members'].append(nd)
 
-        def process_bridge(model, d):
-            for i in range(model.rowCount()):
-                nd = copy.deepcopy(model.item(i).data())
+        def process_bridge(item, orig, d):
+            for child, cd, nd in members(item, self._interface_models, orig):
                 d['members'].append(nd)
                 nd['members'] = []
                 if nd['type'] == 'ovs_bond' or nd['type'] == 'vlan':
-                    item = model.item(i)
-                    nested_model = self._nested_models[item]
-                    process_leaf(nested_model, nd)
-
-        retval = {}
-        for index, filename, _ in net_processing.TYPE_LIST:
-            retval[filename] = []
-            current_item = self.node_type.item(index)
-            current_model = self._node_models[current_item]
-            for i in range(current_model.rowCount()):
-                d = copy.deepcopy(current_model.item(i).data())
-                d['members'] = []
-                item = current_model.item(i)
-                nested_model = self._interface_models[item]
-                process_bridge(nested_model, d)
-                retval[filename].append(d)
+                    process_leaf(child, cd, nd)
+
+        retval = []
+        for item, orig, d in members(self.node_type.item(index),
+                                     self._node_models, None):
+            d['members'] = []
+            process_bridge(item, orig, d)
+            retval.append(d)
         return retval
 
     def _dict_to_ui(self, data):
         """Populate the UI with values from a dict
 
         The dict must be structured the same as the output from _ui_to_dict.
+        Only the items of the first role are created here.  The rest are
+        created by _model as each role and item is first selected.
         """
-        def populate(data, current_model, next_models):
-            for d in data:
-                new_data = copy.deepcopy(d)
-                new_data.pop('members', None)
-                item = QtGui.QStandardItem()
-                if d['type'] == 'interface':
-                    item.setIcon(QtGui.QIcon(
-                        os.path.join('icons', 'network-wired.png')))
-                elif d['type'] == 'ovs_bridge':
-                    item.setIcon(QtGui.QIcon(
-                        os.path.join('icons', 'bridge.png')))
-                elif d['type'] == 'ovs_bond':
-                    item.setIcon(QtGui.QIcon(
-                        os.path.join('icons', 'repository.png')))
-                elif d['type'] == 'vlan':
-                    item.setIcon(QtGui.QIcon(
-                        os.path.join('icons', 'network-workgroup.png')))
-                elif d['type'] == 'route':
-                    item.setIcon(QtGui.QIcon(
-                        os.path.join('icons', 'arrow-right.png')))
-                item.setText(d['name'])
-                item.setData(new_data)
-                self._add_item(item, current_model, next_models)
-                if next_models is self._interface_models:
-                    populate(d['members'], next_models[item],
-                             self._nested_models)
-                elif next_models is self._nested_models:
-                    populate(d['members'], next_models[item], None)
-
         self._interface_models = {}
+        self._nested_models = {}
         self._last_selected = None
         # Initialize all node models
-        for i in range(self.node_type.count()):
-            current_item = self.node_type.item(i)
-            self._node_models[current_item] = QtGui.QStandardItemModel(0, 1)
+        self._set_roles(net_processing._roles(data, {'roles': self._roles}))
         for filename, all_data in data.items():
-            index = net_processing._index_from_filename(filename)
-            current_model = self._node_models[self.node_type.item(index)]
-            populate(all_data, current_model, self._interface_models)
+            index = self._role_index[filename]
+            self._pending[self.node_type.item(index)] = (
+                all_data, self._interface_models)
+            self._validator.update(filename, all_data)
+        self._reset_history(dict((r['filename'], data.get(r['filename'], []))
+                                 for r in self._role_list))
+        self._usage = net_processing._NetworkUsage(data)
+        self._validate_timer.start()
+        self._update_enabled_networks()
+        self.node_type.setCurrentRow(0)
         self._node_type_changed(None)
 
+    def _model(self, models, item):
+        """Return the model of item's members from models
+
+        The items of the members are created the first time this is called
+        for item, if it was loaded by _dict_to_ui.
+        """
+        model = models[item]
+        pending = self._pending.pop(item, None)
+        if pending is not None:
+            data, next_models = pending
+            for d in data:
+                new_data = dict((k, copy.deepcopy(v)) for k, v in d.items()
+                                if k != 'members')
+                child = QtGui.QStandardItem()
+                icon = self._icons.get(d['type'])
+                if icon is not None:
+                    child.setIcon(icon)
+                child.setText(d['name'])
+                child.setData(new_data)
+                model.appendRow(child)
+                if next_models is not None:
+                    next_models[child] = QtGui.QStandardItemModel(0, 1)
+                    if next_models is self._interface_models:
+                        following = self._nested_models
+                    else:
+                        following = None
+                    self._pending[child] = (d.get('members', []), following)
+        return model
+
     def _global_to_dict(self):
         """Convert the global UI data to a dict
 
@@ -611,7 +765,7 @@ class MainForm(QtGui.QMainWindow):
         retval['external']['gateway'] = self.external_gateway.text()
         retval['external']['vlan'] = self.external_vlan.value()
         retval['external']['bridge'] = self.external_bridge.text()
-        for _, net in net_processing.SIMILAR_NETS:
+        for net in [n['lower'] for n in net_processing.SIMILAR_NETWORKS]:
             retval[net] = {}
             retval[net]['cidr'] = getattr(self, '%s_cidr' % net).text()
             retval[net]['start'] = getattr(self, '%s_start' % net).text()
@@ -622,7 +776,20 @@ class MainForm(QtGui.QMainWindow):
         retval['bond_options'] = self.bond_options.text()
         retval['auto_routes'] = self.auto_routes.isChecked()
         retval['ipv6'] = self.ipv6.isChecked()
+        retval['dedup_nic_configs'] = self.dedup_nic_configs.isChecked()
+        retval['trim_nic_params'] = self.trim_nic_params.isChecked()
         retval['version'] = self.version_box.value()
+        if self._roles:
+            retval['roles'] = self._roles
+        if self._node_counts:
+            retval['node_counts'] = self._node_counts
+        # There are no widgets for added networks, so keep what was loaded
+        if self._networks:
+            retval['networks'] = self._networks
+            for net in net_processing._networks(retval)[len(
+                    net_processing.NETWORKS):]:
+                retval[net['lower']] = self._network_settings.get(
+                    net['lower'], {})
         return retval
 
     def _dict_to_global(self, data):
@@ -644,7 +811,7 @@ class MainForm(QtGui.QMainWindow):
         self.external_gateway.setText(data['external']['gateway'])
         self.external_vlan.setValue(data['external']['vlan'])
         self.external_bridge.setText(data['external']['bridge'])
-        for _, net in net_processing.SIMILAR_NETS:
+        for net in [n['lower'] for n in net_processing.SIMILAR_NETWORKS]:
             getattr(self, '%s_cidr' % net).setText(data[net]['cidr'])
             getattr(self, '%s_start' % net).setText(data[net]['start'])
             getattr(self, '%s_end' % net).setText(data[net]['end'])
@@ -654,34 +821,218 @@ class MainForm(QtGui.QMainWindow):
         self.bond_options.setText(data.get('bond_options', ''))
         self.auto_routes.setChecked(data.get('auto_routes', True))
         self.ipv6.setChecked(data.get('ipv6', False))
+        self.dedup_nic_configs.setChecked(data.get('dedup_nic_configs', False))
+        self.trim_nic_params.setChecked(data.get('trim_nic_params', False))
         self.version_box.setValue(data.get('version', 1))
+        self._roles = data.get('roles')
+        self._networks = data.get('networks')
+        self._node_counts = data.get('node_counts')
+        self._network_settings = {}
+        for net in net_processing._networks(data)[len(
+                net_processing.NETWORKS):]:
+            self._network_settings[net['lower']] = data.get(net['lower'], {})
+            if self.network_type.findText(net['name']) == -1:
+                self.network_type.addItem(net['name'])
+
+    def _role_edited(self, filename=None):
+        """Revalidate a role, by default the current one, once edits pause"""
+        self._edited_roles.add(filename or self._current_filename())
+        self._validate_timer.start()
+
+    def _global_edited(self, _):
+        self._validate_timer.start()
+
+    def _validate(self):
+        """Validate the edited roles and mark any problems found
+
+        The edited roles are also recorded as a step in the undo history.
+        """
+        changes = {}
+        for filename in self._edited_roles:
+            index = self._role_index.get(filename)
+            if index is None:
+                self._validator.remove(filename)
+            else:
+                changes[filename] = self._role_to_dict(index)
+                self._validator.update(filename, changes[filename])
+        self._edited_roles = set()
+        if self._history.record(changes):
+            self._update_undo()
+        errors = self._validator.errors(self._global_to_dict())[0]
+        self._errors = {}
+        for e in errors:
+            self._errors.setdefault(e.role, {}).setdefault(
+                e.path, []).append(e.message)
+        if errors:
+            self.problems.setText('%d problem(s)' % len(errors))
+        else:
+            self.problems.setText('')
+        self.problems.setToolTip('\n'.join(e.message for e in errors))
+        self._show_errors()
+
+    def _reset_history(self, data):
+        self._history = net_history.History(data)
+        self._update_undo()
+
+    def _update_undo(self):
+        self.undo.setEnabled(self._history.can_undo)
+        self.redo.setEnabled(self._history.can_redo)
+
+    def _undo(self):
+        self._flush_edits()
+        changes = self._history.undo()
+        if changes is not None:
+            self._restore(changes)
+
+    def _redo(self):
+        self._flush_edits()
+        changes = self._history.redo()
+        if changes is not None:
+            self._restore(changes)
+
+    def _flush_edits(self):
+        """Record any edits still waiting for validation in the history"""
+        if self._validate_timer.isActive():
+            self._validate_timer.stop()
+            self._validate()
+
+    def _restore(self, changes):
+        """Replace the data of the roles in changes from the history
+
+        The items of each role are recreated from the data as they are shown,
+        the same as after _dict_to_ui.
+        """
+        for filename, node_data in changes.items():
+            index = self._role_index[filename]
+            for _, _, d, _ in net_processing._walk_nodes(
+                    {filename: self._role_to_dict(index)}):
+                self._usage.remove(filename, d)
+            item = self.node_type.item(index)
+            model = self._node_models[item]
+            self._forget(model)
+            model.removeRows(0, model.rowCount())
+            self._pending[item] = (node_data, self._interface_models)
+            for _, _, d, _ in net_processing._walk_nodes(
+                    {filename: node_data}):
+                self._usage.add(filename, d)
+            self._validator.update(filename, node_data)
+        self._update_undo()
+        self._update_enabled_networks()
+        if (self.node_type.currentRow() >= 0 and
+                self._current_filename() in changes):
+            self._node_type_changed(None)
+        self._validate_timer.start()
+
+    def _forget(self, model):
+        """Drop the models and pending data of every item in model"""
+        for i in range(model.rowCount()):
+            self._forget_item(model.item(i))
+
+    def _forget_item(self, item):
+        """Drop the models and pending data of item and everything in it"""
+        self._pending.pop(item, None)
+        for models in (self._interface_models, self._nested_models):
+            child_model = models.pop(item, None)
+            if child_model is not None:
+                self._forget(child_model)
+
+    def _show_errors(self):
+        """Mark the items in the lists that have problems
+
+        Only the items currently shown are updated, so this does not depend
+        on the size of the layout.
+        """
+        if self.node_type.currentRow() < 0:
+            return
+        errors = self._errors.get(self._current_filename(), {})
+        path = ()
+        for view in (self.interfaces, self.nested_interfaces,
+                     self.leaf_interfaces):
+            model = view.model()
+            if model is None:
+                break
+            for i in range(model.rowCount()):
+                messages = errors.get(path + (i,))
+                item = model.item(i)
+                if messages:
+                    item.setBackground(self._error_brush)
+                    item.setToolTip('\n'.join(messages))
+                elif item.toolTip():
+                    item.setBackground(QtGui.QBrush())
+                    item.setToolTip('')
+            row = view.currentIndex().row()
+            if row < 0:
+                break
+            path += (row,)
 
     def _error(self, message):
         QtGui.QMessageBox.critical(self, 'Error', message)
         raise RuntimeError(message)
 
     def _generate_templates(self):
+        """Start generating the templates on a GenerateThread
+
+        The UI stays usable while the thread runs.  It works on a snapshot of
+        the settings, so later edits are not included.
+        """
+        if self._generate_thread is not None:
+            return
         base_path = self.base_path.text()
 
         data = self._ui_to_dict()
         global_data = self._global_to_dict()
-        try:
-            net_processing._validate_config(data, global_data)
-            net_processing._write_pickle(data, global_data, base_path)
-            net_processing._write_nic_configs(data, global_data, base_path)
-            # We need a fresh, unmolested copy of the dict for the following steps
-            data = self._ui_to_dict()
-            net_processing._write_net_env(data, global_data, base_path)
-            net_processing._write_net_iso(data, global_data, base_path)
-            net_processing._write_net_iso(data, global_data, base_path,
-                filename='network-isolation-absolute.yaml',
-                template_path='/usr/share/openstack-tripleo-heat-templates')
-        except RuntimeError as e:
-            self._error(str(e))
+        thread = GenerateThread(data, global_data, base_path, self)
+        thread.progress.connect(self._generate_progress)
+        thread.succeeded.connect(self._generate_succeeded)
+        thread.failed.connect(self._generate_failed)
+        thread.cancelled.connect(self._generate_cancelled)
+        thread.finished.connect(self._generate_finished)
+        self._generate_thread = thread
+        self.generate.setEnabled(False)
+        self.cancel.setEnabled(True)
+        # Busy indicator until the first file is written
+        self.progress.setRange(0, 0)
+        self.progress.setVisible(True)
+        self.statusBar().showMessage('Validating')
+        thread.start()
+
+    def _cancel_generate(self):
+        if self._generate_thread is not None:
+            self._generate_thread.cancel()
+            self.cancel.setEnabled(False)
+            self.statusBar().showMessage('Cancelling')
+
+    def _generate_progress(self, done, total, path):
+        self.progress.setRange(0, total)
+        self.progress.setValue(done)
+        self.statusBar().showMessage('Wrote %s' % path)
+
+    def _generate_succeeded(self, summary):
+        self.statusBar().showMessage('Generated: %s' % summary)
         QtGui.QMessageBox.information(self, 'Success!',
                                       'Templates generated successfully')
         print 'Templates generated successfully'
 
+    def _generate_failed(self, message):
+        self.statusBar().showMessage('Generation failed')
+        QtGui.QMessageBox.critical(self, 'Error', message)
+
+    def _generate_cancelled(self):
+        self.statusBar().showMessage('Generation cancelled')
+
+    def _generate_finished(self):
+        self._generate_thread = None
+        self.generate.setEnabled(True)
+        self.cancel.setEnabled(False)
+        self.progress.setVisible(False)
+
+    def closeEvent(self, event):
+        # The thread must not be destroyed with the window while it runs
+        if self._generate_thread is not None:
+            self._generate_thread.cancel()
+            self._generate_thread.wait()
+        super(MainForm, self).closeEvent(event)
+
     def _set_output_path(self):
         new_path = QtGui.QFileDialog.getExistingDirectory(self,
             'Select Output Directory', self.base_path.text())
@@ -703,9 +1054,10 @@ class MainForm(QtGui.QMainWindow):
 
     def _node_type_changed(self, index):
         self.interfaces.setModel(
-            self._node_models[self.node_type.currentItem()])
+            self._model(self._node_models, self.node_type.currentItem()))
         self.nested_interfaces.setModel(QtGui.QStandardItemModel(0, 1))
         self.leaf_interfaces.setModel(QtGui.QStandardItemModel(0, 1))
+        self._show_errors()
 
     def _node_type_focused(self):
         self._last_selected = self.node_type
@@ -714,12 +1066,14 @@ class MainForm(QtGui.QMainWindow):
         row = index.row()
         if row >= 0:
             item = index.model().item(row)
-            self.nested_interfaces.setModel(self._interface_models[item])
+            self.nested_interfaces.setModel(
+                self._model(self._interface_models, item))
             self.leaf_interfaces.setModel(QtGui.QStandardItemModel(0, 1))
             self._update_input(item)
         else:
             self.nested_interfaces.setModel(QtGui.QStandardItemModel(0, 1))
             self.leaf_interfaces.setModel(QtGui.QStandardItemModel(0, 1))
+        self._show_errors()
 
     def _interface_focused(self):
         self._last_selected = self.interfaces
@@ -729,8 +1083,10 @@ class MainForm(QtGui.QMainWindow):
         row = index.row()
         if row >= 0:
             item = index.model().item(row)
-            self.leaf_interfaces.setModel(self._nested_models[item])
+            self.leaf_interfaces.setModel(
+                self._model(self._nested_models, item))
             self._update_input(item)
+        self._show_errors()
 
     def _nested_focused(self):
         self._last_selected = self.nested_interfaces
@@ -749,44 +1105,32 @@ class MainForm(QtGui.QMainWindow):
     def _next_nic_name(self):
         """Guess a reasonable next nic number
 
-        Looks through the existing configuration to find the highest numbered
-        nic, then returns the name of the next in line.
+        Returns the name of the nic after the highest numbered one in the
+        current role.
         """
-        current_item = self.node_type.currentItem()
-        current_model = self._node_models[current_item]
-        next_nic_num = 1
-
-        def calculate_from_data(d, next_nic_num):
-            if d['type'] == 'interface':
-                if d['name'].startswith('nic'):
-                    nic_num = int(d['name'][3:])
-                    next_nic_num = max(next_nic_num, nic_num + 1)
-            return next_nic_num
-
-        for i in range(current_model.rowCount()):
-            d = current_model.item(i).data()
-            if d['type'] == 'interface':
-                next_nic_num = calculate_from_data(d, next_nic_num)
-            elif d['type'] == 'ovs_bridge':
-                item = current_model.item(i)
-                nested = self._interface_models[item]
-                for j in range(nested.rowCount()):
-                    nd = nested.item(j).data()
-                    next_nic_num = calculate_from_data(nd, next_nic_num)
-                    if nd['type'] == 'ovs_bond':
-                        item = nested.item(j)
-                        leaf = self._nested_models[item]
-                        for k in range(leaf.rowCount()):
-                            ld = leaf.item(k).data()
-                            next_nic_num = calculate_from_data(ld,
-                                                               next_nic_num)
-        nic_name = 'nic%d' % next_nic_num
-        return nic_name
+        return self._usage.next_nic(self._current_filename())
+
+    def _current_filename(self):
+        """Return the nic-config filename of the selected role"""
+        return self._role_list[self.node_type.currentRow()]['filename']
+
+    def _item_data(self, item):
+        """Return the data of item and of everything nested under it"""
+        nodes = [item.data()]
+        if item in self._pending:
+            nodes.extend(node for _, _, node, _ in
+                         net_processing._walk_nodes(
+                             {'': self._pending[item][0]}))
+            return nodes
+        for models in (self._interface_models, self._nested_models):
+            model = models.get(item)
+            if model is not None:
+                for i in range(model.rowCount()):
+                    nodes.extend(self._item_data(model.item(i)))
+        return nodes
 
     def _new_nic_item(self, nic_name, network='ControlPlane'):
-        item = QtGui.QStandardItem(
-            QtGui.QIcon(os.path.join('icons', 'network-wired.png')),
-            nic_name)
+        item = QtGui.QStandardItem(self._icons['interface'], nic_name)
         item.setData({'type': 'interface',
                       'name': nic_name,
                       'use_dhcp': False,
@@ -804,7 +1148,7 @@ class MainForm(QtGui.QMainWindow):
                    'bonds.')
         if self._last_selected is self.node_type:
             current_item = self.node_type.currentItem()
-            current_model = self._node_models[current_item]
+            current_model = self._model(self._node_models, current_item)
             nic_name = self._next_nic_name()
             item = self._new_nic_item(nic_name)
             self._add_item(item, current_model, self._interface_models)
@@ -812,7 +1156,7 @@ class MainForm(QtGui.QMainWindow):
             current_item = get_current_item(self.interfaces)
             if current_item.data()['type'] != 'ovs_bridge':
                 self._error(err_msg)
-            current_model = self._interface_models[current_item]
+            current_model = self._model(self._interface_models, current_item)
             nic_name = self._next_nic_name()
             item = self._new_nic_item(nic_name, 'None')
             self._add_item(item, current_model, self._nested_models)
@@ -820,7 +1164,7 @@ class MainForm(QtGui.QMainWindow):
             current_item = get_current_item(self.nested_interfaces)
             if current_item.data()['type'] != 'ovs_bond':
                 self._error(err_msg)
-            current_model = self._nested_models[current_item]
+            current_model = self._model(self._nested_models, current_item)
             nic_name = self._next_nic_name()
             item = self._new_nic_item(nic_name, 'None')
             # Only default the first interface in a bond to primary
@@ -832,19 +1176,21 @@ class MainForm(QtGui.QMainWindow):
         else:
             self._error(err_msg)
 
-    def _add_item(self, item, model, submodels=None):
+    def _add_item(self, item, model, submodels=None, filename=None):
         if submodels is not None:
             submodels[item] = QtGui.QStandardItemModel(0, 1)
         model.appendRow(item)
+        filename = filename or self._current_filename()
+        self._usage.add(filename, item.data())
         self._update_enabled_networks()
+        self._role_edited(filename)
 
     def _add_bridge(self):
         if self._last_selected is self.node_type:
             current_item = self.node_type.currentItem()
-            current_model = self._node_models[current_item]
+            current_model = self._model(self._node_models, current_item)
             bridge_name = 'br-ex'
-            item = QtGui.QStandardItem(
-                QtGui.QIcon(os.path.join('icons', 'bridge.png')), bridge_name)
+            item = QtGui.QStandardItem(self._icons['ovs_bridge'], bridge_name)
             item.setData({'type': 'ovs_bridge',
                           'name': bridge_name,
                           'use_dhcp': False,
@@ -861,9 +1207,7 @@ class MainForm(QtGui.QMainWindow):
 
     def _add_vlan(self):
         def new_item():
-            item = QtGui.QStandardItem(
-                QtGui.QIcon(os.path.join('icons', 'network-workgroup.png')),
-                'VLAN')
+            item = QtGui.QStandardItem(self._icons['vlan'], 'VLAN')
             item.setData({'type': 'vlan',
                           'vlan_id': '',
                           'addresses': [],
@@ -876,7 +1220,7 @@ class MainForm(QtGui.QMainWindow):
 
         if self._last_selected is self.interfaces:
             current_item = get_current_item(self.interfaces)
-            current_model = self._interface_models[current_item]
+            current_model = self._model(self._interface_models, current_item)
             item = new_item()
             self._add_item(item, current_model, self._nested_models)
         else:
@@ -888,11 +1232,9 @@ class MainForm(QtGui.QMainWindow):
             current_item = get_current_item(self.interfaces)
             if current_item.data()['type'] != 'ovs_bridge':
                 self._error(err_msg)
-            current_model = self._interface_models[current_item]
+            current_model = self._model(self._interface_models, current_item)
             bond_name = 'bond1'
-            item = QtGui.QStandardItem(
-                QtGui.QIcon(os.path.join('icons', 'repository.png')),
-                bond_name)
+            item = QtGui.QStandardItem(self._icons['ovs_bond'], bond_name)
             # The ovs_bond type is a historical artifact from when these only
             # supported OVS bonds.  Since it turns out that linux_bonds are
             # very similar, the same object is used, but the type is left
@@ -915,9 +1257,7 @@ class MainForm(QtGui.QMainWindow):
 
     def _add_route(self):
         def new_item():
-            item = QtGui.QStandardItem(
-                QtGui.QIcon(os.path.join('icons', 'arrow-right.png')),
-                'Route')
+            item = QtGui.QStandardItem(self._icons['route'], 'Route')
             item.setData({'type': 'route',
                           'ip_netmask': '0.0.0.0/0',
                           'next_hop': '0.0.0.0',
@@ -928,12 +1268,12 @@ class MainForm(QtGui.QMainWindow):
 
         if self._last_selected is self.interfaces:
             current_item = get_current_item(self.interfaces)
-            current_model = self._interface_models[current_item]
+            current_model = self._model(self._interface_models, current_item)
             item = new_item()
             self._add_item(item, current_model, self._nested_models)
         elif self._last_selected is self.nested_interfaces:
             current_item = get_current_item(self.nested_interfaces)
-            current_model = self._nested_models[current_item]
+            current_model = self._model(self._nested_models, current_item)
             item = new_item()
             self._add_item(item, current_model)
         else:
@@ -950,7 +1290,15 @@ class MainForm(QtGui.QMainWindow):
             current_index = self.leaf_interfaces.currentIndex()
         else:
             self._error('Cannot delete.  Unexpected UI state.')
-        current_index.model().takeRow(current_index.row())
+        model = current_index.model()
+        filename = self._current_filename()
+        item = model.item(current_index.row())
+        for d in self._item_data(item):
+            self._usage.remove(filename, d)
+        self._forget_item(item)
+        model.takeRow(current_index.row())
+        self._update_enabled_networks()
+        self._role_edited(filename)
 
     def _update_input(self, item):
         """Update UI input elements to match selected item
@@ -1034,25 +1382,23 @@ class MainForm(QtGui.QMainWindow):
         else:
             self._error('Cannot change network type of nodes')
         d = current_item.data()
+        filename = self._current_filename()
+        self._usage.remove(filename, d)
         if 'network' in d:
             d['network'] = new_name
         current_item.setData(d)
+        self._usage.add(filename, d)
+        self._role_edited(filename)
         self._update_enabled_networks()
 
     def _update_enabled_networks(self):
-        data = self._ui_to_dict()
-        self.external_group.setEnabled(
-            net_processing._net_used_all(data, 'External')[0])
-        self.internal_group.setEnabled(
-            net_processing._net_used_all(data, 'InternalApi')[0])
-        self.storage_group.setEnabled(
-            net_processing._net_used_all(data, 'Storage')[0])
-        self.storage_mgmt_group.setEnabled(
-            net_processing._net_used_all(data, 'StorageMgmt')[0])
-        self.tenant_group.setEnabled(
-            net_processing._net_used_all(data, 'Tenant')[0])
-        self.management_group.setEnabled(
-            net_processing._net_used_all(data, 'Management')[0])
+        used = self._usage.used
+        self.external_group.setEnabled(used('External'))
+        self.internal_group.setEnabled(used('InternalApi'))
+        self.storage_group.setEnabled(used('Storage'))
+        self.storage_mgmt_group.setEnabled(used('StorageMgmt'))
+        self.tenant_group.setEnabled(used('Tenant'))
+        self.management_group.setEnabled(used('Management'))
 
     def _primary_changed(self, state):
         if self._last_selected is self.nested_interfaces:
@@ -1069,6 +1415,7 @@ class MainForm(QtGui.QMainWindow):
         d = current_item.data()
         d['primary'] = self.primary.isChecked()
         current_item.setData(d)
+        self._role_edited()
 
     def _name_changed(self, text):
         if self._last_selected is self.interfaces:
@@ -1081,8 +1428,12 @@ class MainForm(QtGui.QMainWindow):
             self._error('Cannot change name of node types')
         current_item.setText(text)
         d = current_item.data()
+        filename = self._current_filename()
+        self._usage.remove(filename, d)
         d['name'] = self.item_name.text()
         current_item.setData(d)
+        self._usage.add(filename, d)
+        self._role_edited(filename)
 
     def _mtu_changed(self, value):
         if self._last_selected is self.interfaces:
@@ -1096,6 +1447,7 @@ class MainForm(QtGui.QMainWindow):
         d = current_item.data()
         d['mtu'] = value
         current_item.setData(d)
+        self._role_edited()
 
     def _route_changed(self, _):
         if self._last_selected is self.nested_interfaces:
@@ -1109,6 +1461,7 @@ class MainForm(QtGui.QMainWindow):
         d['next_hop'] = self.route_next_hop.text()
         d['default'] = self.route_default.isChecked()
         current_item.setData(d)
+        self._role_edited()
 
     def _bond_changed(self, _):
         new_name = self.bond_type.currentText()
@@ -1117,6 +1470,7 @@ class MainForm(QtGui.QMainWindow):
         d = current_item.data()
         d['bond_type'] = new_name.lower().replace(' ', '_')
         current_item.setData(d)
+        self._role_edited()
 
     def _bridge_changed(self, _):
         new_name = self.bridge_type.currentText()
@@ -1125,6 +1479,7 @@ class MainForm(QtGui.QMainWindow):
         d = current_item.data()
         d['bridge_type'] = new_name.lower().replace(' ', '_')
         current_item.setData(d)
+        self._role_edited()
 
     def _interface_type_changed(self, _):
         new_name = self.interface_type.currentText()
@@ -1142,6 +1497,7 @@ class MainForm(QtGui.QMainWindow):
             # Ideally we'd make this default smarter, but this work for now
             d['port_name'] = d.get('port_name', 'dpdk0')
         current_item.setData(d)
+        self._role_edited()
         self._update_input(current_item)
 
     def _port_name_changed(self, text):
@@ -1154,6 +1510,7 @@ class MainForm(QtGui.QMainWindow):
         d = current_item.data()
         d['port_name'] = text
         current_item.setData(d)
+        self._role_edited()
 
 if __name__ == '__main__':
     app = QtGui.QApplication(sys.argv)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# Copyright 2017 Red Hat Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Rebuild net-iso-gen.py settings from existing templates
+
+Each input is a directory of templates generated by net-iso-gen.py, possibly
+by a version too old to have written its settings, or edited by hand since.
+The nic-configs and network-environment.yaml are read back into settings,
+which are written as ui-settings.json so the directory can be loaded in the
+UI or regenerated with net-iso-batch.py.  Directories are imported in
+parallel across a pool of worker processes.
+
+By default the settings are written into each input directory, and
+directories that already have settings are skipped unless --force is passed.
+If --output is passed, each directory's settings are instead written to a
+subdirectory of that path named after it.
+
+Every import is checked by regenerating the templates in memory.  Any that
+would come out differently, usually because they were edited by hand in a
+way the settings cannot express, are listed.
+"""
+
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+import netaddr
+
+import net_import
+import net_processing
+
+
+def _parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Rebuild net-iso-gen.py settings from existing '
+                    'templates.')
+    parser.add_argument('inputs', nargs='+', metavar='DIR',
+                        help='Directory containing network-environment.yaml '
+                             'and a nic-configs directory')
+    parser.add_argument('-o', '--output',
+                        help='Write the settings for each directory to a '
+                             'subdirectory of this path instead of to the '
+                             'directory itself')
+    parser.add_argument('-j', '--jobs', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='Number of worker processes (default: %(default)s)')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Overwrite any settings that already exist')
+    return parser.parse_args(args)
+
+
+def _import_one(task):
+    """Import a single directory
+
+    Runs in a worker process, so errors are returned rather than raised.
+
+    :returns: A tuple of the input and output paths, the time taken, the
+              templates that would not be regenerated identically and an
+              error message, which is None if the import succeeded.
+    """
+    input_path, output_path, force = task
+    start = time.time()
+    differ = []
+    try:
+        if not force and any(
+                os.path.exists(os.path.join(output_path, name))
+                for name in (net_processing.SETTINGS_FILE,
+                             net_processing.LEGACY_SETTINGS_FILE)):
+            raise RuntimeError('Settings already exist in "%s"' %
+                               output_path)
+        data, global_data = net_import._import_templates(input_path)
+        differ = [path for path, lines in
+                  net_processing._diff(data, global_data, input_path)]
+        net_processing._write_settings(data, global_data, output_path)
+        error = None
+    except (RuntimeError, EnvironmentError, ValueError, KeyError, TypeError,
+            AttributeError, netaddr.AddrFormatError) as e:
+        # Anything else malformed in one directory must not stop the rest
+        error = str(e)
+        if isinstance(e, KeyError):
+            error = 'Missing key %s' % error
+    return input_path, output_path, time.time() - start, differ, error
+
+
+def main(args=None):
+    args = _parse_args(sys.argv[1:] if args is None else args)
+
+    try:
+        outputs = net_processing._output_dirs(args.inputs, args.output)
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        return 1
+    tasks = [(i, o, args.force) for i, o in zip(args.inputs, outputs)]
+    if args.output is not None and not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    failed = 0
+    start = time.time()
+    pool = multiprocessing.Pool(max(1, min(args.jobs, len(tasks))))
+    try:
+        for (input_path, output_path, elapsed, differ,
+                error) in pool.imap_unordered(_import_one, tasks):
+            if error is not None:
+                failed += 1
+                print('%8.1f ms  %s FAILED: %s' % (elapsed * 1000, input_path,
+                                                   error))
+                continue
+            print('%8.1f ms  %s -> %s' % (elapsed * 1000, input_path,
+                                          output_path))
+            for path in differ:
+                print('            would not regenerate %s identically' %
+                      path)
+    finally:
+        pool.close()
+        pool.join()
+    total = time.time() - start
+
+    print(net_processing._throughput('Imported', len(tasks) - failed,
+                                     len(tasks), total, 'directories'))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,176 @@
+# Copyright 2017 Red Hat Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Undo and redo history of nic-config data
+
+The history holds the data of each role frozen into immutable tuples.  When a
+role is edited its new data is frozen against the old, so every node and value
+that did not change is the same object in both and only the path from the role
+down to each changed value is new.  A long editing session therefore costs
+memory in proportion to what was edited rather than to the size of the
+layout, and undoing is just a matter of thawing the roles a step changed.
+"""
+
+
+class _FrozenDict(tuple):
+    """An immutable dict, held as its (key, value) pairs sorted by key"""
+    __slots__ = ()
+
+    def __eq__(self, other):
+        # A frozen list of pairs must not compare equal to a frozen dict
+        return type(other) is _FrozenDict and tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = tuple.__hash__
+
+
+def _identical(a, b):
+    """Check a and b are equal and made of values of the same types
+
+    Unlike ==, this tells True from 1, so a frozen value is never replaced
+    by one that would thaw differently.
+    """
+    if a is b:
+        return True
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, tuple):
+        return (len(a) == len(b) and
+                all(_identical(x, y) for x, y in zip(a, b)))
+    return a == b
+
+
+def freeze(value, previous=None):
+    """Convert dicts and lists in value to immutable tuples
+
+    Any part of the result that is identical to the same part of previous,
+    or to another member of the same list in previous, is taken from previous
+    instead, so the two share everything that did not change.  previous
+    itself is returned if nothing changed.
+    """
+    if isinstance(value, dict):
+        old = dict(previous) if type(previous) is _FrozenDict else {}
+        frozen = _FrozenDict((key, freeze(value[key], old.get(key)))
+                             for key in sorted(value))
+    elif isinstance(value, (list, tuple)):
+        old = previous if type(previous) is tuple else ()
+        # Members that moved, because one before them was added or removed,
+        # are still shared
+        siblings = dict((member, member) for member in old)
+        members = []
+        for i, member in enumerate(value):
+            member = freeze(member, old[i] if i < len(old) else None)
+            if i >= len(old) or member is not old[i]:
+                sibling = siblings.get(member)
+                if sibling is not None and _identical(sibling, member):
+                    member = sibling
+            members.append(member)
+        frozen = tuple(members)
+    else:
+        frozen = value
+    if previous is not None and _identical(frozen, previous):
+        return previous
+    return frozen
+
+
+def thaw(frozen):
+    """Convert the result of freeze back to dicts and lists"""
+    if type(frozen) is _FrozenDict:
+        return dict((key, thaw(value)) for key, value in frozen)
+    if type(frozen) is tuple:
+        return [thaw(value) for value in frozen]
+    return frozen
+
+
+class History(object):
+    """Undo and redo history of the nic-config data of every role
+
+    Each step only holds the frozen roles it changed, as they were before and
+    after it, so recording one does not copy anything per role either.
+
+    :param data: The nic-config data the history starts from, in the form
+                 returned by _ui_to_dict.
+    """
+    def __init__(self, data=None):
+        self._current = dict((filename, freeze(node_data))
+                             for filename, node_data in (data or {}).items())
+        self._steps = []
+        self._position = 0
+
+    @property
+    def current(self):
+        """The current frozen data of every role, updated in place"""
+        return self._current
+
+    @property
+    def can_undo(self):
+        return self._position > 0
+
+    @property
+    def can_redo(self):
+        return self._position < len(self._steps)
+
+    def record(self, changes):
+        """Add a step for the roles in changes, if any of them changed
+
+        Anything that could have been redone is forgotten.
+
+        :param changes: dict of the new data of each role edited, keyed by
+                        filename.
+        :returns: Whether a step was added.
+        """
+        before = {}
+        after = {}
+        for filename, node_data in changes.items():
+            old = self._current.get(filename, ())
+            frozen = freeze(node_data, old)
+            if frozen is not old:
+                before[filename] = old
+                after[filename] = frozen
+        if not after:
+            return False
+        del self._steps[self._position:]
+        self._steps.append((before, after))
+        self._position += 1
+        self._current.update(after)
+        return True
+
+    def undo(self):
+        """Step back, returning the data of each role that changed
+
+        :returns: dict of the data of each role that differs from the step
+                  undone, keyed by filename, or None if there is nothing to
+                  undo.
+        """
+        if not self.can_undo:
+            return None
+        self._position -= 1
+        return self._apply(self._steps[self._position][0])
+
+    def redo(self):
+        """Step forward again, returning the data of each role that changed
+
+        :returns: As for undo, or None if there is nothing to redo.
+        """
+        if not self.can_redo:
+            return None
+        self._position += 1
+        return self._apply(self._steps[self._position - 1][1])
+
+    def _apply(self, roles):
+        self._current.update(roles)
+        return dict((filename, thaw(frozen))
+                    for filename, frozen in roles.items())
@@ -0,0 +1,471 @@
+# Copyright 2017 Red Hat Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Rebuild net-iso-gen.py settings from previously generated templates
+
+_import_templates reads the nic-configs, network-environment.yaml and, if
+they exist, network-isolation.yaml and ips-from-pool.yaml from a directory of
+templates, for either template version, and returns the nic and global data
+that would generate them.
+
+The templates do not record everything the UI does, such as the role labels
+or the settings of unused networks, so those get the UI's defaults.  Anything
+in the nic-configs that the UI has no field for is kept as it is, so it is
+written back out unchanged.
+"""
+
+import copy
+import os
+import re
+
+import yaml
+
+import net_processing
+
+# The settings the UI starts with, for anything the templates don't say
+DEFAULT_GLOBAL_YAML = """
+control:
+  mask: 24
+  route: 192.168.24.1
+  ec2: 192.168.24.1
+external:
+  cidr: 10.0.0.0/24
+  start: 10.0.0.10
+  end: 10.0.0.50
+  gateway: 10.0.0.1
+  vlan: 1
+  bridge: "''"
+internal_api:
+  cidr: 172.17.0.0/24
+  start: 172.17.0.10
+  end: 172.17.0.250
+  vlan: 2
+storage:
+  cidr: 172.18.0.0/24
+  start: 172.18.0.10
+  end: 172.18.0.250
+  vlan: 3
+storage_mgmt:
+  cidr: 172.19.0.0/24
+  start: 172.19.0.10
+  end: 172.19.0.250
+  vlan: 4
+tenant:
+  cidr: 172.16.0.0/24
+  start: 172.16.0.10
+  end: 172.16.0.250
+  vlan: 5
+management:
+  cidr: 172.20.0.0/24
+  start: 172.20.0.10
+  end: 172.20.0.250
+  vlan: 6
+"""
+DEFAULT_GLOBAL = yaml.safe_load(DEFAULT_GLOBAL_YAML)
+REGISTRY_RE = re.compile(r'^\s*OS::TripleO::(\w+)::Net::SoftwareConfig:'
+                         r'\s*nic-configs/(\S+)\s*$', re.M)
+IP_SUBNET_RE = re.compile(r'^  (\w+)IpSubnet:(?: # (.*))?$', re.M)
+GET_PARAM_RE = re.compile(r'^\{get_param: (\w+)\}$')
+PARAM_NAME_RE = re.compile(r'^  (\w+):', re.M)
+BOND_TYPES = {'ovs_bond': 'ovs',
+              'linux_bond': 'linux',
+              'team': 'team',
+              'ovs_dpdk_bond': 'ovs_dpdk',
+              }
+# The routes _process_network_config adds, as they appear in the output
+EC2_ROUTE = {'ip_netmask': '169.254.169.254/32',
+             'next_hop': '{get_param: EC2MetadataIp}'}
+CONTROL_DEFAULT_ROUTE = {'default': True,
+                         'next_hop': '{get_param: ControlPlaneDefaultRoute}'}
+EXTERNAL_DEFAULT_ROUTE = {
+    'ip_netmask': '0.0.0.0/0',
+    'next_hop': '{get_param: ExternalInterfaceDefaultRoute}'}
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def _load_yaml(text, path):
+    """yaml.safe_load, using libyaml if it is available
+
+    :param path: The file text was read from, to name in errors.
+    :raises: RuntimeError if text is not a YAML mapping.
+    """
+    try:
+        loaded = yaml.load(text, Loader=getattr(yaml, 'CSafeLoader',
+                                                yaml.SafeLoader)) or {}
+    except yaml.YAMLError as e:
+        raise RuntimeError('Invalid YAML in %s: %s' % (path, e))
+    if not isinstance(loaded, dict):
+        raise RuntimeError('%s is not a YAML mapping' % path)
+    return loaded
+
+
+def _from_yaml(value):
+    """Convert Heat get_param intrinsics back to the UI's string form"""
+    if isinstance(value, dict):
+        if len(value) == 1 and 'get_param' in value:
+            return '%s%s}' % (net_processing.GET_PARAM_PREFIX,
+                              value['get_param'])
+        return dict((k, _from_yaml(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [_from_yaml(v) for v in value]
+    return value
+
+
+def _param(value, suffix):
+    """Return the network name in '{get_param: <name><suffix>}', or None"""
+    if not hasattr(value, 'startswith'):
+        return None
+    match = GET_PARAM_RE.match(value)
+    if match and match.group(1).endswith(suffix):
+        return match.group(1)[:-len(suffix)]
+
+
+def _network_config(template, filename):
+    """Return the template version and network_config of a nic-config"""
+    try:
+        resource = template['resources']['OsNetConfigImpl']
+        config = resource['properties']['config']
+        if resource['type'] == 'OS::Heat::StructuredConfig':
+            return 1, config['os_net_config']['network_config']
+        return 2, config['str_replace']['params']['$network_config'][
+            'network_config']
+    except (KeyError, TypeError):
+        raise RuntimeError('No network_config found in %s' % filename)
+
+
+def _network(d, filename):
+    """Work out which network a top-level node's addresses are on"""
+    addresses = d.pop('addresses', None)
+    if not addresses:
+        return 'None'
+    ip_netmask = addresses[0].get('ip_netmask')
+    if isinstance(ip_netmask, dict) and 'list_join' in ip_netmask:
+        return 'ControlPlane'
+    network = _param(ip_netmask, 'IpSubnet')
+    if network is None:
+        raise RuntimeError('Cannot tell which network "%s" in %s is on' %
+                           (d.get('name'), filename))
+    return network
+
+
+def _pop_route(routes, route):
+    """Remove route from the end of routes, if it is there"""
+    if routes and routes[-1] == route:
+        routes.pop()
+        return True
+    return False
+
+
+def _route_nodes(routes):
+    return [dict(r, type='route', name='Route', members=[]) for r in routes]
+
+
+def _import_top_level(d, filename, auto_routes):
+    """Convert a top-level interface or bridge back to its UI form
+
+    :param auto_routes: A list that True or False is appended to wherever
+                        the presence of an automatic route shows whether
+                        auto_routes was set.
+    """
+    nd = dict(d)
+    network = _network(nd, filename)
+    routes = list(nd.pop('routes', []))
+    if network == 'ControlPlane':
+        if filename != 'controller.yaml':
+            auto_routes.append(_pop_route(routes, CONTROL_DEFAULT_ROUTE))
+        _pop_route(routes, EC2_ROUTE)
+    elif network == 'External':
+        auto_routes.append(_pop_route(routes, EXTERNAL_DEFAULT_ROUTE))
+    members = _route_nodes(routes)
+    if nd['type'].endswith('_bridge'):
+        nd['bridge_type'] = nd['type'][:-len('_bridge')]
+        nd['type'] = 'ovs_bridge'
+        members = ([_import_member(m, filename) for m in nd['members']] +
+                   members)
+    elif nd['type'] == 'interface':
+        nd.setdefault('primary', False)
+    else:
+        raise RuntimeError('%s "%s" in %s cannot be used at the top level' %
+                           (nd['type'], nd.get('name'), filename))
+    nd.update(network=network, addresses=[], routes=[], members=members)
+    nd.setdefault('mtu', -1)
+    nd.setdefault('use_dhcp', False)
+    return nd
+
+
+def _import_interface(d):
+    """Convert an interface or DPDK port in a bridge or bond"""
+    nd = dict(d)
+    if nd['type'] == 'ovs_dpdk_port':
+        nd['type'] = 'interface'
+        nd['interface_type'] = 'ovs_dpdk_port'
+        nd['port_name'] = nd['name']
+        nd['name'] = nd.pop('members')[0]['name']
+    nd.setdefault('primary', False)
+    nd.setdefault('mtu', -1)
+    nd.update(network='None', addresses=[], routes=[], use_dhcp=False)
+    return nd
+
+
+def _import_member(d, filename):
+    """Convert a member of a bridge back to its UI form"""
+    nd = dict(d)
+    routes = list(nd.pop('routes', []))
+    if nd['type'] == 'vlan':
+        network = _param(nd['vlan_id'], 'NetworkVlanID')
+        if network is None:
+            raise RuntimeError('Cannot tell which network VLAN "%s" in %s '
+                               'is on' % (nd['vlan_id'], filename))
+        if network == 'External':
+            _pop_route(routes, EXTERNAL_DEFAULT_ROUTE)
+        nd.pop('device', None)
+        nd.pop('addresses', None)
+        nd.update(name='VLAN', network=network, vlan_id='',
+                  addresses=[], routes=[], members=_route_nodes(routes))
+    elif nd['type'] in BOND_TYPES:
+        nd['bond_type'] = BOND_TYPES[nd['type']]
+        nd['type'] = 'ovs_bond'
+        nd['ovs_options'] = nd.pop('bonding_options',
+                                   nd.get('ovs_options', ''))
+        nd.update(network='None', routes=[],
+                  members=[_import_interface(m) for m in nd['members']] +
+                  _route_nodes(routes))
+    elif nd['type'] in ('interface', 'ovs_dpdk_port'):
+        return _import_interface(nd)
+    else:
+        raise RuntimeError('Unknown bridge member type "%s" in %s' %
+                           (nd['type'], filename))
+    nd.setdefault('mtu', -1)
+    return nd
+
+
+def _import_nic_config(template, filename, auto_routes):
+    """Return the template version and UI data of one nic-config"""
+    version, network_config = _network_config(_from_yaml(template), filename)
+    return version, [_import_top_level(d, filename, auto_routes)
+                     for d in network_config]
+
+
+def _import_networks(text, params):
+    """Return the networks added to the NETWORKS, from a nic-config
+
+    :param text: The nic-config.
+    :param params: The parameters of every nic-config.
+    """
+    networks = []
+    for name, comment in IP_SUBNET_RE.findall(text):
+        if name in net_processing.CAMEL_TO_LOWER:
+            continue
+        net = {'name': name}
+        defaults = net_processing._network(net)
+        match = re.search(r'on the (.+) network',
+                          params[name + 'IpSubnet'].get('description', ''))
+        vlan_param = params.get(name + 'NetworkVlanID', {})
+        label = re.search(r'for the (.+) network',
+                          vlan_param.get('description', ''))
+        values = {'lower': match and match.group(1),
+                  'vlan': vlan_param.get('default'),
+                  'vlan_label': label and label.group(1),
+                  'comment': comment or None}
+        for key, value in sorted(values.items()):
+            if value is not None and value != defaults[key]:
+                net[key] = value
+        networks.append(net)
+    return networks
+
+
+def _roles(registry):
+    """Build the role list from the resource_registry entries
+
+    :param registry: A list of (role name, nic-config filename) in order.
+    :returns: The role list, and a dict mapping the filename of each role
+              that shares another's nic-config to the shared filename.
+    """
+    standard = dict((r['name'], r) for r in net_processing.ROLES)
+    roles = []
+    shared = {}
+    owned = set()
+    filenames = set()
+    for name, target in registry:
+        if name in standard:
+            role = dict(standard[name])
+        else:
+            role = {'name': name,
+                    'filename': re.sub(r'(?<!^)([A-Z])', r'-\1',
+                                       name).lower() + '.yaml'}
+        if target not in owned:
+            owned.add(target)
+            role['filename'] = target
+        else:
+            shared[role['filename']] = target
+        if role['filename'] in filenames:
+            raise RuntimeError('More than one role would use %s' %
+                               role['filename'])
+        filenames.add(role['filename'])
+        roles.append(role)
+    return roles, shared
+
+
+def _free_vlan(vlan, taken):
+    while vlan in taken:
+        vlan += 1
+    return vlan
+
+
+def _network_settings(global_data, params, index):
+    """Fill in the settings of each network from parameter_defaults"""
+    taken = set(params[k] for k in params if k.endswith('NetworkVlanID'))
+    for net in net_processing._networks(global_data)[1:]:
+        camel, lower = net['name'], net['lower']
+        settings = copy.deepcopy(DEFAULT_GLOBAL.get(lower, {}))
+        used = net_processing._net_used_all(None, camel, index)[0]
+        if not settings and not used:
+            continue
+        if camel + 'NetCidr' in params:
+            settings['cidr'] = params[camel + 'NetCidr']
+            pools = params.get(camel + 'AllocationPools') or [{}]
+            settings.update(pools[0])
+        if camel + 'NetworkVlanID' in params:
+            settings['vlan'] = params[camel + 'NetworkVlanID']
+        elif used:
+            # The VLAN isn't in the templates, but used networks still
+            # can't share one
+            settings['vlan'] = _free_vlan(settings.get('vlan', 1), taken)
+            taken.add(settings['vlan'])
+        if camel == 'External':
+            for key, param in [('gateway', 'ExternalInterfaceDefaultRoute'),
+                               ('bridge', 'NeutronExternalNetworkBridge')]:
+                if param in params:
+                    settings[key] = params[param]
+        global_data[lower] = settings
+
+
+def _import_templates(base_path):
+    """Return the nic and global data that generate the templates in base_path
+
+    :raises: RuntimeError if the templates cannot be imported.
+    """
+    net_env_path = os.path.join(base_path, 'network-environment.yaml')
+    try:
+        net_env_text = _read(net_env_path)
+    except EnvironmentError:
+        raise RuntimeError('No network-environment.yaml found in "%s"' %
+                           base_path)
+    try:
+        net_iso_text = _read(os.path.join(base_path,
+                                          'network-isolation.yaml'))
+    except EnvironmentError:
+        net_iso_text = ''
+    params = _load_yaml(net_env_text,
+                        net_env_path).get('parameter_defaults') or {}
+    registry = REGISTRY_RE.findall(net_env_text)
+    if not registry:
+        raise RuntimeError('No nic-configs found in the resource_registry '
+                           'of "%s"' % base_path)
+    roles, shared = _roles(registry)
+
+    data = {}
+    versions = set()
+    auto_routes = []
+    texts = []
+    for role in roles:
+        filename = role['filename']
+        if filename in shared:
+            continue
+        path = os.path.join(base_path, 'nic-configs', filename)
+        try:
+            text = _read(path)
+        except EnvironmentError:
+            raise RuntimeError('%s is in the resource_registry but not in '
+                               '"%s"' % (filename, base_path))
+        template = _load_yaml(text, path)
+        try:
+            version, data[filename] = _import_nic_config(template, filename,
+                                                         auto_routes)
+        except (KeyError, TypeError, AttributeError, IndexError) as e:
+            # A hand-edited node missing a key or of the wrong type
+            raise RuntimeError('Cannot import %s: %s%s' % (
+                path, 'missing ' if isinstance(e, KeyError) else '', e))
+        versions.add(version)
+        texts.append((text, template))
+    for filename, target in shared.items():
+        data[filename] = copy.deepcopy(data[target])
+    if len(versions) > 1:
+        raise RuntimeError('The nic-configs in "%s" mix template versions' %
+                           base_path)
+
+    # Trimmed nic-configs only have the vlan of the networks they use, so
+    # gather the parameters of all of them.
+    parameters = {}
+    for text, template in reversed(texts):
+        parameters.update(template.get('parameters') or {})
+    networks = _import_networks(texts[0][0], parameters)
+
+    dns = list(params.get('DnsServers') or []) + ['', '']
+    global_data = {'major': net_processing.DATA_MAJOR,
+                   'minor': net_processing.DATA_MINOR,
+                   'version': versions.pop(),
+                   'auto_routes': all(auto_routes),
+                   'ipv6': '_v6.yaml' in net_iso_text,
+                   'dedup_nic_configs': bool(shared),
+                   'dns1': dns[0],
+                   'dns2': dns[1],
+                   'bond_options': params.get('BondInterfaceOvsOptions', ''),
+                   'control': dict(DEFAULT_GLOBAL['control']),
+                   }
+    for key, param in [('mask', 'ControlPlaneSubnetCidr'),
+                       ('route', 'ControlPlaneDefaultRoute'),
+                       ('ec2', 'EC2MetadataIp')]:
+        if param in params:
+            global_data['control'][key] = params[param]
+    global_data['control']['mask'] = int(global_data['control']['mask'])
+    # Without a role list the registry has the default roles first, in
+    # REGISTRY_ORDER, so the list is only needed if it is in another order
+    default = net_processing._registry_roles(
+        dict((role['filename'], None) for role in roles))
+    if ([(r['name'], r['filename']) for r in roles] !=
+            [(r['name'], r['filename']) for r in default]):
+        global_data['roles'] = roles
+    if networks:
+        global_data['networks'] = networks
+    _network_settings(global_data, params,
+                      net_processing._build_net_index(data))
+    full = set(PARAM_NAME_RE.findall(net_processing._params(global_data)))
+    if any(full - set(template.get('parameters') or {})
+           for text, template in texts):
+        global_data['trim_nic_params'] = True
+    node_counts = _node_counts(base_path, data, global_data)
+    if node_counts:
+        global_data['node_counts'] = node_counts
+    return data, global_data
+
+
+def _node_counts(base_path, data, global_data):
+    """Count the nodes of each role planned in ips-from-pool.yaml"""
+    path = os.path.join(base_path, net_processing.IPS_FROM_POOL)
+    try:
+        text = _read(path)
+    except EnvironmentError:
+        return {}
+    params = _load_yaml(text, path).get('parameter_defaults') or {}
+    counts = {}
+    for role in net_processing._roles(data, global_data):
+        ips = params.get(role['ips'])
+        if ips:
+            counts[role['name']] = max(len(v) for v in ips.values())
+    return counts
@@ -13,172 +13,124 @@
 # under the License.
 
 import collections
+import contextlib
 import copy
-import itertools
+import cProfile
+import difflib
+import hashlib
+import io
+import json
+import multiprocessing
 import os
 import pickle
+import stat
+import time
 import yaml
 
 import netaddr
 
+# Version of the UI data model.  The major version changes for
+# incompatible changes, the minor version when something is added.
+DATA_MAJOR = 1
+DATA_MINOR = 6
+SETTINGS_FILE = 'ui-settings.json'
+# Settings were stored as a pickle before SETTINGS_FILE existed.  These are
+# still read, but never written.
+LEGACY_SETTINGS_FILE = 'ui-settings.pickle'
 TEMPLATE_VERSION = {1: '2015-04-30',
                     2: 'ocata',
                     }
-PARAMS = """heat_template_version: %s
+# The networks known to the tool, in the order their parameters are written.
+# ControlPlane and External have some unique parameters that require special
+# handling, the others are uniform.  global_data['networks'] can add more of
+# the uniform kind, see _network for the defaults of the optional keys.
+NETWORKS_YAML = """
+- name: ControlPlane
+  lower: control
+- name: External
+  lower: external
+  vlan: 10
+- name: InternalApi
+  lower: internal_api
+  vlan: 20
+- name: Storage
+  lower: storage
+  vlan: 30
+- name: StorageMgmt
+  lower: storage_mgmt
+  vlan: 40
+  vlan_label: storage mgmt
+- name: Tenant
+  lower: tenant
+  vlan: 50
+- name: Management
+  lower: management
+  vlan: 60
+  comment: Only populated when including environments/network-management.yaml
+"""
+PARAMS_HEADER = """heat_template_version: %s
 
 parameters:
   ControlPlaneIp:
     default: ''
     description: IP address/subnet on the ctlplane network
     type: string
-  ExternalIpSubnet:
-    default: ''
-    description: IP address/subnet on the external network
-    type: string
-  ExternalInterfaceRoutes:
-    default: []
-    description: >
-      Routes for the external network traffic.
-      JSON route e.g. [{'destination':'10.0.0.0/16', 'nexthop':'10.0.0.1'}]
-      Unless the default is changed, the parameter is automatically resolved
-      from the subnet host_routes attribute.
-    type: json
-  ExternalMtu:
-    default: 1500
-    description: The maximum transmission unit (MTU) size(in bytes) that is
-      guaranteed to pass through the data path of the segments in the
-      external network.
-    type: number
-  InternalApiIpSubnet:
-    default: ''
-    description: IP address/subnet on the internal_api network
-    type: string
-  InternalApiInterfaceRoutes:
-    default: []
-    description: >
-      Routes for the internal_api network traffic.
-      JSON route e.g. [{'destination':'10.0.0.0/16', 'nexthop':'10.0.0.1'}]
-      Unless the default is changed, the parameter is automatically resolved
-      from the subnet host_routes attribute.
-    type: json
-  InternalApiMtu:
-    default: 1500
-    description: The maximum transmission unit (MTU) size(in bytes) that is
-      guaranteed to pass through the data path of the segments in the
-      internal_api network.
-    type: number
-  StorageIpSubnet:
-    default: ''
-    description: IP address/subnet on the storage network
-    type: string
-  StorageInterfaceRoutes:
-    default: []
-    description: >
-      Routes for the storage network traffic.
-      JSON route e.g. [{'destination':'10.0.0.0/16', 'nexthop':'10.0.0.1'}]
-      Unless the default is changed, the parameter is automatically resolved
-      from the subnet host_routes attribute.
-    type: json
-  StorageMtu:
-    default: 1500
-    description: The maximum transmission unit (MTU) size(in bytes) that is
-      guaranteed to pass through the data path of the segments in the
-      storage network.
-    type: number
-  StorageMgmtIpSubnet:
-    default: ''
-    description: IP address/subnet on the storage_mgmt network
-    type: string
-  StorageMgmtInterfaceRoutes:
-    default: []
-    description: >
-      Routes for the storage_mgmt network traffic.
-      JSON route e.g. [{'destination':'10.0.0.0/16', 'nexthop':'10.0.0.1'}]
-      Unless the default is changed, the parameter is automatically resolved
-      from the subnet host_routes attribute.
-    type: json
-  StorageMgmtMtu:
-    default: 1500
-    description: The maximum transmission unit (MTU) size(in bytes) that is
-      guaranteed to pass through the data path of the segments in the
-      storage_mgmt network.
-    type: number
-  TenantIpSubnet:
-    default: ''
-    description: IP address/subnet on the tenant network
-    type: string
-  TenantInterfaceRoutes:
-    default: []
-    description: >
-      Routes for the tenant network traffic.
-      JSON route e.g. [{'destination':'10.0.0.0/16', 'nexthop':'10.0.0.1'}]
-      Unless the default is changed, the parameter is automatically resolved
-      from the subnet host_routes attribute.
-    type: json
-  TenantMtu:
-    default: 1500
-    description: The maximum transmission unit (MTU) size(in bytes) that is
-      guaranteed to pass through the data path of the segments in the
-      tenant network.
-    type: number
-  ManagementIpSubnet: # Only populated when including environments/network-management.yaml
+"""
+PARAMS_SUBNET = """\
+  %(name)sIpSubnet:%(comment)s
     default: ''
-    description: IP address/subnet on the management network
+    description: IP address/subnet on the %(lower)s network
     type: string
-  ManagementInterfaceRoutes:
+"""
+PARAMS_NETWORK = """\
+  %(name)sInterfaceRoutes:
     default: []
     description: >
-      Routes for the management network traffic.
+      Routes for the %(lower)s network traffic.
       JSON route e.g. [{'destination':'10.0.0.0/16', 'nexthop':'10.0.0.1'}]
       Unless the default is changed, the parameter is automatically resolved
       from the subnet host_routes attribute.
     type: json
-  ManagementMtu:
+  %(name)sMtu:
     default: 1500
     description: The maximum transmission unit (MTU) size(in bytes) that is
       guaranteed to pass through the data path of the segments in the
-      management network.
+      %(lower)s network.
     type: number
+"""
+PARAMS_BOND = """\
   BondInterfaceOvsOptions:
     default: 'bond_mode=active-backup'
     description: The ovs_options string for the bond interface. Set things like
                  lacp=active and/or bond_mode=balance-slb using this option.
     type: string
-  ExternalNetworkVlanID:
-    default: 10
-    description: Vlan ID for the external network traffic.
-    type: number
-  InternalApiNetworkVlanID:
-    default: 20
-    description: Vlan ID for the internal_api network traffic.
-    type: number
-  StorageNetworkVlanID:
-    default: 30
-    description: Vlan ID for the storage network traffic.
-    type: number
-  StorageMgmtNetworkVlanID:
-    default: 40
-    description: Vlan ID for the storage mgmt network traffic.
-    type: number
-  TenantNetworkVlanID:
-    default: 50
-    description: Vlan ID for the tenant network traffic.
-    type: number
-  ManagementNetworkVlanID:
-    default: 60
-    description: Vlan ID for the management network traffic.
+"""
+PARAMS_VLAN = """\
+  %(name)sNetworkVlanID:
+    default: %(vlan)d
+    description: Vlan ID for the %(vlan_label)s network traffic.
     type: number
+"""
+# The parameters after the VLANs, as (name, text) pairs
+PARAMS_FOOTER = [
+    ('ExternalInterfaceDefaultRoute', """\
   ExternalInterfaceDefaultRoute:
     default: '10.0.0.1'
     description: default route for the external network
     type: string
+"""),
+    ('ControlPlaneSubnetCidr', """\
   ControlPlaneSubnetCidr: # Override this via parameter_defaults
     default: '24'
     description: The subnet CIDR of the control plane network.
     type: string
+"""),
+    ('ControlPlaneDefaultRoute', """\
   ControlPlaneDefaultRoute: # Override this via parameter_defaults
     description: The default route of the control plane network.
     type: string
+"""),
+    ('ControlPlaneStaticRoutes', """\
   ControlPlaneStaticRoutes:
     default: []
     description: >
@@ -187,21 +139,27 @@ parameters:
       Unless the default is changed, the parameter is automatically resolved
       from the subnet host_routes attribute.
     type: json
+"""),
+    ('ControlPlaneMtu', """\
   ControlPlaneMtu:
     default: 1500
     description: The maximum transmission unit (MTU) size(in bytes) that is
       guaranteed to pass through the data path of the segments in the network.
       (The parameter is automatically resolved from the ctlplane network's mtu attribute.)
     type: number
+"""),
+    ('DnsServers', """\
   DnsServers: # Override this via parameter_defaults
     default: []
     description: A list of DNS servers (2 max for some implementations) that will be added to resolv.conf.
     type: comma_delimited_list
+"""),
+    ('EC2MetadataIp', """\
   EC2MetadataIp: # Override this via parameter_defaults
     description: The IP address of the EC2 metadata server.
     type: string
-
-"""
+"""),
+    ]
 BASE_RESOURCE_YAML = """
 resources:
   OsNetConfigImpl:
@@ -234,22 +192,15 @@ outputs:
     description: The OsNetConfigImpl resource.
     value: {get_resource: OsNetConfigImpl}
 """
-NETENV_HEADER = """
-resource_registry:
-  OS::TripleO::BlockStorage::Net::SoftwareConfig: nic-configs/cinder-storage.yaml
-  OS::TripleO::Compute::Net::SoftwareConfig: nic-configs/compute.yaml
-  OS::TripleO::Controller::Net::SoftwareConfig: nic-configs/controller.yaml
-  OS::TripleO::ObjectStorage::Net::SoftwareConfig: nic-configs/swift-storage.yaml
-  OS::TripleO::CephStorage::Net::SoftwareConfig: nic-configs/ceph-storage.yaml
-
-parameter_defaults:
+NETENV_REGISTRY_ENTRY = """\
+  OS::TripleO::%s::Net::SoftwareConfig: nic-configs/%s
 """
 README = """Generated Network Isolation Templates
 -------------------------------------
 These templates were generated by the UI tool at
 https://github.com/cybertron/tripleo-scripts#net-iso-genpy
 
-ui-settings.pickle is specific to the tool.  TripleO will not use it when
+ui-settings.json is specific to the tool.  TripleO will not use it when
 doing deployments with these templates, but it is needed to be able to
 load the templates into the UI again.  Note that the UI only reads this file,
 so any changes made by hand to the templates will not be reflected in the UI.
@@ -276,190 +227,792 @@ V6_NET_ISO_PARAMS="""parameter_defaults:
   RabbitIPv6: True
   MemcachedIPv6: True
 """
-TYPE_LIST = [(0, 'controller.yaml', 'Controller'),
-             (1, 'compute.yaml', 'Compute'),
-             (2, 'ceph-storage.yaml', 'CephStorage'),
-             (3, 'cinder-storage.yaml', 'BlockStorage'),
-             (4, 'swift-storage.yaml', 'SwiftStorage')]
-ALL_NETS = [('ControlPlane', 'control'),
-            ('External', 'external'),
-            ('InternalApi', 'internal_api'),
-            ('Storage', 'storage'),
-            ('StorageMgmt', 'storage_mgmt'),
-            ('Tenant', 'tenant'),
-            ('Management', 'management')
-            ]
-# SIMILAR_NETS are the networks with uniform parameters.  ControlPlane and
-# External both have some unique ones that require special handling.
-SIMILAR_NETS = ALL_NETS[2:]
-# Used by _order_dict
+# The default roles, in the order they are shown in the UI and generated.
+# 'name' is the role name used in the resource_registry, 'ports' the prefix of
+# its port resources, 'ips' the parameter its predictable IPs are passed in
+# and 'label' what the UI calls it.  Only 'filename' is required, see _role.
+# global_data['roles'] replaces this list if set.
+ROLES = [{'filename': 'controller.yaml', 'name': 'Controller',
+          'ports': 'Controller', 'ips': 'ControllerIPs',
+          'label': 'Controller'},
+         {'filename': 'compute.yaml', 'name': 'Compute',
+          'ports': 'Compute', 'ips': 'NovaComputeIPs', 'label': 'Compute'},
+         {'filename': 'ceph-storage.yaml', 'name': 'CephStorage',
+          'ports': 'CephStorage', 'ips': 'CephStorageIPs', 'label': 'Ceph'},
+         {'filename': 'cinder-storage.yaml', 'name': 'BlockStorage',
+          'ports': 'BlockStorage', 'ips': 'BlockStorageIPs',
+          'label': 'Block Storage'},
+         {'filename': 'swift-storage.yaml', 'name': 'ObjectStorage',
+          'ports': 'SwiftStorage', 'ips': 'SwiftStorageIPs',
+          'label': 'Swift'},
+         ]
+# The resource_registry entries of the default roles have always been
+# written in this order rather than that of ROLES.  It is kept so that
+# regenerating does not change existing network-environment.yaml files.
+REGISTRY_ORDER = ['cinder-storage.yaml', 'compute.yaml', 'controller.yaml',
+                  'swift-storage.yaml', 'ceph-storage.yaml']
+NETWORKS = yaml.safe_load(NETWORKS_YAML)
+CAMEL_TO_LOWER = dict((n['name'], n['lower']) for n in NETWORKS)
+# The networks with uniform parameters
+SIMILAR_NETWORKS = NETWORKS[2:]
+# The types of node each type of node can contain, and those that can be at
+# the top level of a role.  Checked by _structure_errors.
+MEMBER_TYPES = {'interface': ('route',),
+                'ovs_bridge': ('interface', 'ovs_bond', 'vlan', 'route'),
+                'ovs_bond': ('interface', 'route'),
+                'vlan': ('route',),
+                'route': (),
+                }
+ROLE_TYPES = ('interface', 'ovs_bridge')
+# The settings network-environment.yaml needs for each network that is used,
+# other than the VLAN.  Networks not listed need a cidr, start and end.
+NETWORK_SETTINGS = {'ControlPlane': ['mask', 'route', 'ec2'],
+                    'External': ['cidr', 'start', 'end', 'gateway', 'bridge'],
+                    }
+# Used by _ordered_keys
 FIRST_KEYS=['type', 'name']
 # members should always be last so keys are not split over a large members list
 LAST_KEYS=['addresses', 'routes', 'members']
+GET_PARAM_PREFIX = '{get_param: '
+# The parameters of each network, used by _params to tell which networks a
+# trimmed nic config references
+NETWORK_PARAM_SUFFIXES = ('IpSubnet', 'InterfaceRoutes', 'Mtu',
+                          'NetworkVlanID')
+# Parsed netaddr objects, see _netaddr
+_NETADDR_CACHE = {}
+NETADDR_CACHE_SIZE = 4096
+# The text of each scalar written by _write_resources, see _scalar_text
+_SCALAR_CACHE = {}
+SCALAR_CACHE_SIZE = 4096
+# The line width PyYAML's emitter wraps at by default
+YAML_WIDTH = 80
+# The order in which _Stats reports the stages of _generate
+STAGES = ['validate', 'hash', 'process', 'serialize', 'write', 'diff']
+# Written to the output directory by _generate so unchanged files can be
+# skipped on the next run.  Bump MANIFEST_VERSION whenever the generated
+# output, or what the manifest records, changes for the same input, so old
+# manifests are ignored.
+MANIFEST = 'generation-manifest.json'
+# Written by _generate when global_data['node_counts'] is set
+IPS_FROM_POOL = 'ips-from-pool.yaml'
+IPS_FROM_POOL_ABSOLUTE = 'ips-from-pool-absolute.yaml'
+MANIFEST_VERSION = 6
+ABSOLUTE_TEMPLATE_PATH = '/usr/share/openstack-tripleo-heat-templates'
+# Global keys that only affect the nic-configs and network-isolation files
+NON_NETENV_KEYS = ['major', 'minor', 'version', 'auto_routes', 'ipv6',
+                   'node_counts', 'trim_nic_params']
+# Buffer size used for output files, so each file is written in a few large
+# writes rather than one per emitted token.
+OUTPUT_BUFFER_SIZE = 1 << 16
+
+_REPRESENTER = yaml.representer.SafeRepresenter()
+_RESOLVER = yaml.resolver.Resolver()
+
+
+def _ordered_keys(data):
+    """Return the keys of a nic-config dict in a more human-readable order
+
+    The keys will be ordered as follows:
+    FIRST_KEYS
+    all keys not in FIRST_KEYS or LAST_KEYS in alphabetical order
+    LAST_KEYS
 
-# Borrowed from
-# http://stackoverflow.com/questions/9951852/pyyaml-dumping-things-backwards
-def ordered_representer(dumper, data):
-    return dumper.represent_mapping(u'tag:yaml.org,2002:map', data.items(),
-                                    flow_style=False)
-yaml.SafeDumper.add_representer(collections.OrderedDict, ordered_representer)
+    :param data: The dict whose keys should be ordered.
+    """
+    filter_keys = FIRST_KEYS + LAST_KEYS
+    return ([k for k in FIRST_KEYS if k in data] +
+            sorted(k for k in data if k not in filter_keys) +
+            [k for k in LAST_KEYS if k in data])
+
+
+def _emit_scalar(emitter, value):
+    """Emit a scalar exactly the way yaml.safe_dump would"""
+    node = _REPRESENTER.represent_data(value)
+    implicit = (node.tag == _RESOLVER.resolve(yaml.ScalarNode, node.value,
+                                              (True, False)),
+                node.tag == _RESOLVER.resolve(yaml.ScalarNode, node.value,
+                                              (False, True)))
+    emitter.emit(yaml.ScalarEvent(None, node.tag, implicit, node.value,
+                                  style=node.style))
+
+
+def _emit_value(emitter, value, ordered=False):
+    """Emit a value from a nic-config tree
+
+    Dicts are emitted in block style.  If ordered is True the keys are ordered
+    by _ordered_keys, and the same is done for any members, otherwise they
+    are sorted.  The UI stores Heat intrinsics as strings of the form
+    "{get_param: Name}", so those are emitted as flow mappings rather than
+    quoted strings.
+    """
+    if isinstance(value, dict):
+        keys = _ordered_keys(value) if ordered else sorted(value)
+        emitter.emit(yaml.MappingStartEvent(None, None, True,
+                                            flow_style=False))
+        for key in keys:
+            _emit_scalar(emitter, key)
+            _emit_value(emitter, value[key], ordered and key == 'members')
+        emitter.emit(yaml.MappingEndEvent())
+    elif isinstance(value, list):
+        emitter.emit(yaml.SequenceStartEvent(None, None, True,
+                                             flow_style=False))
+        for item in value:
+            _emit_value(emitter, item, ordered)
+        emitter.emit(yaml.SequenceEndEvent())
+    elif (hasattr(value, 'startswith') and
+          value.startswith(GET_PARAM_PREFIX) and value.endswith('}')):
+        emitter.emit(yaml.MappingStartEvent(None, None, True,
+                                            flow_style=True))
+        _emit_scalar(emitter, 'get_param')
+        _emit_scalar(emitter, value[len(GET_PARAM_PREFIX):-1])
+        emitter.emit(yaml.MappingEndEvent())
+    else:
+        _emit_scalar(emitter, value)
 
 
-def _order_dict(data):
-    """Order dict in a more human-readable way
+def _emit_resources(f, base, network_config):
+    """Stream a nic-config resources section to f
 
-    The results will ordered as follows:
-    FIRST_KEYS
-    all keys not in FIRST_KEYS or LAST_KEYS in alphabetical order
-    LAST_KEYS
+    :param f: File to write to.
+    :param base: One of the BASE_RESOURCE structures.  Its empty
+                 network_config key is filled in with network_config.
+    :param network_config: The processed list of top-level nic-config items.
+    """
+    emitter = yaml.emitter.Emitter(f)
+
+    def emit_base(value):
+        emitter.emit(yaml.MappingStartEvent(None, None, True,
+                                            flow_style=False))
+        for key in sorted(value):
+            _emit_scalar(emitter, key)
+            if key == 'network_config':
+                _emit_value(emitter, network_config, True)
+            elif isinstance(value[key], dict):
+                emit_base(value[key])
+            else:
+                _emit_value(emitter, value[key])
+        emitter.emit(yaml.MappingEndEvent())
+
+    emitter.emit(yaml.StreamStartEvent())
+    emitter.emit(yaml.DocumentStartEvent(explicit=False))
+    emit_base(base)
+    emitter.emit(yaml.DocumentEndEvent(explicit=False))
+    emitter.emit(yaml.StreamEndEvent())
+
+
+class _SlowPath(Exception):
+    """Raised for a value _write_value cannot write the way PyYAML would"""
+
+
+def _scalar_text(value, column, key=False):
+    """Return a scalar as PyYAML would write it in a block collection
+
+    The text of each distinct scalar comes from yaml.safe_dump and is cached,
+    so representing and resolving it only happens once.  Text that PyYAML
+    could wrap, or write differently depending on where it is, raises
+    _SlowPath: anything double-quoted or on more than one line, and spaces
+    where the line would pass YAML_WIDTH.
+
+    :param column: The column the scalar would start at.
+    :param key: Whether the scalar is a mapping key rather than a value.
+    """
+    cache_key = (type(value), value, key)
+    text = _SCALAR_CACHE.get(cache_key)
+    if text is None:
+        if key:
+            text = yaml.safe_dump({value: None})
+            suffix = ': null\n'
+        else:
+            text = yaml.safe_dump([value])
+            text, suffix = text[2:], '\n'
+        if (not text.endswith(suffix) or '\n' in text[:-len(suffix)] or
+                text.startswith(('"', '?'))):
+            raise _SlowPath()
+        text = text[:-len(suffix)]
+        if len(_SCALAR_CACHE) >= SCALAR_CACHE_SIZE:
+            _SCALAR_CACHE.clear()
+        _SCALAR_CACHE[cache_key] = text
+    if ' ' in text and column + len(text) > YAML_WIDTH:
+        raise _SlowPath()
+    return text
+
+
+def _write_value(parts, value, indent, column, ordered=False):
+    """Append a value from a nic-config tree to parts as block YAML
+
+    Writes exactly what _emit_value would, for the values nic-configs are
+    made of, without going through PyYAML's emitter.  Raises _SlowPath for
+    anything else.
+
+    :param indent: The indent of the collection the value is in.
+    :param column: The column the value starts at, right after its key or
+                   sequence indicator.
+    """
+    if isinstance(value, dict) and value:
+        keys = _ordered_keys(value) if ordered else sorted(value)
+        parts.append('\n')
+        _write_mapping(parts, value, keys, indent + 2, ordered)
+    elif isinstance(value, list) and value:
+        # A sequence in a mapping is not indented any further than its key
+        parts.append('\n')
+        _write_sequence(parts, value, indent, ordered)
+    else:
+        parts.append(' ')
+        parts.append(_flow_text(value, column + 1))
+        parts.append('\n')
+
+
+def _flow_text(value, column):
+    """Return the text of a scalar, empty collection or get_param string"""
+    if isinstance(value, dict):
+        return '{}'
+    if isinstance(value, list):
+        return '[]'
+    if (hasattr(value, 'startswith') and
+            value.startswith(GET_PARAM_PREFIX) and value.endswith('}')):
+        # PyYAML starts a flow mapping's key on a new line past the width
+        if column + 1 > YAML_WIDTH:
+            raise _SlowPath()
+        name = value[len(GET_PARAM_PREFIX):-1]
+        if not name.replace('_', '').isalnum():
+            raise _SlowPath()
+        return '{get_param: %s}' % _scalar_text(name, column + 12)
+    return _scalar_text(value, column)
+
+
+def _write_mapping(parts, value, keys, indent, ordered, inline=False):
+    """Append a non-empty dict at indent, with its first key on the current
+    line if inline is True"""
+    for i, key in enumerate(keys):
+        if i or not inline:
+            parts.append(' ' * indent)
+        text = _scalar_text(key, indent, True)
+        parts.append(text)
+        parts.append(':')
+        _write_value(parts, value[key], indent, indent + len(text) + 1,
+                     ordered and key == 'members')
+
+
+def _write_sequence(parts, value, indent, ordered, inline=False):
+    """Append a non-empty list at indent, with its first item on the current
+    line if inline is True"""
+    for i, item in enumerate(value):
+        if i or not inline:
+            parts.append(' ' * indent)
+        parts.append('- ')
+        if isinstance(item, dict) and item:
+            keys = _ordered_keys(item) if ordered else sorted(item)
+            _write_mapping(parts, item, keys, indent + 2, ordered, True)
+        elif isinstance(item, list) and item:
+            _write_sequence(parts, item, indent + 2, ordered, True)
+        else:
+            parts.append(_flow_text(item, indent + 2))
+            parts.append('\n')
 
-    This must be the last thing done before the data is dumped as YAML.
-    Any further manipulation of the data after this is run on it may change
-    the ordering.
 
-    If data has a key named 'members' then _order_dicts will be called
-    recursively on its value.
+def _write_resources(f, base, network_config):
+    """Write a nic-config resources section to f, as _emit_resources would
 
-    :param data: The dict to be ordered.
+    The nic-config is built up in a list of strings by _write_value, which
+    is several times faster than feeding every node and scalar through
+    PyYAML's emitter.  If it holds anything _write_value cannot write,
+    nothing has been written to f yet and _emit_resources is used instead.
     """
-    new_dict = collections.OrderedDict()
-    filter_keys = FIRST_KEYS + LAST_KEYS
-    rest = {k: v for k, v in data.items() if k not in filter_keys}
-    for key in FIRST_KEYS:
-        if key in data:
-            new_dict[key] = data[key]
-    for key in sorted(rest.keys()):
-        new_dict[key] = rest[key]
-    for key in LAST_KEYS:
-        if key in data:
-            new_dict[key] = data[key]
-    if 'members' in new_dict:
-        _order_dicts(new_dict['members'])
+    parts = []
+
+    def write_base(value, indent):
+        for key in sorted(value):
+            text = _scalar_text(key, indent, True)
+            parts.extend([' ' * indent, text, ':'])
+            if key == 'network_config':
+                _write_value(parts, network_config, indent,
+                             indent + len(text) + 1, True)
+            elif isinstance(value[key], dict) and value[key]:
+                parts.append('\n')
+                write_base(value[key], indent + 2)
+            else:
+                _write_value(parts, value[key], indent,
+                             indent + len(text) + 1)
+
+    try:
+        write_base(base, 0)
+    except _SlowPath:
+        _emit_resources(f, base, network_config)
+    else:
+        f.write(''.join(parts))
+
+
+class _Chunks(list):
+    """A file-like list of the strings written to it"""
+    def write(self, data):
+        self.append(data)
+
+
+class _Cancelled(Exception):
+    """Raised by _generate when it is cancelled part way through"""
+
 
-    return new_dict
+class _Stats(object):
+    """Wall time, call count and bytes written of each generation stage
 
+    Each entry is keyed by the stage and the output file it was for, relative
+    to the output directory, or None for stages such as validation that are
+    not tied to one file.  The nic-configs go through the process and
+    serialize stages, the other files are only written.  The nic-configs are
+    serialized straight to their files, so the time taken to write them is
+    part of serialize and only their bytes are counted under write.  The
+    times of roles written in parallel are added together.
+    """
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+
+    def add(self, stage, path=None, seconds=0.0, calls=0, bytes_written=0):
+        entry = self.entries.setdefault((stage, path), [0.0, 0, 0])
+        entry[0] += seconds
+        entry[1] += calls
+        entry[2] += bytes_written
+
+    @contextlib.contextmanager
+    def time(self, stage, path=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, path, time.time() - start, 1)
+
+    def merge(self, other):
+        for (stage, path), entry in other.entries.items():
+            self.add(stage, path, *entry)
+
+    def stages(self):
+        """Return the totals of each stage, in the order of STAGES
+
+        Stages not in STAGES follow in the order they first ran.
+
+        :returns: An OrderedDict mapping each stage to a list of its seconds,
+                  calls and bytes written.
+        """
+        totals = collections.OrderedDict()
+        for (stage, path), entry in self.entries.items():
+            total = totals.setdefault(stage, [0.0, 0, 0])
+            for i, value in enumerate(entry):
+                total[i] += value
+        order = dict((stage, i) for i, stage in enumerate(STAGES))
+        return collections.OrderedDict(
+            sorted(totals.items(),
+                   key=lambda i: order.get(i[0], len(STAGES))))
+
+    def summary(self):
+        """Return a one line summary of the time taken by each stage"""
+        return ', '.join('%s %.1f ms%s' % (stage, total[0] * 1000,
+                                           ' (%d bytes)' % total[2]
+                                           if total[2] else '')
+                         for stage, total in self.stages().items())
+
+
+def _temp_path(path):
+    """Return the path a generated file is written to before it is final"""
+    head, tail = os.path.split(path)
+    return os.path.join(head, '.%s.tmp' % tail)
+
+@contextlib.contextmanager
+def _open_temp(path):
+    """Open the temporary file for path, see _temp_path
+
+    It takes the mode of any existing file at path, and is removed again if
+    writing it fails.
+    """
+    tmp = _temp_path(path)
+    try:
+        with open(tmp, 'w', OUTPUT_BUFFER_SIZE) as f:
+            try:
+                os.chmod(tmp, stat.S_IMODE(os.stat(path).st_mode))
+            except OSError:
+                pass
+            yield f
+    except BaseException:
+        _discard_output([path])
+        raise
+
+@contextlib.contextmanager
+def _output_file(path, staged=None):
+    """Open a generated file for writing
+
+    The file is written to a temporary file next to path, which then
+    replaces path in a single rename, so readers never see it half written.
+    If staged is a list, path is appended to it instead and the rename is
+    left to _commit_output, so that a whole set of files can be written
+    before any of them replaces what is there.
+    """
+    with _open_temp(path) as f:
+        yield f
+    if staged is None:
+        _commit_output([path])
+    else:
+        staged.append(path)
 
-def _order_dicts(node_data):
-    """Convert dicts in node_data to a more human-readable format
+def _commit_output(paths):
+    """Rename the temporary files of paths into place
 
-    :param node_data: A list of dicts to order
+    Each temporary file is flushed to disk before anything is renamed, and
+    the directories they are renamed in are flushed afterwards, so after a
+    crash each path holds either its old or its new contents and the renames
+    are not lost.  Each path is replaced atomically, but the set is not: the
+    files are renamed one at a time, so a reader looking while that happens
+    can see some new files next to old ones.
     """
-    for index, item in enumerate(node_data):
-        node_data[index] = _order_dict(item)
+    for path in paths:
+        _fsync(_temp_path(path))
+    for path in paths:
+        os.rename(_temp_path(path), path)
+    for directory in set(os.path.dirname(path) or '.' for path in paths):
+        try:
+            _fsync(directory)
+        except OSError:
+            # Not every platform and filesystem can sync a directory
+            pass
 
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
-def _write_nic_configs(data, global_data, base_path):
-    """Write nic configs based on the data passed in"""
+def _discard_output(paths):
+    """Remove any temporary files left for paths"""
+    for path in paths:
+        try:
+            os.unlink(_temp_path(path))
+        except OSError:
+            pass
+
+def _write_nic_configs(data, global_data, base_path, workers=1, stats=None,
+                       progress=None, staged=None):
+    """Write nic configs based on the data passed in
+
+    :param workers: Number of processes to write the roles with.  Each role
+                    is independent, so with enough workers the time taken is
+                    that of the slowest role rather than the sum of them all.
+    :param stats: A _Stats to add the stages of writing each role to.
+    :param progress: Called with the path of each nic config, relative to
+                     base_path, once it is written.  If it raises, the
+                     remaining roles are abandoned.
+    :param staged: As for _output_file.  Otherwise the nic configs all
+                   replace the existing ones once every role is written.
+    """
     nic_path = os.path.join(base_path, 'nic-configs')
     try:
         os.mkdir(nic_path)
     except OSError:
         pass
-    template_version = global_data.get('version', 1)
-
-    def new_resource():
-        if template_version == 1:
-            resources = copy.deepcopy(BASE_RESOURCE)
-            network_config = resources['resources']['OsNetConfigImpl']
-            network_config = network_config['properties']['config']
-            network_config = network_config['os_net_config']
-            network_config['network_config'] = []
-            network_config = network_config['network_config']
-        else:
-            # Version 2, using os-net-config script from tht
-            resources = copy.deepcopy(BASE_RESOURCE_2)
-            network_config = resources['resources']['OsNetConfigImpl']
-            network_config = network_config['properties']['config']
-            network_config = network_config['str_replace']['params']
-            network_config = network_config['$network_config']
-            network_config['network_config'] = []
-            network_config = network_config['network_config']
-        return (resources, network_config)
+    tasks = _nic_config_tasks(data, global_data, nic_path)
+    written = []
+    try:
+        results = _imap(_write_nic_config, tasks, workers)
+        try:
+            for task, result in zip(tasks, results):
+                written.append(task[0])
+                if stats is not None:
+                    stats.merge(result)
+                if progress is not None:
+                    progress(os.path.join('nic-configs', task[1]))
+        finally:
+            results.close()
+    except BaseException:
+        _discard_output([task[0] for task in tasks])
+        raise
+    if staged is None:
+        _commit_output(written)
+    else:
+        staged.extend(written)
 
-    for filename, node_data in data.items():
-        with open(os.path.join(nic_path, filename), 'w') as f:
-            f.write(PARAMS % TEMPLATE_VERSION[template_version])
-            resources, network_config = new_resource()
-            for i in node_data:
-                _process_network_config(i, filename,
-                                        global_data.get('auto_routes', True))
-                for j in i.get('members', []):
-                    _process_bridge_members(j, i.get('members', []))
-                    for k in j.get('members', []):
-                        _process_bond_members(k)
-                network_config.append(i)
-            _order_dicts(network_config)
-            resource_string = yaml.safe_dump(resources,
-                                             default_flow_style=False)
-            # Ugly hack to remove unwanted quoting around get_params
-            resource_string = resource_string.replace(
-                "'{get_param:", "{get_param:")
-            resource_string = resource_string.replace("}'", "}")
-            f.write(resource_string)
-            f.write(OUTPUTS)
-
-def _write_pickle(data, global_data, base_path):
-    # Useful for generating the input json for a unit test
-    #import json
-    #print json.dumps(data)
-    #print json.dumps(global_data)
+def _render_nic_configs(data, global_data, workers=1, stats=None):
+    """Return the contents of the nic configs _write_nic_configs would write
+
+    :returns: A dict mapping each nic config's filename to its contents.
+    """
+    tasks = _nic_config_tasks(data, global_data, 'nic-configs')
+    contents = {}
+    for task, (content, task_stats) in zip(
+            tasks, _map(_render_nic_config, tasks, workers)):
+        contents[task[1]] = content
+        if stats is not None:
+            stats.merge(task_stats)
+    return contents
+
+def _nic_config_tasks(data, global_data, nic_path):
+    """Return a _write_nic_config task for each nic config to be written"""
+    params = _params(global_data)
+    templates = _nic_templates(data, global_data)
+    return [(os.path.join(nic_path, filename), filename, node_data,
+             global_data, params)
+            for filename, node_data in data.items()
+            if templates[filename] == filename]
+
+def _map(func, tasks, workers):
+    """Return func(task) for each task, using a pool if workers > 1"""
+    return list(_imap(func, tasks, workers))
+
+def _imap(func, tasks, workers):
+    """Yield func(task) for each task in order, using a pool if workers > 1
+
+    If the generator is closed early, the remaining tasks are skipped rather
+    than run.  The pool is only terminated on KeyboardInterrupt, because
+    terminating a worker while it sends a result leaves the result queue
+    locked, and joining the pool then hangs.
+    """
+    workers = min(workers, len(tasks))
+    if workers <= 1:
+        for task in tasks:
+            yield func(task)
+        return
+    skip = multiprocessing.Event()
+    pool = multiprocessing.Pool(workers, _init_pool_worker, (skip,))
+    try:
+        for result in pool.imap(_run_pool_task,
+                                [(func, task) for task in tasks]):
+            yield result
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    except BaseException:
+        skip.set()
+        pool.close()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+# Set in each pool worker by _init_pool_worker, see _imap
+_SKIP_TASKS = None
+
+def _init_pool_worker(skip):
+    """Initialise an _imap pool worker with the event that skips its tasks"""
+    global _SKIP_TASKS
+    _SKIP_TASKS = skip
+
+def _run_pool_task(args):
+    """Return func(task) for an _imap pool, or None once it is closed"""
+    func, task = args
+    if _SKIP_TASKS.is_set():
+        return None
+    return func(task)
+
+def _nic_templates(data, global_data):
+    """Map each role's nic-config filename to the template it uses
+
+    Normally every role has its own template.  With
+    global_data['dedup_nic_configs'] set, roles whose templates would be
+    identical all use the template of the first of them, in role order, and
+    the others are not written at all.
+    """
+    if not global_data.get('dedup_nic_configs', False):
+        return dict((filename, filename) for filename in data)
+    templates = {}
+    shared = {}
+    for role in _roles(data, global_data):
+        filename = role['filename']
+        if filename not in data:
+            continue
+        # _process_network_config treats the controller differently, so
+        # identical data does not mean an identical template there.
+        key = _input_hash(data[filename], filename == 'controller.yaml')
+        templates[filename] = shared.setdefault(key, filename)
+    return templates
+
+def _write_nic_config(task):
+    """Write the nic config for a single role
+
+    This is a separate module-level function so it can be run in a worker
+    process by _write_nic_configs.  Only the temporary file is written, see
+    _output_file, it is up to _write_nic_configs to rename it into place.
+
+    :returns: A _Stats of each stage of writing the file.
+    """
+    path, filename = task[:2]
+    stats = _Stats()
+    with _open_temp(path) as f:
+        _emit_nic_config(f, task, stats)
+    stats.add('write', os.path.join('nic-configs', filename),
+              bytes_written=os.path.getsize(_temp_path(path)))
+    return stats
+
+def _render_nic_config(task):
+    """Return the contents of a single nic config, and a _Stats of doing so
+
+    Takes the same tasks as _write_nic_config, but the path is not used.
+    """
+    stats = _Stats()
+    chunks = _Chunks()
+    _emit_nic_config(chunks, task, stats)
+    return ''.join(chunks), stats
+
+def _emit_nic_config(f, task, stats):
+    """Stream a single nic config to f, adding each stage to stats"""
+    path, filename, node_data, global_data, params = task
+    if global_data.get('version', 1) == 1:
+        base = BASE_RESOURCE
+    else:
+        # Version 2, using os-net-config script from tht
+        base = BASE_RESOURCE_2
+    rel_path = os.path.join('nic-configs', filename)
+    with stats.time('process', rel_path):
+        network_config = _process_role(node_data, filename,
+                                       global_data.get('auto_routes', True))
+        if global_data.get('trim_nic_params', False):
+            params = _params(global_data,
+                             set(_get_params(network_config)))
+    with stats.time('serialize', rel_path):
+        f.write(params)
+        _write_resources(f, base, network_config)
+        f.write(OUTPUTS)
+
+def _params(global_data, needed=None):
+    """Return the parameters section of the nic configs
+
+    Every network that is defined gets its parameters, whether the role uses
+    it or not, because tripleo-heat-templates passes them all to every role.
+
+    :param needed: The names of the parameters a processed role references,
+                   from _get_params, to only include the parameters that role
+                   needs for global_data['trim_nic_params'].  The IpSubnet of
+                   every network and all of the ControlPlane parameters are
+                   still included, because tripleo-heat-templates passes them
+                   to every role.  The routes, MTU and VLAN of a network are
+                   included if any parameter of the network is referenced,
+                   and any other parameter only if it is referenced itself.
+    """
+    networks = _networks(global_data)[1:]
+    if needed is None:
+        used = networks
+        keep = lambda name: True
+    else:
+        used = [n for n in networks
+                if any(n['name'] + suffix in needed
+                       for suffix in NETWORK_PARAM_SUFFIXES)]
+        keep = lambda name: name in needed or name.startswith('ControlPlane')
+    parts = [PARAMS_HEADER % TEMPLATE_VERSION[global_data.get('version', 1)]]
+    for n in networks:
+        parts.append(PARAMS_SUBNET % dict(n, comment=' # ' + n['comment']
+                                          if n['comment'] else ''))
+        if n in used:
+            parts.append(PARAMS_NETWORK % n)
+    if keep('BondInterfaceOvsOptions'):
+        parts.append(PARAMS_BOND)
+    parts.extend(PARAMS_VLAN % n for n in used)
+    parts.extend(text for name, text in PARAMS_FOOTER if keep(name))
+    parts.append('\n')
+    return ''.join(parts)
+
+def _get_params(value):
+    """Yield the names of the "{get_param: Name}" strings in value"""
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, list):
+        for item in value:
+            for name in _get_params(item):
+                yield name
+    elif (hasattr(value, 'startswith') and
+          value.startswith(GET_PARAM_PREFIX) and value.endswith('}')):
+        yield value[len(GET_PARAM_PREFIX):-1]
+
+def _write_settings(data, global_data, base_path, staged=None):
+    """Write the README and the UI settings needed to load base_path again
+
+    The settings are stored as compact json, with the data version at the
+    top level so the file can be checked without reading all of it.
+
+    :param staged: As for _output_file.  The legacy settings are then left
+                   for the caller to remove once the new ones are in place.
+    """
     try:
         os.mkdir(base_path)
     except OSError:
         pass
-    with open(os.path.join(base_path, 'README'), 'w') as f:
+    with _output_file(os.path.join(base_path, 'README'), staged) as f:
         f.write(README)
-    file_data = {'data': data, 'global_data': global_data}
-    pickle.dump(file_data, open(os.path.join(base_path,
-                                             'ui-settings.pickle'), 'wb'))
+    file_data = {'major': global_data.get('major', DATA_MAJOR),
+                 'minor': global_data.get('minor', DATA_MINOR),
+                 'data': data,
+                 'global_data': global_data,
+                 }
+    with _output_file(os.path.join(base_path, SETTINGS_FILE), staged) as f:
+        f.write(json.dumps(file_data, sort_keys=True, separators=(',', ':')))
+    if staged is None:
+        _remove_legacy_settings(base_path)
+
+def _remove_legacy_settings(base_path):
+    # Otherwise the stale pickle would be left behind next to the new file
+    try:
+        os.unlink(os.path.join(base_path, LEGACY_SETTINGS_FILE))
+    except OSError:
+        pass
 
-def _write_net_env(data, global_data, base_path):
+def _write_net_env(data, global_data, base_path, index=None, staged=None):
     """Write network-environment.yaml based on the data passed in"""
+    with _output_file(os.path.join(base_path, 'network-environment.yaml'),
+                      staged) as f:
+        f.write(_render_net_env(data, global_data, index))
+
+def _render_net_env(data, global_data, index=None):
+    """Return the contents of network-environment.yaml"""
+    if index is None:
+        index = _build_net_index(data)
     # This is simple YAML, so instead of generating it with the yaml
     # module, we'll just write it directly as text so we control the
     # formatting.
-    with open(os.path.join(base_path,
-                            'network-environment.yaml'), 'w') as f:
-        def write(content):
-            f.write('  ' + content + '\n')
-        f.write(NETENV_HEADER)
-        if _net_used_all(data, 'ControlPlane')[0]:
-            write("ControlPlaneSubnetCidr: '%d'" %
-                  global_data['control']['mask'])
-            write('ControlPlaneDefaultRoute: %s' %
-                  global_data['control']['route'])
-            write('EC2MetadataIp: %s' % global_data['control']['ec2'])
-        external_used = _net_used_all(data, 'External')
-        if external_used[0]:
-            write('ExternalNetCidr: %s' % global_data['external']['cidr'])
-            write('ExternalAllocationPools: [{"start": "%s", '
-                  '"end": "%s"}]' % (global_data['external']['start'],
-                                     global_data['external']['end']))
-            write('ExternalInterfaceDefaultRoute: %s' %
-                  global_data['external']['gateway'])
-            if external_used[1]:
-                write('ExternalNetworkVlanID: %d' %
-                      global_data['external']['vlan'])
-            write('NeutronExternalNetworkBridge: "%s"' %
-                  global_data['external']['bridge'])
-        for camel, lower in SIMILAR_NETS:
-            used = _net_used_all(data, camel)
-            if used[0]:
-                write('%sNetCidr: %s' % (camel, global_data[lower]['cidr']))
-                write('%sAllocationPools: [{"start": "%s", '
-                    '"end": "%s"}]' % (camel,
-                                       global_data[lower]['start'],
-                                       global_data[lower]['end']))
-                if used[1]:
-                    write('%sNetworkVlanID: %d' % (camel,
-                                                   global_data[lower]['vlan']))
-        write('DnsServers: ["%s", "%s"]' % (global_data['dns1'],
-                                            global_data['dns2']))
-        if global_data['bond_options']:
-            write('BondInterfaceOvsOptions: %s' % global_data['bond_options'])
+    f = _Chunks()
+    def write(content):
+        f.write('  ' + content + '\n')
+    f.write('\nresource_registry:\n')
+    templates = _nic_templates(data, global_data)
+    for role in _registry_roles(data, global_data):
+        f.write(NETENV_REGISTRY_ENTRY %
+                (role['name'], templates.get(role['filename'],
+                                             role['filename'])))
+    f.write('\nparameter_defaults:\n')
+    if _net_used_all(data, 'ControlPlane', index)[0]:
+        write("ControlPlaneSubnetCidr: '%d'" %
+              global_data['control']['mask'])
+        write('ControlPlaneDefaultRoute: %s' %
+              global_data['control']['route'])
+        write('EC2MetadataIp: %s' % global_data['control']['ec2'])
+    external_used = _net_used_all(data, 'External', index)
+    if external_used[0]:
+        write('ExternalNetCidr: %s' % global_data['external']['cidr'])
+        write('ExternalAllocationPools: [{"start": "%s", '
+              '"end": "%s"}]' % (global_data['external']['start'],
+                                 global_data['external']['end']))
+        write('ExternalInterfaceDefaultRoute: %s' %
+              global_data['external']['gateway'])
+        if external_used[1]:
+            write('ExternalNetworkVlanID: %d' %
+                  global_data['external']['vlan'])
+        write('NeutronExternalNetworkBridge: "%s"' %
+              global_data['external']['bridge'])
+    for net in _networks(global_data)[2:]:
+        camel, lower = net['name'], net['lower']
+        used = _net_used_all(data, camel, index)
+        if used[0]:
+            write('%sNetCidr: %s' % (camel, global_data[lower]['cidr']))
+            write('%sAllocationPools: [{"start": "%s", '
+                '"end": "%s"}]' % (camel,
+                                   global_data[lower]['start'],
+                                   global_data[lower]['end']))
+            if used[1]:
+                write('%sNetworkVlanID: %d' % (camel,
+                                               global_data[lower]['vlan']))
+    write('DnsServers: ["%s", "%s"]' % (global_data['dns1'],
+                                        global_data['dns2']))
+    if global_data['bond_options']:
+        write('BondInterfaceOvsOptions: %s' % global_data['bond_options'])
+    return ''.join(f)
 
 def _write_net_iso(data, global_data, base_path,
-                   filename='network-isolation.yaml', template_path='..'):
+                   filename='network-isolation.yaml', template_path='..',
+                   index=None, staged=None):
     """Write network-isolation.yaml based on the data passed in
 
     :param data: nic-config data
@@ -467,29 +1020,50 @@ def _write_net_iso(data, global_data, base_path,
     :param base_path: output directory
     :param filename: output filename
     :param template_path: path to root of tripleo-heat-templates
+    :param index: network usage index from _build_net_index.  Built from
+                  data if not passed.
+    :param staged: As for _output_file.
+    """
+    with _output_file(os.path.join(base_path, filename), staged) as f:
+        f.write(_render_net_iso(data, global_data, template_path, index))
+
+def _render_net_iso(data, global_data, template_path='..', index=None):
+    """Return the contents of network-isolation.yaml
+
+    See _write_net_iso for the parameters.
     """
+    if index is None:
+        index = _build_net_index(data)
     ipv6 = global_data.get('ipv6', False)
-    with open(os.path.join(base_path, filename), 'w') as f:
-        f.write('resource_registry:\n')
-        # By default, we run redis on the internal network with net-iso.
-        # Without internal enabled, this doesn't seem to work.
-        def write(content):
-            f.write('  ' + content + '\n')
-        if _net_used_all(data, 'InternalApi')[0]:
-            vip_name = 'vip'
-            if ipv6:
-                vip_name = 'vip_v6'
-            write('# Redis')
-            path = os.path.join(template_path, 'network/ports/%s.yaml' % vip_name)
-            write('OS::TripleO::Network::Ports::RedisVipPort: %s'% path)
-        for i in ALL_NETS[1:]:
-            _write_net_iso_entry(f, i[0], data, template_path, i[1], ipv6=ipv6)
+    f = _Chunks()
+    f.write('resource_registry:\n')
+    # By default, we run redis on the internal network with net-iso.
+    # Without internal enabled, this doesn't seem to work.
+    def write(content):
+        f.write('  ' + content + '\n')
+    if _net_used_all(data, 'InternalApi', index)[0]:
+        vip_name = 'vip'
         if ipv6:
-            f.write(V6_NET_ISO_PARAMS)
+            vip_name = 'vip_v6'
+        write('# Redis')
+        path = os.path.join(template_path, 'network/ports/%s.yaml' % vip_name)
+        write('OS::TripleO::Network::Ports::RedisVipPort: %s'% path)
+    roles = _roles(data, global_data)
+    for net in _networks(global_data)[1:]:
+        _write_net_iso_entry(f, net['name'], data, template_path,
+                             net['lower'], ipv6=ipv6, index=index,
+                             roles=roles)
+    if ipv6:
+        f.write(V6_NET_ISO_PARAMS)
+    return ''.join(f)
 
 def _write_net_iso_entry(f, net, data, template_path, basename=None,
-                         ipv6=False):
+                         ipv6=False, index=None, roles=None):
     """Write the entries for a single network to f"""
+    if index is None:
+        index = _build_net_index(data)
+    if roles is None:
+        roles = _roles(data)
     if basename is None:
         basename = net.lower()
     # OVS and Neutron don't support ipv6 tenant networks yet.
@@ -500,31 +1074,261 @@ def _write_net_iso_entry(f, net, data, template_path, basename=None,
         format_str = '  ' + content + '\n'
         f.write(format_str % (net, template_path, basename))
 
-    if _net_used_all(data, net)[0]:
+    if _net_used_all(data, net, index)[0]:
         f.write('  # %s\n' % net)
         write('OS::TripleO::Network::%s: '
               '%s/network/%s.yaml')
         write('OS::TripleO::Network::Ports::%sVipPort: '
               '%s/network/ports/%s.yaml')
-    for _, filename, template_name in TYPE_LIST:
-        if _net_used(data, net, filename)[0]:
-            write('OS::TripleO::' + template_name + '::Ports::%sPort: '
+    for role in roles:
+        if _net_used(data, net, role['filename'], index)[0]:
+            write('OS::TripleO::' + role['ports'] + '::Ports::%sPort: '
                   '%s/network/ports/%s.yaml')
 
-def _net_used_all(data, name):
+def _plan_ips(data, global_data, index=None):
+    """Plan a fixed address for every node on every network its role uses
+
+    global_data['node_counts'] maps role names to the number of nodes of
+    that role.  On each network, every role using it gets a consecutive
+    block of addresses from the start of the network's allocation pool, in
+    role order.  Enough of the pool is left for the virtual IPs that Neutron
+    still allocates from it.  Addresses are only ever handled as integers,
+    so the size of the plan does not depend on the number of nodes.
+
+    :param index: network usage index from _build_net_index.  Built from
+                  data if not passed.
+    :returns: A tuple of the planned roles in order, a dict mapping each
+              role name to a list of (network, first address, count) and a
+              dict mapping each network's lower name to the (first, last,
+              IP version) of the addresses left in its pool.  Addresses are integers, and
+              network dicts have an extra 'version' key for formatting them.
+    """
+    if index is None:
+        index = _build_net_index(data)
+    counts = global_data.get('node_counts') or {}
+    roles = _roles(data, global_data)
+    unknown = sorted(set(counts) - set(r['name'] for r in roles))
+    if unknown:
+        raise RuntimeError('Node counts given for unknown roles: %s' %
+                           ', '.join(unknown))
+    for name, count in sorted(counts.items()):
+        if not isinstance(count, int) or isinstance(count, bool) or count < 0:
+            raise RuntimeError('Invalid node count for %s: %r' %
+                               (name, count))
+    roles = [r for r in roles if counts.get(r['name'])]
+    plan = dict((r['name'], []) for r in roles)
+    pools = {}
+    for net in _networks(global_data)[1:]:
+        users = [r for r in roles
+                 if _net_used(data, net['name'], r['filename'], index)[0]]
+        if not users:
+            continue
+        settings = global_data[net['lower']]
+        start = _netaddr(netaddr.IPAddress, settings['start'])
+        net = dict(net, version=start.version)
+        start = int(start)
+        end = int(_netaddr(netaddr.IPAddress, settings['end']))
+        nodes = sum(counts[r['name']] for r in users)
+        # The network's VIP, and Redis runs on a VIP on the internal network
+        vips = 2 if net['name'] == 'InternalApi' else 1
+        available = end - start + 1
+        if nodes + vips > available:
+            raise RuntimeError('The %s allocation pool has %d addresses, but '
+                               '%d nodes and %d virtual IPs need one each' %
+                               (net['name'], max(available, 0), nodes, vips))
+        first = start
+        for r in users:
+            plan[r['name']].append((net, first, counts[r['name']]))
+            first += counts[r['name']]
+        pools[net['lower']] = (first, end, net['version'])
+    return roles, plan, pools
+
+def _write_ips_from_pool(data, global_data, base_path,
+                         filename=IPS_FROM_POOL, template_path='..',
+                         index=None, staged=None):
+    """Write an environment assigning every node its planned addresses
+
+    The nodes' ports are switched to the from_pool port templates, and each
+    allocation pool is shrunk to what is left after the plan so that Neutron
+    cannot hand out a planned address to a virtual IP.  See _plan_ips.
+    """
+    with _output_file(os.path.join(base_path, filename), staged) as f:
+        f.write(_render_ips_from_pool(data, global_data, template_path,
+                                      index))
+
+def _render_ips_from_pool(data, global_data, template_path='..', index=None):
+    """Return the contents of ips-from-pool.yaml
+
+    See _write_ips_from_pool.
+    """
+    roles, plan, pools = _plan_ips(data, global_data, index)
+    ipv6 = global_data.get('ipv6', False)
+    f = _Chunks()
+    f.write('resource_registry:\n')
+    for net in _networks(global_data)[1:]:
+        basename = net['lower'] + '_from_pool'
+        # OVS and Neutron don't support ipv6 tenant networks yet.
+        if ipv6 and net['lower'] != 'tenant':
+            basename += '_v6'
+        for role in roles:
+            if any(n['lower'] == net['lower']
+                   for n, _, _ in plan[role['name']]):
+                f.write('  OS::TripleO::%s::Ports::%sPort: '
+                        '%s/network/ports/%s.yaml\n' %
+                        (role['ports'], net['name'], template_path,
+                         basename))
+    f.write('\nparameter_defaults:\n')
+    for net in _networks(global_data)[1:]:
+        if net['lower'] in pools:
+            first, last, version = pools[net['lower']]
+            f.write('  %sAllocationPools: [{"start": "%s", '
+                    '"end": "%s"}]\n' %
+                    (net['name'], netaddr.IPAddress(first, version),
+                     netaddr.IPAddress(last, version)))
+    for role in roles:
+        if not plan[role['name']]:
+            continue
+        f.write('  %s:\n' % role['ips'])
+        for net, first, count in plan[role['name']]:
+            f.write('    %s:\n' % net['lower'])
+            for value in range(first, first + count):
+                f.write('    - %s\n' %
+                        netaddr.IPAddress(value, net['version']))
+    return ''.join(f)
+
+def _build_net_index(data):
+    """Index where each network is used across all nic-config files
+
+    Every role is walked once, to any depth, so callers that need to ask
+    about many networks should build this once and pass it around rather
+    than scanning data for each network.
+
+    :returns: A dict keyed by the camelcase network name.  Each value is a
+              dict with the keys 'roles' (a dict mapping each filename that
+              uses the network to a dict with the shallowest 'depth' at which
+              it is used there and whether it is used on a 'vlan'), 'vlan'
+              (whether any use is a VLAN) and 'depth' (the shallowest depth
+              the network is used at in any role).  Top-level interfaces and
+              bridges are depth 0.
+    """
+    index = {}
+    for filename, path, node, _ in _walk_nodes(data):
+        _index_node(index, filename, len(path) - 1, node)
+    return index
+
+def _index_node(index, filename, depth, node):
+    """Add a single node to a network usage index"""
+    network = node.get('network', 'None')
+    if network == 'None':
+        return
+    vlan = node['type'] == 'vlan'
+    entry = index.setdefault(network, {'roles': {},
+                                       'vlan': False,
+                                       'depth': depth})
+    role = entry['roles'].setdefault(filename, {'depth': depth,
+                                                'vlan': False})
+    role['depth'] = min(role['depth'], depth)
+    role['vlan'] = role['vlan'] or vlan
+    entry['vlan'] = entry['vlan'] or vlan
+    entry['depth'] = min(entry['depth'], depth)
+
+def _merge_index(index, other):
+    """Add the network usage of other to index, for roles not in index"""
+    for network, entry in other.items():
+        merged = index.setdefault(network, {'roles': {},
+                                            'vlan': False,
+                                            'depth': entry['depth']})
+        merged['roles'].update(entry['roles'])
+        merged['vlan'] = merged['vlan'] or entry['vlan']
+        merged['depth'] = min(merged['depth'], entry['depth'])
+
+def _walk_nodes(data):
+    """Visit every interface, bridge, bond, VLAN and route in data
+
+    Yields a tuple of (filename, path, node, parents) for each node, parents
+    first.  path is a tuple of the indexes into the role's list and each
+    members list leading to the node, and parents is a tuple of the nodes
+    containing it, outermost first.  Nodes that are not dicts are yielded
+    but not looked into, and neither are members that are not a list, see
+    _structure_errors.
+    """
+    stack = []
+    for filename, node_data in data.items():
+        stack.extend((filename, (i,), node, ())
+                     for i, node in reversed(list(enumerate(node_data))))
+        while stack:
+            filename, path, node, parents = stack.pop()
+            yield filename, path, node, parents
+            members = node.get('members') if isinstance(node, dict) else None
+            if not isinstance(members, list):
+                continue
+            child_parents = parents + (node,)
+            stack.extend((filename, path + (i,), m, child_parents)
+                         for i, m in reversed(list(enumerate(members))))
+
+def _net_used_all(data, name, index=None):
     """Check whether a network is used in any nic-config file
 
+    :param index: network usage index from _build_net_index.  Built from
+                  data if not passed.
     :returns: A tuple where the first element is whether the network is used
               at all, and the second element is whether the network is used on
               a VLAN.
     """
-    return (any([_net_used(data, name, fname)[0]
-                 for fname, _ in data.items()]),
-            any([_net_used(data, name, fname)[1]
-                 for fname, _ in data.items()])
-            )
-
-def _net_used(data, name, filename):
+    if index is None:
+        index = _build_net_index(data)
+    entry = index.get(name)
+    if entry is None:
+        return False, False
+    return True, entry['vlan']
+
+class _NetworkUsage(object):
+    """Count where networks and nic numbers are used, as the data is edited
+
+    The UI keeps one of these up to date as nodes are added, removed and
+    changed, so it does not need to rebuild a _build_net_index or walk every
+    role on each edit.  A node is counted the same way _index_node and the
+    nic numbering in the UI would count it.
+    """
+    def __init__(self, data=None):
+        self.networks = collections.Counter()
+        self.nics = {}
+        for filename, path, node, _ in _walk_nodes(data or {}):
+            self.add(filename, node)
+
+    def add(self, filename, node, count=1):
+        """Count node, without its members, as used in filename"""
+        network = node.get('network', 'None')
+        if network != 'None':
+            self.networks[network] += count
+            if self.networks[network] <= 0:
+                del self.networks[network]
+        number = _nic_number(node)
+        if number is not None:
+            nics = self.nics.setdefault(filename, collections.Counter())
+            nics[number] += count
+            if nics[number] <= 0:
+                del nics[number]
+
+    def remove(self, filename, node):
+        self.add(filename, node, -1)
+
+    def used(self, network):
+        return network in self.networks
+
+    def next_nic(self, filename):
+        """Return the name of the nic after the highest numbered one"""
+        return 'nic%d' % (max(self.nics.get(filename) or [0]) + 1)
+
+def _nic_number(node):
+    """Return the number of a nicN interface, or None for anything else"""
+    name = node.get('name', '')
+    if (node.get('type') == 'interface' and name.startswith('nic') and
+            name[3:].isdigit()):
+        return int(name[3:])
+    return None
+
+def _net_used(data, name, filename, index=None):
     """Determine whether nics are configured to use a network
 
     Returns whether a nic in filename is configured to use the network
@@ -533,18 +1337,46 @@ def _net_used(data, name, filename):
     whether the network is used by a VLAN.  name is the camelcase form of the
     network.
     """
-    node_data = data[filename]
+    if index is None:
+        index = _build_net_index(data)
+    role = index.get(name, {'roles': {}})['roles'].get(filename)
+    if role is None:
+        return False, False
+    return True, role['vlan']
+
+def _process_role(node_data, filename, auto_routes):
+    """Return the output form of a role's nic-config data
+
+    The transforms below all build new nodes rather than modifying the ones
+    they are given, so node_data is left exactly as it was and can be shared
+    with the other writers.
+    """
+    result = []
     for i in node_data:
-        if i.get('network', '') == name:
-            return True, i['type'] == 'vlan'
-        for j in i['members']:
-            if j.get('network', '') == name:
-                return True, j['type'] == 'vlan'
-    return False, False
+        d = _process_network_config(i, filename, auto_routes)
+        if 'members' in d:
+            d['members'] = [_process_bridge_member_tree(j, i['members'])
+                            for j in d['members']]
+        result.append(d)
+    return result
+
+def _process_bridge_member_tree(nd, siblings):
+    nd = _process_bridge_members(nd, siblings)
+    if 'members' in nd:
+        nd['members'] = [_process_bond_members(k) for k in nd['members']]
+    return nd
 
 def _process_all(d):
+    """Return a copy of d with the processing common to all nodes done
+
+    Lists that the other transforms add to are copied as well, so d is never
+    modified.
+    """
+    d = dict(d)
     if 'mtu' in d and d['mtu'] == -1:
         del d['mtu']
+    if 'routes' in d:
+        d['routes'] = list(d['routes'])
     for m in d.get('members', []):
         if m['type'] == 'route':
             new_route = copy.deepcopy(m)
@@ -554,15 +1386,19 @@ def _process_all(d):
             d['routes'].append(new_route)
     if d['type'] == 'ovs_bridge' or d['type'] == 'ovs_bond':
         d['members'] = [m for m in d['members'] if m['type'] != 'route']
+    return d
 
 def _process_network_config(d, filename, auto_routes):
     """Tweak config data for top-level interfaces and bridges
 
     There is some data in the internal data structures of the UI that doesn't
     belong in the output files, or that needs to be adjusted/added.  This
-    function is responsible for doing that.
+    function is responsible for doing that.  The members are left for
+    _process_bridge_members.
+
+    :returns: The adjusted copy of d.
     """
-    _process_all(d)
+    d = _process_all(d)
     if d['type'] == 'interface' or d['type'] == 'ovs_bridge':
         network = d['network']
         del d['network']
@@ -605,6 +1441,7 @@ def _process_network_config(d, filename, auto_routes):
             d['type'] = '%s_bridge' % br_type
     if 'routes' in d and not d['routes']:
         del d['routes']
+    return d
 
 def _find_bond(siblings):
     bonds = [b for b in siblings if b['type'].endswith('_bond')]
@@ -621,22 +1458,27 @@ def _process_dpdk_interface(nd):
     DPDK ports are treated as interfaces, but they actually need to be a
     separate object which contains an interface.  This function handles
     that conversion.
+
+    :returns: The converted copy of nd.
     """
     if nd['type'] != 'interface':
-        return
+        return nd
+    nd = dict(nd)
     if nd.get('interface_type', 'interface') == 'ovs_dpdk_port':
         nd['type'] = nd.pop('interface_type')
         nd['members'] = [{'type': 'interface', 'name': nd['name']}]
         nd['name'] = nd.pop('port_name')
     else:
         nd.pop('port_name', None)
+    return nd
 
 def _process_bridge_members(nd, siblings):
     """The same as _process_network_config, except for bridge members
 
     Also takes a siblings parameter that allows VLAN items to be
-    automatically associated with the appropriate device."""
-    _process_all(nd)
+    automatically associated with the appropriate device.  siblings should
+    be the unprocessed members of the bridge."""
+    nd = _process_all(nd)
     if nd['type'] == 'vlan':
         network = nd['network']
         del nd['network']
@@ -686,185 +1528,933 @@ def _process_bridge_members(nd, siblings):
         nd.pop('network', None)
         if len(nd['members']) < 2:
             raise RuntimeError('Bonds must contain at least two interfaces')
-    _process_dpdk_interface(nd)
+    nd = _process_dpdk_interface(nd)
     if 'routes' in nd and not nd['routes']:
         del nd['routes']
+    return nd
 
 def _process_bond_members(nd):
-    _process_all(nd)
+    nd = _process_all(nd)
     if nd['type'] == 'interface':
         nd.pop('addresses', None)
         nd.pop('network', None)
         nd.pop('use_dhcp', None)
         nd.pop('routes', None)
-    _process_dpdk_interface(nd)
+    return _process_dpdk_interface(nd)
 
-def _validate_config(data, global_data):
-    _check_duplicate_vlans(data, global_data)
-    _check_duplicate_networks(data)
-    _check_duplicate_bonds(data)
-    _check_duplicate_nics(data)
-    _check_overlapping_cidrs(data, global_data)
-    _check_ips_in_cidr(data, global_data)
-    _check_primary_interfaces(data)
-    _check_bridge_members(data)
+ConfigError = collections.namedtuple('ConfigError',
+                                     ['role', 'path', 'message'])
+ConfigError.__doc__ = """A problem found by _find_config_errors
 
-def _lower_to_camel(lower):
-    """Given a lower-case network name, return the camel-cased form
+role is the filename of the nic-config the problem is in, or None for
+problems with the global data.  path is the index path to the offending
+node, as yielded by _walk_nodes, or an empty tuple.
+"""
 
-    Uses the ALL_NETS structure for the mapping.
+def _structure_errors(role, path, node, parents):
+    """Check a node and its members are of types allowed where they are
 
-    Example: control -> ControlPlane
-             storage_mgmt -> StorageMgmt
+    Run on each node as it is walked, before any rule visits it, so a rule
+    can rely on the node and each of its members being a dict of a known
+    type.  Problems with a member are reported at the member's path.  See
+    MEMBER_TYPES and ROLE_TYPES.
     """
-    result = [i[0] for i in ALL_NETS if i[1] == lower]
-    if len(result) == 1:
-        return result[0]
-    raise IndexError('Expected one result, found: %d' % len(result))
+    if not isinstance(node, dict):
+        # A member that is not a dict is reported by its parent
+        if not parents:
+            yield ConfigError(role, path, 'Invalid node: %r' % (node,))
+        return
+    if not parents:
+        node_type = node.get('type')
+        if node_type not in MEMBER_TYPES:
+            yield ConfigError(role, path, 'Unknown node type "%s"' % node_type)
+        elif node_type not in ROLE_TYPES:
+            yield ConfigError(role, path,
+                              '%s "%s" cannot be used at the top level' %
+                              (node_type, node.get('name')))
+    members = node.get('members', [])
+    if not isinstance(members, list):
+        yield ConfigError(role, path, 'The members of %s "%s" are not a list'
+                          % (node.get('type'), node.get('name')))
+        return
+    allowed = MEMBER_TYPES.get(node.get('type'), ())
+    for i, member in enumerate(members):
+        if not isinstance(member, dict):
+            yield ConfigError(role, path + (i,),
+                              'Invalid node: %r' % (member,))
+            continue
+        member_type = member.get('type')
+        if member_type not in MEMBER_TYPES:
+            yield ConfigError(role, path + (i,),
+                              'Unknown node type "%s"' % member_type)
+        elif member_type not in allowed:
+            yield ConfigError(role, path + (i,),
+                              '%s "%s" cannot contain %s "%s"' %
+                              (node['type'], node.get('name'), member_type,
+                               member.get('name')))
+
+class _NodeRule(object):
+    """Base class for validation rules applied to each node in turn"""
+    def __init__(self):
+        self.errors = []
+
+    def error(self, role, path, message):
+        self.errors.append(ConfigError(role, path, message))
+
+    def visit(self, role, path, node, parents):
+        raise NotImplementedError()
+
+class _DuplicateNetworkRule(_NodeRule):
+    err_msg = 'Duplicate network assignment found: %s in %s'
+
+    def __init__(self):
+        super(_DuplicateNetworkRule, self).__init__()
+        self.seen = collections.defaultdict(set)
+
+    def visit(self, role, path, node, parents):
+        network = node.get('network', 'None')
+        if network == 'None':
+            return
+        if network in self.seen[role]:
+            self.error(role, path, self.err_msg % (network, role))
+        self.seen[role].add(network)
+
+class _DuplicateBondRule(_NodeRule):
+    def __init__(self):
+        super(_DuplicateBondRule, self).__init__()
+        self.seen = collections.defaultdict(set)
+
+    def visit(self, role, path, node, parents):
+        if node['type'] != 'ovs_bond':
+            return
+        if node['name'] in self.seen[role]:
+            self.error(role, path, 'Duplicate bond name "%s" found in "%s"' %
+                       (node['name'], role))
+        self.seen[role].add(node['name'])
+
+class _DuplicateNicRule(_NodeRule):
+    def __init__(self):
+        super(_DuplicateNicRule, self).__init__()
+        self.seen = collections.defaultdict(set)
+
+    def visit(self, role, path, node, parents):
+        if node['type'] != 'interface':
+            return
+        if node['name'] in self.seen[role]:
+            self.error(role, path, 'Duplicate nic name: "%s"' % node['name'])
+        self.seen[role].add(node['name'])
+
+class _PrimaryInterfaceRule(_NodeRule):
+    """Validate that there is exactly one primary interface on a bond"""
+    multi_err = 'Found multiple primary interfaces on bond "%s"'
+    missing_err = 'Found no primary interface on bond "%s"'
 
-def _check_duplicate_vlans(data, global_data):
+    def visit(self, role, path, node, parents):
+        if node['type'] != 'ovs_bond':
+            return
+        primaries = len([i for i in node['members']
+                         if i['type'] == 'interface' and i.get('primary')])
+        if primaries > 1:
+            self.error(role, path, self.multi_err % node['name'])
+        elif not primaries:
+            self.error(role, path, self.missing_err % node['name'])
+
+class _BondMemberRule(_NodeRule):
+    """Validate that bonds have enough members to be bonds"""
+    def visit(self, role, path, node, parents):
+        if node['type'] != 'ovs_bond':
+            return
+        if len([i for i in node['members'] if i['type'] != 'route']) < 2:
+            self.error(role, path,
+                       'Bonds must contain at least two interfaces')
+
+class _BridgeMemberRule(_NodeRule):
+    """Validate that there is exactly one bond/interface per bridge"""
+    multi_err = 'Found multiple bonds/interfaces on bridge "%s"'
+    missing_err = 'Found no interface or bond on bridge "%s"'
+
+    def visit(self, role, path, node, parents):
+        if node['type'] != 'ovs_bridge':
+            return
+        ports = len([m for m in node['members']
+                     if m['type'] == 'interface' or m['type'] == 'ovs_bond'])
+        if ports > 1:
+            self.error(role, path, self.multi_err % node['name'])
+        elif not ports:
+            self.error(role, path, self.missing_err % node['name'])
+
+class _VlanNetworkRule(_NodeRule):
+    def visit(self, role, path, node, parents):
+        if node['type'] == 'vlan' and node.get('network', 'None') == 'None':
+            self.error(role, path, 'VLANs must have a network set')
+
+def _network_errors(global_data, index):
+    """Check the networks added in global_data, if there are any"""
+    added = global_data.get('networks') or []
+    for i, net in enumerate(added):
+        if not net.get('name'):
+            yield ConfigError(None, (), 'Network %d has no name' % i)
+        elif not _valid_vlan(net.get('vlan', 1)):
+            yield ConfigError(None, (), 'Invalid VLAN for network "%s": %r' %
+                              (net['name'], net['vlan']))
+    names = set()
+    lowers = set()
+    for net in _networks(global_data):
+        if net['name'] in names:
+            yield ConfigError(None, (), 'Duplicate network name found: "%s"'
+                              % net['name'])
+        elif net['lower'] in lowers:
+            yield ConfigError(None, (), 'Duplicate network name found: "%s"'
+                              % net['lower'])
+        names.add(net['name'])
+        lowers.add(net['lower'])
+
+def _network_settings_errors(global_data, index):
+    """Check every used network has the settings its templates need"""
+    for net in _networks(global_data):
+        used, vlan = _net_used_all(None, net['name'], index)
+        if not used:
+            continue
+        d = global_data.get(net['lower'])
+        if not isinstance(d, dict):
+            yield ConfigError(None, (), 'No settings found for the %s network'
+                              % net['name'])
+            continue
+        keys = NETWORK_SETTINGS.get(net['name'], ['cidr', 'start', 'end'])
+        for key in keys:
+            if key not in d:
+                yield ConfigError(None, (), 'No %s set for the %s network' %
+                                  (key, net['name']))
+        if vlan and net['name'] != 'ControlPlane':
+            if not _valid_vlan(d.get('vlan')):
+                yield ConfigError(None, (), 'Invalid VLAN for network "%s": '
+                                  '%r' % (net['name'], d.get('vlan')))
+
+def _duplicate_vlan_errors(global_data, index):
     seen = set()
-    for name, d in global_data.items():
+    for camel, d in _used_networks(global_data, index):
         try:
-            used = _net_used_all(data, _lower_to_camel(name))[0]
-            if d['vlan'] in seen and used:
-                raise RuntimeError('Duplicate VLAN found: %s' % d['vlan'])
-            if used:
-                seen.add(d['vlan'])
-        except (TypeError, KeyError, IndexError):
+            if d['vlan'] in seen:
+                yield ConfigError(None, (),
+                                  'Duplicate VLAN found: %s' % d['vlan'])
+            seen.add(d['vlan'])
+        except (TypeError, KeyError):
             pass
 
-def _check_duplicate_networks(data):
-    err_msg = 'Duplicate network assignment found: %s in %s'
-    for filename, d in data.items():
-        seen = set()
-        for i in d:
-            if 'network' not in i:
-                continue
-            if i['network'] in seen and i['network'] != 'None':
-                raise RuntimeError(err_msg % (i['network'], filename))
-            for j in i['members']:
-                if 'network' not in j:
-                    continue
-                if j['network'] in seen and j['network'] != 'None':
-                    raise RuntimeError(err_msg % (j['network'], filename))
-                seen.add(j['network'])
-            seen.add(i['network'])
-
-def _check_duplicate_bonds(data):
-    for filename, d in data.items():
-        seen = set()
-        for i in d:
-            if i['type'] != 'ovs_bridge':
-                continue
-            for j in i['members']:
-                if j['type'] != 'ovs_bond':
-                    continue
-                if j['name'] in seen:
-                    raise RuntimeError('Duplicate bond name "%s" found in '
-                                       '"%s"' %
-                                       (j['name'], filename))
-                seen.add(j['name'])
+def _used_networks(global_data, index):
+    """Yield (camel name, settings) for each used network with settings"""
+    seen = set()
+    for net in _networks(global_data):
+        d = global_data.get(net['lower'])
+        # Duplicate definitions are reported by _network_errors
+        if net['lower'] in seen:
+            continue
+        seen.add(net['lower'])
+        if d is not None and _net_used_all(None, net['name'], index)[0]:
+            yield net['name'], d
 
-def _check_duplicate_nics(data):
-    for filename, d in data.items():
-        seen = set()
-        def process_interfaces(d):
-            for i in d:
-                if i['type'] == 'interface':
-                    name = i['name']
-                    if name in seen:
-                        raise RuntimeError('Duplicate nic name: "%s"' % name)
-                    seen.add(name)
-                if 'members' in i:
-                    process_interfaces(i['members'])
-        process_interfaces(d)
-
-def _check_overlapping_cidrs(data, global_data):
-    cidrs = []
-    for name, d in global_data.items():
+def _used_cidrs(global_data, index):
+    """Yield (camel name, settings) for each used network with a CIDR"""
+    for camel, d in _used_networks(global_data, index):
         try:
-            cidr = d['cidr']
+            d['cidr']
         except (KeyError, TypeError):
             continue
-        camel = _lower_to_camel(name)
-        if _net_used_all(data, camel)[0]:
-            new_cidr = netaddr.IPNetwork(cidr)
-            if new_cidr in cidrs:
-                raise RuntimeError('Duplicate CIDR found: "%s"' % new_cidr)
-            cidrs.append(new_cidr)
-    for x, y in itertools.product(cidrs, cidrs):
-        if x == y:
-            # We checked for duplicate CIDRs above, and don't want to check a
-            # CIDR against itself.
-            continue
-        if x in y or y in x:
-            raise RuntimeError('Overlapping CIDRs detected: "%s" and "%s"' %
-                               (x, y))
+        yield camel, d
 
-def _validate_addr_in_cidr(ip, cidr, name):
-        if netaddr.IPAddress(ip) not in netaddr.IPNetwork(cidr):
-            raise RuntimeError('%s "%s" not in CIDR "%s"' % (name, ip, cidr))
+def _overlapping_cidr_errors(global_data, index):
+    """Find duplicate and overlapping CIDRs among the used networks
 
-def _check_ips_in_cidr(data, global_data):
-    for name, d in global_data.items():
-        try:
-            cidr = d['cidr']
-        except (KeyError, TypeError):
+    The CIDRs are sorted by version, first address and then widest first,
+    and swept in that order.  CIDRs are aligned blocks, so two of them either
+    don't overlap at all or one contains the other, which means a CIDR can
+    only overlap an earlier one if it falls within the block the sweep is
+    currently in.  Duplicates always end up next to each other.
+    """
+    def key(cidr):
+        return cidr.version, cidr.first, -cidr.last
+
+    cidrs = [_netaddr(netaddr.IPNetwork, d['cidr'])
+             for _, d in _used_cidrs(global_data, index)]
+    cidrs.sort(key=key)
+    previous = current = None
+    for cidr in cidrs:
+        if previous is not None and key(cidr) == key(previous):
+            yield ConfigError(None, (), 'Duplicate CIDR found: "%s"' % cidr)
+        elif (current is None or cidr.version != current.version or
+                cidr.first > current.last):
+            current = cidr
+        else:
+            yield ConfigError(None, (),
+                              'Overlapping CIDRs detected: "%s" and "%s"' %
+                              (current, cidr))
+        previous = cidr
+
+def _netaddr(cls, value):
+    """Return a cached cls(value), where cls is a netaddr class
+
+    A long-running process such as net-iso-batch.py --watch validates the
+    same addresses over and over, so they are only parsed once.  The objects
+    are shared, so they must never be modified in place.
+    """
+    key = (cls, value)
+    try:
+        return _NETADDR_CACHE[key]
+    except KeyError:
+        pass
+    if len(_NETADDR_CACHE) >= NETADDR_CACHE_SIZE:
+        _NETADDR_CACHE.clear()
+    result = _NETADDR_CACHE[key] = cls(value)
+    return result
+
+def _addr_in_cidr_error(ip, cidr, name):
+    if (_netaddr(netaddr.IPAddress, ip) not in
+            _netaddr(netaddr.IPNetwork, cidr)):
+        return ConfigError(None, (),
+                           '%s "%s" not in CIDR "%s"' % (name, ip, cidr))
+
+def _ips_in_cidr_errors(global_data, index):
+    for camel, d in _used_cidrs(global_data, index):
+        checks = [('start', '%s start'), ('end', '%s end'),
+                  ('gateway', '%s gateway')]
+        for key, name in checks:
+            if key not in d:
+                continue
+            error = _addr_in_cidr_error(d[key], d['cidr'], name % camel)
+            if error is not None:
+                yield error
+
+def _role_errors(data, global_data):
+    """Check the roles in global_data and those derived from data
+
+    Unlike the GLOBAL_RULES this needs data, because roles without a
+    definition get their names from their filenames and could clash.
+    """
+    missing = [i for i, role in enumerate(global_data.get('roles') or [])
+               if not role.get('filename')]
+    for i in missing:
+        yield ConfigError(None, (), 'Role %d has no filename' % i)
+    if missing:
+        return
+    filenames = set()
+    names = set()
+    for role in _roles(data, global_data):
+        if role['filename'] in filenames:
+            yield ConfigError(None, (), 'Duplicate role filename found: "%s"'
+                              % role['filename'])
+        if role['name'] in names:
+            yield ConfigError(None, (), 'Duplicate role name found: "%s"' %
+                              role['name'])
+        filenames.add(role['filename'])
+        names.add(role['name'])
+
+# Rules run by _find_config_errors, in the order their errors are reported.
+NODE_RULES = [_DuplicateNetworkRule,
+              _DuplicateBondRule,
+              _DuplicateNicRule,
+              _PrimaryInterfaceRule,
+              _BondMemberRule,
+              _BridgeMemberRule,
+              _VlanNetworkRule,
+              ]
+GLOBAL_RULES = [_network_errors,
+                _network_settings_errors,
+                _duplicate_vlan_errors,
+                _overlapping_cidr_errors,
+                _ips_in_cidr_errors,
+                ]
+
+def _find_config_errors(data, global_data, node_rules=None,
+                        global_rules=None):
+    """Validate data in a single pass over every node
+
+    Each node rule visits every node exactly once during the walk, and the
+    network usage index is built during the same walk for the global rules.
+
+    :returns: A tuple of a list of every ConfigError found, and the network
+              usage index for data.
+    """
+    if node_rules is None:
+        node_rules = NODE_RULES
+    if global_rules is None:
+        global_rules = GLOBAL_RULES
+    rules = [rule() for rule in node_rules]
+    errors = list(_role_errors(data, global_data))
+    for filename, node_data in data.items():
+        if not isinstance(node_data, list):
+            errors.append(ConfigError(filename, (), 'The nodes of %s are not '
+                                      'a list' % filename))
+    data = dict((filename, node_data) for filename, node_data in data.items()
+                if isinstance(node_data, list))
+    index = {}
+    # The walk visits the roles one at a time.  A role that turns out not to
+    # be structurally valid only reports its structure errors, so the rule
+    # errors and network usage found in it so far are dropped.
+    current = broken = role_index = marks = None
+    for role, path, node, parents in _walk_nodes(data):
+        if role != current:
+            if current is not None and not broken:
+                _merge_index(index, role_index)
+            current, broken, role_index = role, False, {}
+            marks = [len(rule.errors) for rule in rules]
+        structure = list(_structure_errors(role, path, node, parents))
+        if structure and not broken:
+            broken = True
+            for rule, mark in zip(rules, marks):
+                del rule.errors[mark:]
+        errors.extend(structure)
+        if broken:
             continue
-        camel = _lower_to_camel(name)
-        if _net_used_all(data, camel)[0]:
-            _validate_addr_in_cidr(d['start'], cidr, '%s start' % camel)
-            _validate_addr_in_cidr(d['end'], cidr, '%s end' % camel)
-            if 'gateway' in d:
-                _validate_addr_in_cidr(d['gateway'], cidr,
-                                       '%s gateway' % camel)
+        _index_node(role_index, role, len(path) - 1, node)
+        for rule in rules:
+            rule.visit(role, path, node, parents)
+    if current is not None and not broken:
+        _merge_index(index, role_index)
+    for rule in rules:
+        errors.extend(rule.errors)
+    for rule in global_rules:
+        errors.extend(rule(global_data, index))
+    return errors, index
+
+def _raise_errors(errors):
+    if errors:
+        raise RuntimeError('\n'.join(e.message for e in errors))
+
+def _validate_config(data, global_data):
+    """Raise a RuntimeError listing every problem in the config
+
+    :returns: The network usage index for data, which comes for free.
+    """
+    errors, index = _find_config_errors(data, global_data)
+    _raise_errors(errors)
+    return index
+
+class _Validator(object):
+    """Validate a config as it is edited, one role at a time
+
+    The node rule errors and network usage of each role are cached by
+    update, so after an edit only that role is walked again.  errors then
+    combines the cached results and runs the role and global rules, which
+    only look at global_data and the merged network usage index, so their
+    cost does not depend on the number of nodes.
+    """
+    def __init__(self):
+        self.roles = {}
+
+    def update(self, filename, node_data):
+        """Validate the nodes of a single role and cache the results"""
+        errors, index = _find_config_errors({filename: node_data}, {},
+                                            global_rules=[])
+        self.roles[filename] = ([e for e in errors if e.role == filename],
+                                index)
+
+    def remove(self, filename):
+        self.roles.pop(filename, None)
+
+    def errors(self, global_data):
+        """Return every ConfigError, as _find_config_errors would
+
+        :returns: A tuple of a list of every ConfigError found, and the network
+                  usage index for all the roles.
+        """
+        errors = list(_role_errors(dict.fromkeys(self.roles), global_data))
+        index = {}
+        for filename in sorted(self.roles):
+            role_errors, role_index = self.roles[filename]
+            errors.extend(role_errors)
+            _merge_index(index, role_index)
+        for rule in GLOBAL_RULES:
+            errors.extend(rule(global_data, index))
+        return errors, index
+
+def _check_duplicate_vlans(data, global_data, index=None):
+    if index is None:
+        index = _build_net_index(data)
+    _raise_errors(list(_duplicate_vlan_errors(global_data, index)))
+
+def _check_duplicate_networks(data):
+    _raise_errors(_find_config_errors(data, {}, [_DuplicateNetworkRule],
+                                      [])[0])
+
+def _check_duplicate_bonds(data):
+    _raise_errors(_find_config_errors(data, {}, [_DuplicateBondRule], [])[0])
+
+def _check_duplicate_nics(data):
+    _raise_errors(_find_config_errors(data, {}, [_DuplicateNicRule], [])[0])
+
+def _check_overlapping_cidrs(data, global_data, index=None):
+    if index is None:
+        index = _build_net_index(data)
+    _raise_errors(list(_overlapping_cidr_errors(global_data, index)))
+
+def _check_ips_in_cidr(data, global_data, index=None):
+    if index is None:
+        index = _build_net_index(data)
+    _raise_errors(list(_ips_in_cidr_errors(global_data, index)))
 
 def _check_primary_interfaces(data):
     """Validate that there is exactly one primary interface on a bond"""
-    multi_err = 'Found multiple primary interfaces on bond "%s"'
-    missing_err = 'Found no primary interface on bond "%s"'
-    def process_bond(m):
-        have_primary = False
-        for i in m['members']:
-            if i['type'] == 'interface':
-                if i['primary']:
-                    if have_primary:
-                        raise RuntimeError(multi_err % m['name'])
-                    have_primary = True
-        if not have_primary:
-            raise RuntimeError(missing_err % m['name'])
-
-    for filename, d in data.items():
-        for item in d:
-            if item['type'] == 'ovs_bridge':
-                for m in item['members']:
-                    if m['type'] == 'ovs_bond':
-                        process_bond(m)
+    _raise_errors(_find_config_errors(data, {}, [_PrimaryInterfaceRule],
+                                      [])[0])
 
 def _check_bridge_members(data):
     """Validate that there is exactly one bond/interface per bridge"""
-    multi_err = 'Found multiple bonds/interfaces on bridge "%s"'
-    missing_err = 'Found no interface or bond on bridge "%s"'
-    for filename, d in data.items():
-        for item in d:
-            if item['type'] == 'ovs_bridge':
-                have_one = False
-                for m in item['members']:
-                    if m['type'] == 'interface' or m['type'] == 'ovs_bond':
-                        if have_one:
-                            raise RuntimeError(multi_err % item['name'])
-                        have_one = True
-                if not have_one:
-                    raise RuntimeError(missing_err % item['name'])
+    _raise_errors(_find_config_errors(data, {}, [_BridgeMemberRule], [])[0])
 
 
+class _SettingsUnpickler(pickle.Unpickler):
+    """Unpickler that refuses to load anything but plain data
+
+    Settings pickles only ever contained dicts, lists, strings, numbers and
+    booleans, none of which need find_class.  Refusing everything else means
+    loading a pickle from a shared directory cannot run arbitrary code.
+    """
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError('Unexpected object %s.%s in settings' %
+                                     (module, name))
+
+def _load_legacy_settings(base_path):
+    with open(os.path.join(base_path, LEGACY_SETTINGS_FILE), 'rb') as f:
+        file_data = _SettingsUnpickler(io.BytesIO(f.read())).load()
+    global_data = file_data['global_data']
+    file_data['major'] = global_data.get('major', DATA_MAJOR)
+    file_data['minor'] = global_data.get('minor', DATA_MINOR)
+    return file_data
+
 def _load(base_path):
-    file_data = pickle.load(open(os.path.join(base_path,
-                                              'ui-settings.pickle'), 'rb'))
+    """Load the settings written by _write_settings from base_path
+
+    Settings pickles written by older versions of the tool are migrated
+    transparently if there is no json settings file.
+    """
+    settings_path = os.path.join(base_path, SETTINGS_FILE)
+    if os.path.exists(settings_path):
+        with open(settings_path) as f:
+            file_data = json.loads(f.read())
+    else:
+        file_data = _load_legacy_settings(base_path)
+    if file_data['major'] != DATA_MAJOR or file_data['minor'] > DATA_MINOR:
+        raise RuntimeError('Settings version %d.%d in "%s" is not compatible '
+                           'with current version %d.%d' %
+                           (file_data['major'], file_data['minor'],
+                            base_path, DATA_MAJOR, DATA_MINOR))
     nic_data = file_data['data']
     global_data = file_data['global_data']
     return nic_data, global_data
 
-def _index_from_filename(filename):
-    return [i[0] for i in TYPE_LIST if i[1] == filename][0]
+def _input_files(input_path):
+    """Return the files in input_path that _load_input reads
+
+    If there are none, the nic-input.json/global-input.json pair that would
+    be read once they exist is returned.
+    """
+    nic_file = os.path.join(input_path, 'nic-input.json')
+    global_file = os.path.join(input_path, 'global-input.json')
+    if os.path.exists(nic_file) and os.path.exists(global_file):
+        return [nic_file, global_file]
+    for name in (SETTINGS_FILE, LEGACY_SETTINGS_FILE):
+        if os.path.exists(os.path.join(input_path, name)):
+            return [os.path.join(input_path, name)]
+    return [nic_file, global_file]
+
+def _load_input(input_path):
+    """Load nic and global data from a directory
+
+    The directory may contain either a nic-input.json/global-input.json pair,
+    as used by the unit tests, or the settings written by a previous run of
+    the tool.  If both are present the input files win.
+    """
+    files = _input_files(input_path)
+    if len(files) == 2 and all(os.path.exists(f) for f in files):
+        with open(files[0]) as f:
+            data = json.loads(f.read())
+        with open(files[1]) as f:
+            global_data = json.loads(f.read())
+        for path, value in zip(files, (data, global_data)):
+            if not isinstance(value, dict):
+                raise RuntimeError('%s does not contain a JSON object' % path)
+        return data, global_data
+    if os.path.exists(files[0]):
+        return _load(input_path)
+    raise RuntimeError('No nic-input.json/global-input.json or %s found in '
+                       '"%s"' % (SETTINGS_FILE, input_path))
+
+def _output_dirs(input_paths, output_root=None):
+    """Return the output directory of each input to a batch tool
+
+    Each input is written to itself, or if output_root is passed to the
+    subdirectory of it named after the input.
+
+    :raises: RuntimeError if two inputs would be written to the same directory.
+    """
+    if output_root is None:
+        outputs = list(input_paths)
+    else:
+        outputs = [os.path.join(output_root,
+                                os.path.basename(os.path.normpath(path)))
+                   for path in input_paths]
+    if len(set(outputs)) != len(outputs):
+        raise RuntimeError('Multiple inputs would be written to the same '
+                           'output directory')
+    return outputs
+
+def _throughput(verb, done, total, seconds, noun):
+    """Return the summary line a batch tool prints once it has finished"""
+    return '%s %d of %d %s in %.2f s (%.1f %s/s)' % (
+        verb, done, total, noun, seconds,
+        total / seconds if seconds else 0.0, noun)
+
+def _input_hash(*inputs):
+    """Return a hash of the canonical json form of inputs"""
+    canonical = json.dumps(inputs, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+def _output_hashes(data, global_data, index):
+    """Hash the inputs that affect each generated file
+
+    :returns: A dict mapping each output path, relative to the output
+              directory, to a hash of everything that file is generated from.
+    """
+    version = global_data.get('version', 1)
+    auto_routes = global_data.get('auto_routes', True)
+    ipv6 = global_data.get('ipv6', False)
+    trim = global_data.get('trim_nic_params', False)
+    vlans = dict((name, entry['vlan']) for name, entry in index.items())
+    roles = dict((name, sorted(entry['roles']))
+                 for name, entry in index.items())
+    netenv_global = dict((k, v) for k, v in global_data.items()
+                         if k not in NON_NETENV_KEYS)
+    role_list = _roles(data, global_data)
+    networks = _networks(global_data)
+    templates = _nic_templates(data, global_data)
+
+    hashes = {}
+    hashes['README'] = _input_hash(README)
+    hashes[SETTINGS_FILE] = _input_hash(data, global_data)
+    for filename, node_data in data.items():
+        if templates[filename] != filename:
+            continue
+        hashes[os.path.join('nic-configs', filename)] = _input_hash(
+            filename, node_data, version, auto_routes, networks, trim)
+    hashes['network-environment.yaml'] = _input_hash(vlans, netenv_global,
+                                                     role_list, templates)
+    for filename, template_path in [
+            ('network-isolation.yaml', '..'),
+            ('network-isolation-absolute.yaml', ABSOLUTE_TEMPLATE_PATH)]:
+        hashes[filename] = _input_hash(roles, ipv6, template_path, role_list,
+                                       networks)
+    if global_data.get('node_counts'):
+        for filename, template_path in [
+                (IPS_FROM_POOL, '..'),
+                (IPS_FROM_POOL_ABSOLUTE, ABSOLUTE_TEMPLATE_PATH)]:
+            hashes[filename] = _input_hash(roles, ipv6, template_path,
+                                           role_list, netenv_global,
+                                           global_data['node_counts'])
+    return hashes
+
+def _load_manifest(base_path):
+    """Return the outputs recorded by the last _generate run
+
+    :returns: A dict mapping each output path, relative to base_path, to a
+              list of the hash of its inputs and its size and modification
+              time once written, see _output_stat.
+    """
+    try:
+        with open(os.path.join(base_path, MANIFEST)) as f:
+            manifest = json.loads(f.read())
+    except (EnvironmentError, ValueError):
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    return manifest.get('files', {})
+
+def _write_manifest(base_path, files, staged=None):
+    with _output_file(os.path.join(base_path, MANIFEST), staged) as f:
+        f.write(json.dumps({'version': MANIFEST_VERSION, 'files': files},
+                           indent=2, sort_keys=True))
+        f.write('\n')
+
+def _output_stat(path):
+    """Return the size and modification time of a file, or None if missing
+
+    Recorded in the manifest so that a generated file that has been edited
+    or damaged since is written again, even though its inputs are the same.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime]
+
+def _generate(data, global_data, base_path, force=False, workers=1,
+              stats=None, profile=None, progress=None, cancel=None):
+    """Validate data and write the full set of templates to base_path
+
+    This is everything the Generate button in the UI does, without any
+    dependency on Qt.
+
+    A manifest of hashes of the inputs to each file is kept in base_path, and
+    files whose inputs have not changed since the last run are neither
+    regenerated nor rewritten.  The size and modification time of each file
+    are recorded too, so a file changed by anything else is rewritten.
+
+    Each file is written to a temporary file next to it, and only once every
+    file has been written are they renamed over the old ones, see
+    _output_file.  An error part way through therefore leaves base_path
+    untouched, and readers never see a partially written template.  The
+    renames are done one file at a time though, so while they are being done
+    a reader can see a mix of old and new templates, see _commit_output.
+    Nothing else in base_path is touched.
+
+    :param force: Regenerate every file even if its inputs are unchanged.
+    :param workers: Number of processes to write the nic configs with.
+    :param stats: A _Stats to record the time taken by each stage in.
+    :param profile: Path to write cProfile stats for the whole run to.  The
+                    nic configs are then written in this process, whatever
+                    workers is, so that they are included.
+    :param progress: Called as progress(done, total, path) after each file is
+                     written, where path is relative to base_path.
+    :param cancel: A threading.Event.  If it is set, _Cancelled is raised
+                   after the file being written and base_path is untouched.
+    :returns: A list of the files that were written, relative to base_path.
+    """
+    if profile:
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(_generate, data, global_data, base_path,
+                                    force, 1, stats, None, progress, cancel)
+        finally:
+            profiler.dump_stats(profile)
+    if stats is None:
+        stats = _Stats()
+
+    with stats.time('validate'):
+        index = _validate_config(data, global_data)
+        if global_data.get('node_counts'):
+            # Fail before anything is written if the pools are too small
+            _plan_ips(data, global_data, index)
+
+    with stats.time('hash'):
+        hashes = _output_hashes(data, global_data, index)
+        previous = _load_manifest(base_path)
+    old = {} if force else previous
+    stale = set(path for path, value in hashes.items()
+                if path not in old or old[path][0] != value or
+                old[path][1:] != _output_stat(os.path.join(base_path, path)))
+    if not stale and set(old) == set(hashes):
+        return []
+    if 'README' in stale or SETTINGS_FILE in stale:
+        # These are always written together
+        stale.update(['README', SETTINGS_FILE])
+
+    nic_path = os.path.join(base_path, 'nic-configs')
+    if not os.path.isdir(nic_path):
+        os.makedirs(nic_path)
+
+    staged = []
+    written = []
+    def step(path):
+        written.append(path)
+        if progress is not None:
+            progress(len(written), len(stale), path)
+        if cancel is not None and cancel.is_set():
+            raise _Cancelled('Generation was cancelled')
+
+    def write(path, func, *args, **kwargs):
+        if path not in stale:
+            return
+        with stats.time('write', path):
+            func(*args, staged=staged, **kwargs)
+        stats.add('write', path, bytes_written=os.path.getsize(
+            _temp_path(os.path.join(base_path, path))))
+        step(path)
+
+    try:
+        write(SETTINGS_FILE, _write_settings, data, global_data, base_path)
+        if 'README' in stale:
+            # Written along with the settings
+            step('README')
+        nic_data = dict((filename, node_data)
+                        for filename, node_data in data.items()
+                        if os.path.join('nic-configs', filename) in stale)
+        if nic_data:
+            _write_nic_configs(nic_data, global_data, base_path, workers,
+                               stats, step, staged)
+        write('network-environment.yaml', _write_net_env, data, global_data,
+              base_path, index)
+        write('network-isolation.yaml', _write_net_iso, data, global_data,
+              base_path, index=index)
+        write('network-isolation-absolute.yaml', _write_net_iso, data,
+              global_data, base_path,
+              filename='network-isolation-absolute.yaml',
+              template_path=ABSOLUTE_TEMPLATE_PATH, index=index)
+        write(IPS_FROM_POOL, _write_ips_from_pool, data, global_data,
+              base_path, index=index)
+        write(IPS_FROM_POOL_ABSOLUTE, _write_ips_from_pool, data, global_data,
+              base_path, filename=IPS_FROM_POOL_ABSOLUTE,
+              template_path=ABSOLUTE_TEMPLATE_PATH, index=index)
+        with stats.time('write'):
+            # Renaming the files into place keeps their modification times
+            files = {}
+            for path, value in hashes.items():
+                full_path = os.path.join(base_path, path)
+                files[path] = [value] + (
+                    _output_stat(_temp_path(full_path)) if path in stale
+                    else previous[path][1:])
+            _write_manifest(base_path, files, staged)
+            _commit_output(staged)
+    except BaseException:
+        _discard_output(os.path.join(base_path, path)
+                        for path in list(stale) + [MANIFEST])
+        raise
+    with stats.time('write'):
+        if SETTINGS_FILE in stale:
+            _remove_legacy_settings(base_path)
+        # Files from the last run that are no longer generated at all, such
+        # as the nic-configs of roles that now share a template
+        for path in set(previous) - set(hashes):
+            try:
+                os.unlink(os.path.join(base_path, path))
+            except OSError:
+                pass
+    return sorted(stale)
+
+def _render(data, global_data, index, workers=1, stats=None):
+    """Return the contents of every template _generate would write
+
+    The README, settings and manifest are not templates, so are left out.
+
+    :param index: network usage index from _validate_config.
+    :returns: A dict mapping the path of each template, relative to the
+              output directory, to its contents.
+    """
+    outputs = dict((os.path.join('nic-configs', filename), content)
+                   for filename, content in _render_nic_configs(
+                       data, global_data, workers, stats).items())
+    outputs['network-environment.yaml'] = _render_net_env(data, global_data,
+                                                          index)
+    outputs['network-isolation.yaml'] = _render_net_iso(data, global_data,
+                                                        index=index)
+    outputs['network-isolation-absolute.yaml'] = _render_net_iso(
+        data, global_data, ABSOLUTE_TEMPLATE_PATH, index)
+    if global_data.get('node_counts'):
+        outputs[IPS_FROM_POOL] = _render_ips_from_pool(data, global_data,
+                                                       index=index)
+        outputs[IPS_FROM_POOL_ABSOLUTE] = _render_ips_from_pool(
+            data, global_data, ABSOLUTE_TEMPLATE_PATH, index)
+    return outputs
+
+def _diff(data, global_data, base_path, workers=1, stats=None):
+    """Compare the templates _generate would write with those in base_path
+
+    Nothing is written.  Every template is rendered in memory and hashed,
+    and only those whose hash differs from that of the existing file are
+    diffed.  Templates from the last run into base_path that would no longer
+    be generated, such as the nic-configs of roles that now share a
+    template, are diffed against nothing.
+
+    :param workers: Number of processes to render the nic configs with.
+    :param stats: A _Stats to record the time taken by each stage in.
+    :returns: A list of (path, unified diff lines) for each template that
+              differs, sorted by path, which is relative to base_path.
+    """
+    if stats is None:
+        stats = _Stats()
+    with stats.time('validate'):
+        index = _validate_config(data, global_data)
+    outputs = _render(data, global_data, index, workers, stats)
+    with stats.time('hash'):
+        removed = (set(_load_manifest(base_path)) -
+                   set(_output_hashes(data, global_data, index)))
+    diffs = []
+    with stats.time('diff'):
+        for path in sorted(set(outputs) | removed):
+            new = outputs.get(path, '').encode('utf-8')
+            try:
+                with open(os.path.join(base_path, path), 'rb') as f:
+                    old = f.read()
+            except EnvironmentError:
+                old = None
+            if (old is not None and
+                    hashlib.sha1(old).digest() == hashlib.sha1(new).digest()):
+                continue
+            lines = list(difflib.unified_diff(
+                [] if old is None else
+                old.decode('utf-8').splitlines(True),
+                new.decode('utf-8').splitlines(True),
+                '/dev/null' if old is None else 'a/' + path,
+                '/dev/null' if path not in outputs else 'b/' + path))
+            diffs.append((path, lines))
+    return diffs
+
+def _network(network):
+    """Fill in the defaults for a network definition
+
+    Only 'name' is required.  'lower' is derived from it, so the network
+    called StorageNfs is storage_nfs.
+    """
+    name = network['name']
+    lower = network.get('lower') or ''.join(
+        '_' + c.lower() if c.isupper() and i else c.lower()
+        for i, c in enumerate(name))
+    return {'name': name,
+            'lower': lower,
+            'vlan': network.get('vlan', 1),
+            'vlan_label': network.get('vlan_label') or lower,
+            'comment': network.get('comment'),
+            }
+
+def _networks(global_data=None):
+    """Return every defined network, in order
+
+    These are the NETWORKS followed by any in global_data['networks'].  Added
+    networks without a name or with an invalid VLAN are skipped, validation
+    reports them.
+    """
+    added = (global_data or {}).get('networks') or []
+    return ([_network(n) for n in NETWORKS] +
+            [_network(n) for n in added
+             if n.get('name') and _valid_vlan(n.get('vlan', 1))])
+
+def _valid_vlan(vlan):
+    return isinstance(vlan, int) and not isinstance(vlan, bool)
+
+def _role(role):
+    """Fill in the defaults for a role definition
+
+    Only 'filename' is required.  The other names are derived from it, so
+    the role for custom-role.yaml is called CustomRole.
+    """
+    stem = os.path.splitext(role['filename'])[0]
+    name = role.get('name') or ''.join(
+        w.capitalize() for w in stem.replace('_', '-').split('-'))
+    return {'filename': role['filename'],
+            'name': name,
+            'ports': role.get('ports') or name,
+            'ips': role.get('ips') or name + 'IPs',
+            'label': role.get('label') or name,
+            }
+
+def _roles(data=None, global_data=None):
+    """Return the roles to generate, in order
+
+    global_data['roles'] replaces ROLES if it is set.  Any role with nic-config
+    data that is not in the list is added to the end, with derived names.
+    """
+    roles = [_role(r) for r in (global_data or {}).get('roles') or ROLES]
+    known = set(r['filename'] for r in roles)
+    roles.extend(_role({'filename': filename})
+                 for filename in sorted(data or {}) if filename not in known)
+    return roles
+
+def _registry_roles(data=None, global_data=None):
+    """Return the roles in the order of their resource_registry entries
+
+    This is the order of _roles, except that without global_data['roles'] the
+    default roles come first, in REGISTRY_ORDER.
+    """
+    roles = _roles(data, global_data)
+    if (global_data or {}).get('roles'):
+        return roles
+    order = dict((filename, i) for i, filename in enumerate(REGISTRY_ORDER))
+    return sorted(roles, key=lambda r: order.get(r['filename'], len(order)))
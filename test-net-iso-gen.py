@@ -13,12 +13,20 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import copy
 import json
 import os
+import re
 import shutil
 import tempfile
+import threading
 import unittest
 
+import netaddr
+import yaml
+
+import net_history
+import net_import
 import net_processing
 
 class TestOutput(unittest.TestCase):
@@ -31,11 +39,11 @@ class TestOutput(unittest.TestCase):
             data = json.loads(f.read())
         with open(os.path.join(input_path, 'global-input.json')) as f:
             global_data = json.loads(f.read())
-        net_processing._write_pickle(data, global_data, self.output_path)
+        net_processing._write_settings(data, global_data, self.output_path)
         self.assertTrue(os.path.exists(os.path.join(self.output_path,
                                                     'README')))
         self.assertTrue(os.path.exists(os.path.join(self.output_path,
-                                                    'ui-settings.pickle')))
+                                                    'ui-settings.json')))
         net_processing._write_net_env(data, global_data, self.output_path)
         with open(os.path.join(self.output_path,
                                'network-environment.yaml')) as actual:
@@ -82,6 +90,795 @@ class TestOutput(unittest.TestCase):
     def test_ovs_dpdk(self):
         self._test('test-data/ovs-dpdk')
 
+    def test_write_resources(self):
+        # Values the direct writer has to leave to PyYAML's emitter
+        self.output_path = tempfile.mkdtemp()
+        network_config = [
+            {'type': 'ovs_bridge', 'name': 'br-ex', 'use_dhcp': False,
+             'members': [{'type': 'interface', 'name': 'nic1',
+                          'primary': True}, []],
+             'addresses': [{'ip_netmask': '{get_param: ExternalIpSubnet}'}],
+             'mtu': 1500, '1': 'true', 'empty': {}},
+            {'type': 'interface', 'name': u'n\xefc2'},
+            {'type': 'interface', 'name': 'a long name ' * 8},
+            {'type': 'interface', 'name': '{get_param: Not a name}'},
+            {'type': 'interface', 'name': "it's\nquoted"},
+        ]
+        for i in range(len(network_config) + 1):
+            expected = net_processing._Chunks()
+            net_processing._emit_resources(expected,
+                                           net_processing.BASE_RESOURCE_2,
+                                           network_config[:i])
+            actual = net_processing._Chunks()
+            net_processing._write_resources(actual,
+                                            net_processing.BASE_RESOURCE_2,
+                                            network_config[:i])
+            self.assertEqual(''.join(expected), ''.join(actual))
+
+class TestGenerate(unittest.TestCase):
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+        self.output_path = os.path.join(self.tmp_path, 'templates')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def _assert_matches(self, input_path):
+        for f in ['network-environment.yaml', 'network-isolation.yaml',
+                  'network-isolation-absolute.yaml']:
+            with open(os.path.join(self.output_path, f)) as actual:
+                with open(os.path.join(input_path, f)) as expected:
+                    self.assertEqual(expected.read(), actual.read())
+        opath = os.path.join(self.output_path, 'nic-configs')
+        for f in os.listdir(opath):
+            with open(os.path.join(opath, f)) as actual:
+                with open(os.path.join(input_path,
+                                       'nic-configs', f)) as expected:
+                    self.assertEqual(expected.read(), actual.read())
+
+    def test_generate(self):
+        input_path = 'test-data/all-the-things-v2'
+        data, global_data = net_processing._load_input(input_path)
+        net_processing._generate(data, global_data, self.output_path)
+        self.assertTrue(os.path.exists(os.path.join(self.output_path,
+                                                    'ui-settings.json')))
+        self._assert_matches(input_path)
+
+    def test_write_leaves_input(self):
+        os.mkdir(self.output_path)
+        for name in ['all-the-things', 'all-the-things-v2', 'ovs-dpdk']:
+            data, global_data = net_processing._load_input(
+                os.path.join('test-data', name))
+            original = copy.deepcopy((data, global_data))
+            net_processing._write_nic_configs(data, global_data,
+                                              self.output_path)
+            self.assertEqual(original, (data, global_data))
+
+    def test_generate_parallel(self):
+        input_path = 'test-data/all-the-things-v2'
+        data, global_data = net_processing._load_input(input_path)
+        net_processing._generate(data, global_data, self.output_path,
+                                 workers=3)
+        self._assert_matches(input_path)
+
+    def test_generate_stats(self):
+        input_path = 'test-data/all-the-things-v2'
+        data, global_data = net_processing._load_input(input_path)
+        stats = net_processing._Stats()
+        profile = os.path.join(self.tmp_path, 'generate.prof')
+        written = net_processing._generate(data, global_data,
+                                           self.output_path, stats=stats,
+                                           profile=profile)
+        self._assert_matches(input_path)
+        self.assertEqual(['validate', 'hash', 'process', 'serialize',
+                          'write'], list(stats.stages()))
+        self.assertEqual(len(data), stats.stages()['process'][1])
+        for path in written:
+            if path == 'README':
+                continue
+            self.assertEqual(
+                os.path.getsize(os.path.join(self.output_path, path)),
+                stats.entries[('write', path)][2])
+        self.assertTrue(os.path.getsize(profile))
+
+    def test_generate_progress(self):
+        input_path = 'test-data/all-the-things-v2'
+        data, global_data = net_processing._load_input(input_path)
+        calls = []
+        written = net_processing._generate(
+            data, global_data, self.output_path, workers=3,
+            progress=lambda *args: calls.append(args))
+        self.assertEqual(sorted(written), sorted(c[2] for c in calls))
+        self.assertEqual([(i + 1, len(written)) for i in range(len(calls))],
+                         [c[:2] for c in calls])
+
+        cancel = threading.Event()
+        def progress(done, total, path):
+            if path.startswith('nic-configs'):
+                cancel.set()
+        global_data['storage']['vlan'] = 33
+        self.assertRaises(net_processing._Cancelled, net_processing._generate,
+                          data, global_data, self.output_path, force=True,
+                          workers=3, progress=progress, cancel=cancel)
+        self.assertEqual(['templates'], os.listdir(self.tmp_path))
+        for root, dirs, files in os.walk(self.output_path):
+            self.assertEqual([], [f for f in files if f.endswith('.tmp')])
+        global_data['storage']['vlan'] = 3
+        self.assertEqual([], net_processing._diff(data, global_data,
+                                                  self.output_path))
+
+    def test_diff(self):
+        input_path = 'test-data/all-the-things-v2'
+        data, global_data = net_processing._load_input(input_path)
+        net_processing._generate(data, global_data, self.output_path)
+        self.assertEqual([], net_processing._diff(data, global_data,
+                                                  self.output_path))
+
+        global_data['storage']['vlan'] = 33
+        global_data['dedup_nic_configs'] = True
+        data['compute-2.yaml'] = data['compute.yaml']
+        before = os.listdir(self.output_path)
+        diffs = dict(net_processing._diff(data, global_data,
+                                          self.output_path))
+        self.assertEqual(before, os.listdir(self.output_path))
+        self.assertEqual(['network-environment.yaml'], list(diffs))
+        self.assertIn('-  StorageNetworkVlanID: 3\n',
+                      diffs['network-environment.yaml'])
+        self.assertIn('+  StorageNetworkVlanID: 33\n',
+                      diffs['network-environment.yaml'])
+        self.assertIn('+  OS::TripleO::Compute2::Net::SoftwareConfig: '
+                      'nic-configs/compute.yaml\n',
+                      diffs['network-environment.yaml'])
+
+        global_data['dedup_nic_configs'] = False
+        net_processing._generate(data, global_data, self.output_path)
+        global_data['dedup_nic_configs'] = True
+        diffs = dict(net_processing._diff(data, global_data,
+                                          self.output_path))
+        self.assertEqual(['network-environment.yaml',
+                          'nic-configs/compute-2.yaml'], sorted(diffs))
+        self.assertEqual('+++ /dev/null\n',
+                         diffs['nic-configs/compute-2.yaml'][1])
+
+    def test_trim_nic_params(self):
+        input_path = 'test-data/all-the-things-v2'
+        data, global_data = net_processing._load_input(input_path)
+        net_processing._generate(data, global_data, self.output_path)
+        full = net_processing._render_nic_configs(data, global_data)
+        global_data['trim_nic_params'] = True
+        trimmed = net_processing._render_nic_configs(data, global_data)
+        diffs = dict(net_processing._diff(data, global_data,
+                                          self.output_path))
+        # The controller uses every network, so nothing is trimmed from it
+        self.assertEqual(full['controller.yaml'], trimmed['controller.yaml'])
+        self.assertEqual(sorted(os.path.join('nic-configs', f)
+                                for f in data if f != 'controller.yaml'),
+                         sorted(diffs))
+
+        for filename in data:
+            full_params = yaml.safe_load(full[filename])['parameters']
+            params = yaml.safe_load(trimmed[filename])['parameters']
+            used = set(re.findall(r'get_param: \[?(\w+)', trimmed[filename]))
+            self.assertLessEqual(used, set(params))
+            for name in full_params:
+                if (name.endswith('IpSubnet') or
+                        name.startswith('ControlPlane')):
+                    self.assertEqual(full_params[name], params[name])
+            for network in ['Storage', 'Tenant']:
+                self.assertEqual(network + 'IpSubnet' in used,
+                                 network + 'NetworkVlanID' in params)
+                self.assertEqual(network + 'IpSubnet' in used,
+                                 network + 'Mtu' in params)
+            self.assertEqual(
+                full[filename].split('\nresources:')[1],
+                trimmed[filename].split('\nresources:')[1])
+
+    def test_input_files(self):
+        input_path = 'test-data/all-the-things-v2'
+        self.assertEqual([os.path.join(input_path, 'nic-input.json'),
+                          os.path.join(input_path, 'global-input.json')],
+                         net_processing._input_files(input_path))
+        data, global_data = net_processing._load_input(input_path)
+        net_processing._generate(data, global_data, self.output_path)
+        self.assertEqual([os.path.join(self.output_path, 'ui-settings.json')],
+                         net_processing._input_files(self.output_path))
+        self.assertEqual((data, global_data),
+                         net_processing._load_input(self.output_path))
+
+    def test_generate_custom_roles(self):
+        data, global_data = net_processing._load_input(
+            'test-data/all-the-things-v2')
+        data['block-storage.yaml'] = data['cinder-storage.yaml']
+        global_data['roles'] = [{'filename': 'controller.yaml'},
+                                {'filename': 'cinder-storage.yaml',
+                                 'name': 'Cinder'}]
+        net_processing._generate(data, global_data, self.output_path)
+        with open(os.path.join(self.output_path,
+                               'network-environment.yaml')) as f:
+            registry = [l.split()[0] for l in f if 'SoftwareConfig' in l]
+        self.assertEqual(['OS::TripleO::Controller::Net::SoftwareConfig:',
+                          'OS::TripleO::Cinder::Net::SoftwareConfig:',
+                          'OS::TripleO::BlockStorage::Net::SoftwareConfig:',
+                          'OS::TripleO::CephStorage::Net::SoftwareConfig:',
+                          'OS::TripleO::Compute::Net::SoftwareConfig:',
+                          'OS::TripleO::SwiftStorage::Net::SoftwareConfig:'],
+                         registry)
+        with open(os.path.join(self.output_path,
+                               'network-isolation.yaml')) as f:
+            net_iso = f.read()
+        self.assertIn('OS::TripleO::Cinder::Ports::ExternalPort', net_iso)
+        self.assertIn('OS::TripleO::BlockStorage::Ports::ExternalPort',
+                      net_iso)
+
+    def test_generate_custom_networks(self):
+        data, global_data = net_processing._load_input(
+            'test-data/all-the-things-v2')
+        nfs = dict(data['controller.yaml'][1]['members'][3],
+                   network='StorageNfs')
+        data['controller.yaml'][1]['members'].insert(4, nfs)
+        global_data['networks'] = [{'name': 'StorageNfs', 'vlan': 70,
+                                    'comment': 'Only 100% used by NFS'}]
+        global_data['storage_nfs'] = {'cidr': '172.22.0.0/24',
+                                      'start': '172.22.0.10',
+                                      'end': '172.22.0.250',
+                                      'vlan': 7}
+        net_processing._generate(data, global_data, self.output_path)
+        with open(os.path.join(self.output_path, 'nic-configs',
+                               'compute.yaml')) as f:
+            template = f.read()
+        self.assertIn('  StorageNfsIpSubnet: # Only 100% used by NFS\n',
+                      template)
+        params = yaml.safe_load(template)['parameters']
+        self.assertEqual(70, params['StorageNfsNetworkVlanID']['default'])
+        self.assertIn('StorageNfsIpSubnet', params)
+        with open(os.path.join(self.output_path,
+                               'network-environment.yaml')) as f:
+            net_env = yaml.safe_load(f)['parameter_defaults']
+        self.assertEqual('172.22.0.0/24', net_env['StorageNfsNetCidr'])
+        self.assertEqual(7, net_env['StorageNfsNetworkVlanID'])
+        with open(os.path.join(self.output_path,
+                               'network-isolation.yaml')) as f:
+            registry = yaml.safe_load(f)['resource_registry']
+        self.assertEqual('../network/ports/storage_nfs.yaml',
+                         registry['OS::TripleO::Controller::Ports::'
+                                  'StorageNfsPort'])
+
+    def test_generate_dedup(self):
+        data, global_data = net_processing._load_input(
+            'test-data/all-the-things-v2')
+        data['swift-storage.yaml'] = copy.deepcopy(data['ceph-storage.yaml'])
+        data['compute.yaml'] = copy.deepcopy(data['controller.yaml'])
+        nic_path = os.path.join(self.output_path, 'nic-configs')
+        net_processing._generate(data, global_data, self.output_path)
+        self.assertIn('swift-storage.yaml', os.listdir(nic_path))
+
+        global_data['dedup_nic_configs'] = True
+        net_processing._generate(data, global_data, self.output_path)
+        self.assertEqual(['ceph-storage.yaml', 'cinder-storage.yaml',
+                          'compute.yaml', 'controller.yaml'],
+                         sorted(os.listdir(nic_path)))
+        with open(os.path.join(self.output_path,
+                               'network-environment.yaml')) as f:
+            registry = yaml.safe_load(f)['resource_registry']
+        self.assertEqual('nic-configs/ceph-storage.yaml',
+                         registry['OS::TripleO::ObjectStorage::Net::'
+                                  'SoftwareConfig'])
+        self.assertEqual('nic-configs/compute.yaml',
+                         registry['OS::TripleO::Compute::Net::'
+                                  'SoftwareConfig'])
+
+    def test_generate_incremental(self):
+        input_path = 'test-data/all-the-things-v2'
+        data, global_data = net_processing._load_input(input_path)
+        written = net_processing._generate(data, global_data,
+                                           self.output_path)
+        self.assertIn('network-environment.yaml', written)
+        self.assertIn(os.path.join('nic-configs', 'compute.yaml'), written)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.output_path, net_processing.MANIFEST)))
+
+        self.assertEqual([], net_processing._generate(data, global_data,
+                                                      self.output_path))
+
+        data['compute.yaml'][0]['mtu'] = 9000
+        written = net_processing._generate(data, global_data,
+                                           self.output_path)
+        self.assertEqual(['README', os.path.join('nic-configs', 'compute.yaml'),
+                          'ui-settings.json'], written)
+
+        os.remove(os.path.join(self.output_path, 'network-isolation.yaml'))
+        written = net_processing._generate(data, global_data,
+                                           self.output_path)
+        self.assertEqual(['network-isolation.yaml'], written)
+
+        compute = os.path.join(self.output_path, 'nic-configs', 'compute.yaml')
+        with open(compute) as f:
+            expected = f.read()
+        with open(compute, 'a') as f:
+            f.write('# edited by hand\n')
+        written = net_processing._generate(data, global_data,
+                                           self.output_path)
+        self.assertEqual([os.path.join('nic-configs', 'compute.yaml')],
+                         written)
+        with open(compute) as f:
+            self.assertEqual(expected, f.read())
+
+        written = net_processing._generate(data, global_data,
+                                           self.output_path, force=True)
+        self.assertIn('network-environment.yaml', written)
+        self.assertIn(os.path.join('nic-configs', 'controller.yaml'), written)
+
+    def test_generate_preserves_unchanged(self):
+        data, global_data = net_processing._load_input(
+            'test-data/all-the-things-v2')
+        net_processing._generate(data, global_data, self.output_path)
+        net_env = os.path.join(self.output_path, 'network-environment.yaml')
+        before = os.stat(net_env)
+        data['compute.yaml'][0]['mtu'] = 9000
+        net_processing._generate(data, global_data, self.output_path)
+        after = os.stat(net_env)
+        self.assertEqual(before.st_ino, after.st_ino)
+        self.assertEqual(before.st_mtime, after.st_mtime)
+        self.assertEqual(['templates'], os.listdir(self.tmp_path))
+
+    def test_generate_in_place(self):
+        data, global_data = net_processing._load_input(
+            'test-data/all-the-things-v2')
+        os.mkdir(self.output_path)
+        os.chmod(self.output_path, 0o750)
+        other = os.path.join(self.output_path, 'my-notes.txt')
+        with open(other, 'w') as f:
+            f.write('notes')
+        before = os.stat(self.output_path)
+        net_processing._generate(data, global_data, self.output_path)
+        data['compute.yaml'][0]['mtu'] = 9000
+        net_processing._generate(data, global_data, self.output_path)
+        after = os.stat(self.output_path)
+        self.assertEqual(before.st_ino, after.st_ino)
+        self.assertEqual(0o750, after.st_mode & 0o777)
+        with open(other) as f:
+            self.assertEqual('notes', f.read())
+        self.assertEqual([], [f for f in os.listdir(self.output_path)
+                              if f.endswith('.tmp')])
+
+    def test_generate_error_leaves_output(self):
+        input_path = 'test-data/all-the-things-v2'
+        data, global_data = net_processing._load_input(input_path)
+        net_processing._generate(data, global_data, self.output_path)
+
+        def fail(*args, **kwargs):
+            raise RuntimeError('Failed part way through')
+        original = net_processing._write_net_env
+        net_processing._write_net_env = fail
+        try:
+            self.assertRaises(RuntimeError, net_processing._generate,
+                              data, global_data, self.output_path, True)
+        finally:
+            net_processing._write_net_env = original
+        self._assert_matches(input_path)
+        self.assertEqual(['templates'], os.listdir(self.tmp_path))
+        for root, dirs, files in os.walk(self.output_path):
+            self.assertEqual([], [f for f in files if f.endswith('.tmp')])
+
+    def test_generate_invalid(self):
+        data, global_data = net_processing._load_input(
+            'test-data/duplicate-vlans')
+        self.assertRaises(RuntimeError, net_processing._generate,
+                          data, global_data, self.output_path)
+
+    def test_load_input_missing(self):
+        self.assertRaises(RuntimeError, net_processing._load_input,
+                          self.output_path)
+
+class TestSettings(unittest.TestCase):
+    def setUp(self):
+        self.output_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_path)
+
+    def _load_json(self, input_path):
+        with open(os.path.join(input_path, 'nic-input.json')) as f:
+            data = json.loads(f.read())
+        with open(os.path.join(input_path, 'global-input.json')) as f:
+            global_data = json.loads(f.read())
+        return data, global_data
+
+    def test_round_trip(self):
+        data, global_data = self._load_json('test-data/all-the-things')
+        net_processing._write_settings(data, global_data, self.output_path)
+        self.assertEqual((data, global_data),
+                         net_processing._load(self.output_path))
+
+    def test_load_legacy_pickle(self):
+        input_path = 'test-data/ovs-dpdk'
+        self.assertEqual(self._load_json(input_path),
+                         net_processing._load(input_path))
+
+    def test_write_removes_pickle(self):
+        input_path = 'test-data/ovs-dpdk'
+        shutil.copy(os.path.join(input_path, 'ui-settings.pickle'),
+                    self.output_path)
+        data, global_data = net_processing._load(self.output_path)
+        net_processing._write_settings(data, global_data, self.output_path)
+        self.assertEqual(['README', 'ui-settings.json'],
+                         sorted(os.listdir(self.output_path)))
+
+    def test_load_unsafe_pickle(self):
+        with open(os.path.join(self.output_path,
+                               'ui-settings.pickle'), 'wb') as f:
+            f.write(b"cos\nsystem\n(S'true'\ntR.")
+        self.assertRaises(Exception, net_processing._load, self.output_path)
+
+    def test_load_newer_version(self):
+        data, global_data = self._load_json('test-data/all-the-things')
+        global_data['minor'] = net_processing.DATA_MINOR + 1
+        net_processing._write_settings(data, global_data, self.output_path)
+        self.assertRaises(RuntimeError, net_processing._load,
+                          self.output_path)
+
+class TestPlanIps(unittest.TestCase):
+    def setUp(self):
+        self.data, self.global_data = net_processing._load_input(
+            'test-data/ipv6-multi')
+        self.data['compute.yaml'] = self.data['controller.yaml']
+
+    def test_plan(self):
+        self.global_data['node_counts'] = {'Controller': 3, 'Compute': 2}
+        roles, plan, pools = net_processing._plan_ips(self.data,
+                                                      self.global_data)
+        self.assertEqual(['Controller', 'Compute'],
+                         [r['name'] for r in roles])
+        net, first, count = plan['Compute'][0]
+        self.assertEqual('external', net['lower'])
+        self.assertEqual('2001:db8:fd00:1000::13',
+                         str(netaddr.IPAddress(first, net['version'])))
+        self.assertEqual(2, count)
+        first, last, version = pools['tenant']
+        self.assertEqual('172.16.0.15', str(netaddr.IPAddress(first)))
+        self.assertEqual('172.16.0.250', str(netaddr.IPAddress(last)))
+
+    def test_plan_large(self):
+        self.global_data['tenant']['end'] = '172.16.255.250'
+        self.global_data['management']['end'] = '172.20.255.250'
+        self.global_data['node_counts'] = {'Controller': 3, 'Compute': 9997}
+        roles, plan, pools = net_processing._plan_ips(self.data,
+                                                      self.global_data)
+        net, first, count = plan['Compute'][-1]
+        self.assertEqual('172.16.39.25',
+                         str(netaddr.IPAddress(first + count - 1)))
+
+    def test_pool_too_small(self):
+        self.global_data['node_counts'] = {'Controller': 3, 'Compute': 238}
+        self.assertRaises(RuntimeError, net_processing._plan_ips,
+                          self.data, self.global_data)
+        self.global_data['node_counts']['Compute'] = 237
+        net_processing._plan_ips(self.data, self.global_data)
+
+    def test_invalid_counts(self):
+        for counts in [{'Foo': 1}, {'Compute': -1}, {'Compute': '1'}]:
+            self.global_data['node_counts'] = counts
+            self.assertRaises(RuntimeError, net_processing._plan_ips,
+                              self.data, self.global_data)
+
+    def test_generate(self):
+        output_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_path)
+        self.global_data['node_counts'] = {'Controller': 1, 'Compute': 1}
+        net_processing._generate(self.data, self.global_data, output_path)
+        with open(os.path.join(output_path, 'ips-from-pool.yaml')) as f:
+            env = yaml.safe_load(f)
+        self.assertEqual(
+            '../network/ports/internal_api_from_pool_v6.yaml',
+            env['resource_registry']['OS::TripleO::Compute::Ports::'
+                                     'InternalApiPort'])
+        self.assertEqual(
+            '../network/ports/tenant_from_pool.yaml',
+            env['resource_registry']['OS::TripleO::Compute::Ports::'
+                                     'TenantPort'])
+        params = env['parameter_defaults']
+        self.assertEqual(['172.16.0.10'], params['ControllerIPs']['tenant'])
+        self.assertEqual(['172.16.0.11'], params['NovaComputeIPs']['tenant'])
+        self.assertEqual([{'start': '172.16.0.12', 'end': '172.16.0.250'}],
+                         params['TenantAllocationPools'])
+
+class TestStructure(unittest.TestCase):
+    def _errors(self, node_data):
+        return [(e.path, e.message)
+                for _, path, node, parents in net_processing._walk_nodes(
+                    {'role.yaml': node_data})
+                for e in net_processing._structure_errors(
+                    'role.yaml', path, node, parents)]
+
+    def test_valid(self):
+        for name in os.listdir('test-data'):
+            path = os.path.join('test-data', name, 'nic-input.json')
+            if not os.path.exists(path):
+                continue
+            with open(path) as f:
+                data = json.loads(f.read())
+            for filename, node_data in data.items():
+                self.assertEqual([], self._errors(node_data))
+
+    def test_invalid_members(self):
+        self.assertEqual(
+            [((0, 0, 0), 'vlan "VLAN" cannot contain interface "nic1"')],
+            self._errors([{'type': 'ovs_bridge', 'name': 'br-ex',
+                           'members': [{'type': 'vlan', 'name': 'VLAN',
+                                        'members': [{'type': 'interface',
+                                                     'name': 'nic1'}]}]}]))
+        self.assertEqual(
+            [((0, 0, 0), 'ovs_bond "bond1" cannot contain ovs_bridge '
+                         '"br-ex"')],
+            self._errors([{'type': 'ovs_bridge', 'name': 'br-ex',
+                           'members': [{'type': 'ovs_bond', 'name': 'bond1',
+                                        'members': [{'type': 'ovs_bridge',
+                                                     'name': 'br-ex'}]}]}]))
+        self.assertEqual([((0,), 'Unknown node type "bridge"')],
+                         self._errors([{'type': 'bridge', 'name': 'br-ex'}]))
+        self.assertEqual([((0,), 'vlan "VLAN" cannot be used at the top '
+                                 'level')],
+                         self._errors([{'type': 'vlan', 'name': 'VLAN'}]))
+
+    def test_malformed_nodes(self):
+        self.assertEqual([((0,), "Invalid node: 'oops'"),
+                          ((1, 0), "Invalid node: 'oops'")],
+                         self._errors(['oops',
+                                       {'type': 'ovs_bridge', 'name': 'br-ex',
+                                        'members': ['oops']}]))
+        self.assertEqual([((0,), 'The members of ovs_bridge "br-ex" are not '
+                                 'a list')],
+                         self._errors([{'type': 'ovs_bridge', 'name': 'br-ex',
+                                        'members': 'oops'}]))
+        errors, _ = net_processing._find_config_errors(
+            {'a.yaml': 'oops', 'b.yaml': [{'type': 'interface',
+                                           'name': 'nic1',
+                                           'members': [5]}]}, {})
+        self.assertEqual([('a.yaml', (), 'The nodes of a.yaml are not a list'),
+                          ('b.yaml', (0, 0), 'Invalid node: 5')], errors)
+
+    def test_invalid_members_reported(self):
+        data, global_data = net_processing._load_input(
+            'test-data/all-the-things')
+        data['compute.yaml'].append({'type': 'vlan', 'name': 'VLAN',
+                                     'network': 'Storage'})
+        errors, _ = net_processing._find_config_errors(data, global_data)
+        self.assertEqual([('compute.yaml', (2,),
+                           'vlan "VLAN" cannot be used at the top level')],
+                         errors)
+
+    def test_invalid_role_skips_rules(self):
+        bridge = {'type': 'ovs_bridge', 'name': 'br-ex', 'members': []}
+        errors, index = net_processing._find_config_errors(
+            {'a.yaml': [dict(bridge, network='Tenant'),
+                        {'type': 'route', 'name': 'r'}],
+             'b.yaml': [bridge]}, {}, global_rules=[])
+        self.assertEqual(
+            [('a.yaml', (1,), 'route "r" cannot be used at the top level'),
+             ('b.yaml', (0,), 'Found no interface or bond on bridge "br-ex"')],
+            sorted(errors))
+        self.assertEqual({}, index)
+
+class TestNetworkUsage(unittest.TestCase):
+    def _next_nic(self, node_data):
+        numbers = [int(node['name'][3:]) for _, _, node, _ in
+                   net_processing._walk_nodes({'role': node_data})
+                   if node['type'] == 'interface' and
+                   node['name'].startswith('nic')]
+        return 'nic%d' % (max(numbers + [0]) + 1)
+
+    def _assert_matches(self, usage, data):
+        self.assertEqual(set(net_processing._build_net_index(data)),
+                         set(usage.networks))
+        for filename, node_data in data.items():
+            self.assertEqual(self._next_nic(node_data),
+                             usage.next_nic(filename))
+
+    def test_usage(self):
+        data, global_data = net_processing._load_input(
+            'test-data/all-the-things')
+        usage = net_processing._NetworkUsage(data)
+        self._assert_matches(usage, data)
+        self.assertTrue(usage.used('Storage'))
+        self.assertFalse(usage.used('None'))
+        self.assertEqual('nic1', usage.next_nic('unknown.yaml'))
+
+        # Remove every use of Storage, one node at a time
+        for filename, path, node, _ in list(
+                net_processing._walk_nodes(data)):
+            if node.get('network') == 'Storage':
+                usage.remove(filename, node)
+                node['network'] = 'Tenant'
+                usage.add(filename, node)
+        self._assert_matches(usage, data)
+        self.assertFalse(usage.used('Storage'))
+
+        bridge = data['compute.yaml'][0]
+        nic = {'type': 'interface', 'name': 'nic7', 'network': 'Management'}
+        bridge['members'].append(nic)
+        usage.add('compute.yaml', nic)
+        self._assert_matches(usage, data)
+        self.assertEqual('nic8', usage.next_nic('compute.yaml'))
+
+        for _, _, node, _ in net_processing._walk_nodes({'': [bridge]}):
+            usage.remove('compute.yaml', node)
+        del data['compute.yaml'][0]
+        self._assert_matches(usage, data)
+
+class TestHistory(unittest.TestCase):
+    def test_undo_redo(self):
+        data, _ = net_processing._load_input('test-data/all-the-things')
+        original = copy.deepcopy(data)
+        history = net_history.History(data)
+        self.assertFalse(history.can_undo)
+        self.assertIsNone(history.undo())
+
+        data['compute.yaml'][0]['members'][0]['mtu'] = 9000
+        self.assertTrue(history.record(
+            {'compute.yaml': data['compute.yaml'],
+             'controller.yaml': data['controller.yaml']}))
+        del data['compute.yaml'][0]
+        self.assertTrue(history.record({'compute.yaml': data['compute.yaml']}))
+        edited = copy.deepcopy(data)
+
+        history.undo()
+        self.assertEqual({'compute.yaml': original['compute.yaml']},
+                         history.undo())
+        self.assertFalse(history.can_undo)
+        self.assertEqual(original,
+                         dict((filename, net_history.thaw(frozen))
+                              for filename, frozen
+                              in history.current.items()))
+        history.redo()
+        self.assertEqual({'compute.yaml': edited['compute.yaml']},
+                         history.redo())
+        self.assertFalse(history.can_redo)
+
+        # A new edit after undoing replaces what could have been redone
+        history.undo()
+        self.assertTrue(history.record({'compute.yaml': []}))
+        self.assertFalse(history.can_redo)
+
+    def test_no_change(self):
+        data, _ = net_processing._load_input('test-data/all-the-things')
+        history = net_history.History(data)
+        self.assertFalse(history.record(copy.deepcopy(data)))
+        self.assertFalse(history.can_undo)
+
+        # True and 1 are equal, but would not be saved the same
+        bridge = data['compute.yaml'][0]
+        bridge['use_dhcp'] = not bridge['use_dhcp']
+        history.record({'compute.yaml': data['compute.yaml']})
+        bridge['use_dhcp'] = int(bridge['use_dhcp'])
+        self.assertTrue(history.record({'compute.yaml':
+                                        data['compute.yaml']}))
+        self.assertIs(bool,
+                      type(history.undo()['compute.yaml'][0]['use_dhcp']))
+
+    def test_sharing(self):
+        data, _ = net_processing._load_input('test-data/all-the-things')
+        history = net_history.History(data)
+        before = dict(history.current)
+        data['compute.yaml'].insert(0, {'type': 'interface', 'name': 'nic9',
+                                        'network': 'Tenant'})
+        history.record({'compute.yaml': data['compute.yaml'],
+                        'controller.yaml': data['controller.yaml']})
+        after = dict(history.current)
+        self.assertIs(before['controller.yaml'], after['controller.yaml'])
+        # The existing nodes moved down one, but are not copied
+        for old, new in zip(before['compute.yaml'], after['compute.yaml'][1:]):
+            self.assertIs(old, new)
+
+        # Only the path to a changed value is new
+        bridge = data['compute.yaml'][1]
+        bridge['members'][0]['mtu'] = 1400
+        history.record({'compute.yaml': data['compute.yaml']})
+        old_bridge = dict(after['compute.yaml'][1])
+        new_bridge = dict(history.current['compute.yaml'][1])
+        self.assertIsNot(old_bridge['members'][0], new_bridge['members'][0])
+        for old, new in zip(old_bridge['members'][1:],
+                            new_bridge['members'][1:]):
+            self.assertIs(old, new)
+        self.assertIs(after['compute.yaml'][0],
+                      history.current['compute.yaml'][0])
+
+
+class TestImport(unittest.TestCase):
+    def setUp(self):
+        self.output_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_path)
+
+    def test_round_trip(self):
+        for name in ['nics-basic', 'all-the-things', 'all-the-things-v2',
+                     'ipv6-multi', 'ovs-dpdk']:
+            input_path = os.path.join('test-data', name)
+            data, global_data = net_import._import_templates(input_path)
+            self.assertEqual([], net_processing._diff(data, global_data,
+                                                      input_path))
+            original = net_processing._load_input(input_path)[1]
+            self.assertEqual(original.get('version', 1),
+                             global_data['version'])
+            self.assertEqual(original.get('auto_routes', True),
+                             global_data.get('auto_routes', True))
+            self.assertEqual(original.get('ipv6', False),
+                             global_data.get('ipv6', False))
+            for key in ['external', 'internal_api', 'tenant']:
+                self.assertEqual(original[key], global_data[key])
+            self.assertNotIn('roles', global_data)
+
+    def test_round_trip_custom(self):
+        data, global_data = net_processing._load_input(
+            'test-data/all-the-things-v2')
+        data['compute-2.yaml'] = data['compute.yaml']
+        data['storage-nfs.yaml'] = copy.deepcopy(data['cinder-storage.yaml'])
+        global_data['dedup_nic_configs'] = True
+        global_data['networks'] = [{'name': 'StorageNfs', 'vlan': 70}]
+        global_data['storage_nfs'] = {'cidr': '172.21.0.0/24',
+                                      'start': '172.21.0.10',
+                                      'end': '172.21.0.250', 'vlan': 7}
+        data['storage-nfs.yaml'][0]['members'][1]['network'] = 'StorageNfs'
+        global_data['node_counts'] = {'Controller': 3, 'StorageNfs': 2}
+        global_data['trim_nic_params'] = True
+        net_processing._generate(data, global_data, self.output_path)
+
+        data, global_data = net_import._import_templates(self.output_path)
+        self.assertEqual([], net_processing._diff(data, global_data,
+                                                  self.output_path))
+        self.assertTrue(global_data['dedup_nic_configs'])
+        self.assertTrue(global_data['trim_nic_params'])
+        # A shared role's own filename is not recorded anywhere
+        self.assertEqual(data['compute.yaml'], data['compute2.yaml'])
+        self.assertEqual([{'name': 'StorageNfs', 'vlan': 70}],
+                         global_data['networks'])
+        self.assertEqual(7, global_data['storage_nfs']['vlan'])
+        self.assertEqual({'Controller': 3, 'StorageNfs': 2},
+                         global_data['node_counts'])
+
+    def test_unknown_top_level(self):
+        shutil.rmtree(self.output_path)
+        shutil.copytree('test-data/all-the-things', self.output_path)
+        path = os.path.join(self.output_path, 'nic-configs', 'compute.yaml')
+        with open(path) as f:
+            template = yaml.safe_load(f)
+        resource = template['resources']['OsNetConfigImpl']
+        resource['properties']['config']['os_net_config'][
+            'network_config'].append({'type': 'vlan', 'vlan_id': 5})
+        with open(path, 'w') as f:
+            yaml.safe_dump(template, f)
+        self.assertRaises(RuntimeError, net_import._import_templates,
+                          self.output_path)
+
+    def test_malformed_nic_config(self):
+        shutil.rmtree(self.output_path)
+        shutil.copytree('test-data/all-the-things', self.output_path)
+        path = os.path.join(self.output_path, 'nic-configs',
+                            'controller.yaml')
+        with open(path) as f:
+            text = f.read()
+        for broken, message in [(text.replace('vlan_id:', 'vlan:'),
+                                 'controller.yaml: missing \'vlan_id\''),
+                                (text + '\n  [unclosed\n', 'Invalid YAML')]:
+            with open(path, 'w') as f:
+                f.write(broken)
+            with self.assertRaises(RuntimeError) as cm:
+                net_import._import_templates(self.output_path)
+            self.assertIn(message, str(cm.exception))
+
+    def test_output_dirs(self):
+        inputs = ['a/env1', 'b/env2/']
+        self.assertEqual(inputs, net_processing._output_dirs(inputs))
+        self.assertEqual([os.path.join('out', 'env1'),
+                          os.path.join('out', 'env2')],
+                         net_processing._output_dirs(inputs, 'out'))
+        self.assertRaises(RuntimeError, net_processing._output_dirs,
+                          ['a/env1', 'b/env1'], 'out')
+        self.assertEqual('Imported 1 of 2 directories in 0.50 s '
+                         '(4.0 directories/s)',
+                         net_processing._throughput('Imported', 1, 2, 0.5,
+                                                    'directories'))
+
 class TestValidations(unittest.TestCase):
     def _load_data(self, name):
         with open('test-data/%s/nic-input.json' % name) as f:
@@ -94,6 +891,148 @@ class TestValidations(unittest.TestCase):
         data, global_data = self._load_data('all-the-things')
         net_processing._validate_config(data, global_data)
 
+    def test_find_config_errors(self):
+        data, global_data = self._load_data('all-the-things')
+        self.assertEqual([], net_processing._find_config_errors(
+            data, global_data)[0])
+
+        bridge = data['controller.yaml'][1]
+        bond = bridge['members'][0]
+        bond['members'][0]['name'] = 'nic1'
+        bond['members'][1]['primary'] = True
+        bridge['members'][1]['network'] = 'None'
+        global_data['tenant']['vlan'] = global_data['storage']['vlan']
+        errors = net_processing._find_config_errors(data, global_data)[0]
+        self.assertEqual(
+            [('controller.yaml', (1, 0, 0), 'Duplicate nic name: "nic1"'),
+             ('controller.yaml', (1, 0),
+              'Found multiple primary interfaces on bond "bond1"'),
+             ('controller.yaml', (1, 1), 'VLANs must have a network set'),
+             (None, (), 'Duplicate VLAN found: 3'),
+             ], sorted(errors, key=lambda e: e.role is None))
+
+        self.assertRaises(RuntimeError, net_processing._validate_config,
+                          data, global_data)
+
+    def test_validator(self):
+        data, global_data = self._load_data('all-the-things')
+        validator = net_processing._Validator()
+        for filename, node_data in data.items():
+            validator.update(filename, node_data)
+
+        def check():
+            expected = net_processing._find_config_errors(data, global_data)
+            actual = validator.errors(global_data)
+            self.assertEqual(sorted(expected[0], key=repr),
+                             sorted(actual[0], key=repr))
+            self.assertEqual(expected[1], actual[1])
+            return actual[0]
+
+        self.assertEqual([], check())
+        bridge = data['controller.yaml'][1]
+        bridge['members'][0]['members'][0]['name'] = 'nic1'
+        bridge['members'][1]['network'] = 'None'
+        validator.update('controller.yaml', data['controller.yaml'])
+        self.assertEqual(2, len(check()))
+
+        # Only updated roles are seen
+        data['compute.yaml'][0]['members'].append({'type': 'vlan',
+                                                   'name': 'VLAN',
+                                                   'network': 'None'})
+        self.assertEqual(2, len(validator.errors(global_data)[0]))
+        validator.update('compute.yaml', data['compute.yaml'])
+        global_data['tenant']['vlan'] = global_data['storage']['vlan']
+        self.assertEqual(4, len(check()))
+
+        del data['compute.yaml']
+        validator.remove('compute.yaml')
+        self.assertEqual(3, len(check()))
+
+    def test_duplicate_roles(self):
+        data, global_data = self._load_data('all-the-things')
+        global_data['roles'] = [{'filename': 'controller.yaml'},
+                                {'filename': 'controller.yaml'},
+                                {'filename': 'compute.yaml',
+                                 'name': 'Controller'}]
+        data['compute_node.yaml'] = []
+        data['compute-node.yaml'] = []
+        errors, _ = net_processing._find_config_errors(data, global_data)
+        self.assertEqual(['Duplicate role filename found: "controller.yaml"',
+                          'Duplicate role name found: "ComputeNode"',
+                          'Duplicate role name found: "Controller"',
+                          'Duplicate role name found: "Controller"'],
+                         sorted(e.message for e in errors))
+
+        global_data['roles'].append({'name': 'Compute'})
+        errors, _ = net_processing._find_config_errors(data, global_data)
+        self.assertEqual(['Role 3 has no filename'],
+                         [e.message for e in errors])
+
+    def test_duplicate_networks(self):
+        data, global_data = self._load_data('all-the-things')
+        global_data['networks'] = [{'name': 'StorageNfs'},
+                                   {'name': 'Storage'},
+                                   {'name': 'Nfs', 'lower': 'storage_nfs'},
+                                   {'lower': 'nfs'}]
+        errors, _ = net_processing._find_config_errors(data, global_data)
+        self.assertEqual(['Network 3 has no name',
+                          'Duplicate network name found: "Storage"',
+                          'Duplicate network name found: "storage_nfs"'],
+                         [e.message for e in errors])
+
+    def test_network_settings(self):
+        data, global_data = self._load_data('all-the-things')
+        global_data['networks'] = [{'name': 'StorageNfs'},
+                                   {'name': 'Nfs', 'vlan': '70'}]
+        data['compute.yaml'][0]['members'].append(
+            {'type': 'vlan', 'name': 'VLAN', 'network': 'StorageNfs'})
+        del global_data['tenant']['cidr']
+        global_data['storage']['vlan'] = 'thirty'
+        errors, _ = net_processing._find_config_errors(data, global_data)
+        self.assertEqual(['Invalid VLAN for network "Nfs": \'70\'',
+                          'Invalid VLAN for network "Storage": \'thirty\'',
+                          'No cidr set for the Tenant network',
+                          'No settings found for the StorageNfs network'],
+                         sorted(e.message for e in errors))
+
+    def test_single_member_bond(self):
+        data, global_data = self._load_data('all-the-things')
+        bond = data['controller.yaml'][1]['members'][0]
+        bond['members'] = bond['members'][:1] + bond['members'][2:]
+        errors = net_processing._find_config_errors(data, global_data)[0]
+        self.assertEqual(['Bonds must contain at least two interfaces'],
+                         [e.message for e in errors])
+
+    def test_net_index(self):
+        data, _ = self._load_data('all-the-things')
+        index = net_processing._build_net_index(data)
+        self.assertNotIn('None', index)
+        self.assertEqual(0, index['ControlPlane']['depth'])
+        self.assertFalse(index['ControlPlane']['vlan'])
+        self.assertEqual(1, index['External']['depth'])
+        self.assertTrue(index['External']['vlan'])
+        self.assertIn('controller.yaml', index['External']['roles'])
+        self.assertEqual((True, True),
+                         net_processing._net_used_all(data, 'External', index))
+        self.assertEqual((False, False),
+                         net_processing._net_used_all(data, 'Foo', index))
+
+    def test_net_index_nested(self):
+        data = {'compute.yaml': [
+            {'type': 'ovs_bridge', 'name': 'br-ex', 'network': 'None',
+             'members': [
+                 {'type': 'ovs_bond', 'name': 'bond1', 'network': 'None',
+                  'members': [{'type': 'interface', 'name': 'nic2',
+                               'network': 'Tenant'}]}]}]}
+        index = net_processing._build_net_index(data)
+        self.assertEqual(2, index['Tenant']['depth'])
+        self.assertEqual((True, False),
+                         net_processing._net_used(data, 'Tenant',
+                                                  'compute.yaml', index))
+        self.assertEqual((False, False),
+                         net_processing._net_used(data, 'Tenant',
+                                                  'controller.yaml', index))
+
     def test_vlans_valid(self):
         data, global_data = self._load_data('all-the-things')
         net_processing._check_duplicate_vlans(data, global_data)
@@ -129,6 +1068,26 @@ class TestValidations(unittest.TestCase):
                           net_processing._check_overlapping_cidrs,
                           data, global_data)
 
+    def test_cidrs_overlapping_pairs(self):
+        data, global_data = self._load_data('all-the-things')
+        global_data['external']['cidr'] = '172.16.0.0/12'
+        global_data['storage']['cidr'] = '172.17.0.0/24'
+        global_data['tenant']['cidr'] = '2001:db8::/64'
+        global_data['management']['cidr'] = '2001:db8::/56'
+        index = net_processing._build_net_index(data)
+        errors = list(net_processing._overlapping_cidr_errors(global_data,
+                                                              index))
+        self.assertEqual(
+            sorted(['Overlapping CIDRs detected: "172.16.0.0/12" and '
+                    '"172.17.0.0/24"',
+                    'Overlapping CIDRs detected: "172.16.0.0/12" and '
+                    '"172.19.0.0/24"',
+                    'Duplicate CIDR found: "172.17.0.0/24"',
+                    'Overlapping CIDRs detected: "2001:db8::/56" and '
+                    '"2001:db8::/64"',
+                    ]),
+            sorted(e.message for e in errors))
+
     def test_ips_in_cidr_valid(self):
         data, global_data = self._load_data('all-the-things')
         net_processing._check_ips_in_cidr(data, global_data)